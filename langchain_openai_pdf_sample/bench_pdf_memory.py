@@ -0,0 +1,110 @@
+import os
+import sys
+import json
+import base64
+import resource
+import subprocess
+import time
+import tracemalloc
+
+from pdf_stream import PDF_DATA_URL_PREFIX, convert_pdf_to_data_url, write_pdf_base64
+
+
+def create_synthetic_pdf(file_path, size_mb):
+    """
+    指定したサイズの合成PDFを作成する関数
+    中身はランダムなバイト列を持つストリームで、圧縮の効かない大きなPDFを再現する
+    """
+    size = size_mb * 1024 * 1024
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+    with open(file_path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        f.write(f"1 0 obj\n<< /Length {size} >>\nstream\n".encode("ascii"))
+        block = 4 * 1024 * 1024
+        written = 0
+        while written < size:
+            n = min(block, size - written)
+            f.write(os.urandom(n))
+            written += n
+        f.write(b"\nendstream\nendobj\ntrailer\n<< >>\n%%EOF\n")
+
+
+def legacy_data_url(pdf_path):
+    """
+    従来の方法（read() -> b64encode -> decode -> f-stringでdata URLに連結）
+    """
+    with open(pdf_path, "rb") as f:
+        pdf_bytes = f.read()
+    pdf_str = base64.b64encode(pdf_bytes).decode("utf-8")
+    return f"{PDF_DATA_URL_PREFIX}{pdf_str}"
+
+
+def stream_to_devnull(pdf_path):
+    """
+    base64をメモリ上に文字列として保持せず、書き込み先（ここでは/dev/null）へ直接書き込む
+    """
+    with open(os.devnull, "wb") as out:
+        return write_pdf_base64(pdf_path, out, prefix=PDF_DATA_URL_PREFIX)
+
+
+METHODS = {
+    "legacy": legacy_data_url,
+    "stream_str": convert_pdf_to_data_url,
+    "stream_write": stream_to_devnull,
+}
+
+
+def run_worker(method, pdf_path):
+    """
+    計測用のサブプロセスで1つの方法を実行し、結果をJSONで出力する
+    プロセスごとに分けることで、前の計測のメモリ使用量が影響しないようにする
+    """
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = METHODS[method](pdf_path)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    del result
+
+    print(json.dumps({
+        "method": method,
+        "seconds": elapsed,
+        "tracemalloc_peak_mb": peak / 1024 / 1024,
+        # Linuxではru_maxrssの単位はKB
+        "maxrss_delta_mb": (rss_after - rss_before) / 1024,
+    }))
+
+
+def main():
+    # ========== 設定 ==========
+    # 作成する合成PDFのサイズ（MB）
+    sizes_mb = [50, 200]
+    bench_dir = "outputs/bench"
+    # =========================
+
+    for size_mb in sizes_mb:
+        pdf_path = os.path.join(bench_dir, f"synthetic_{size_mb}mb.pdf")
+        if not os.path.exists(pdf_path):
+            print(f"合成PDFを作成します: {pdf_path}")
+            create_synthetic_pdf(pdf_path, size_mb)
+
+        print(f"=== {size_mb}MB ===")
+        for method in METHODS:
+            proc = subprocess.run(
+                [sys.executable, __file__, "--worker", method, pdf_path],
+                capture_output=True, text=True, check=True,
+            )
+            r = json.loads(proc.stdout)
+            print(f"{r['method']:>12}: {r['seconds']:6.2f}s  "
+                  f"tracemalloc peak {r['tracemalloc_peak_mb']:8.1f}MB  "
+                  f"maxrss +{r['maxrss_delta_mb']:8.1f}MB")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--worker":
+        run_worker(sys.argv[2], sys.argv[3])
+    else:
+        main()
@@ -1,5 +1,4 @@
 import os
-import base64
 from io import BytesIO
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.messages import HumanMessage, SystemMessage
@@ -8,17 +7,8 @@ from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.runnables import RunnableLambda
 from dotenv import load_dotenv, find_dotenv
 
-def convert_pdf_to_base64(pdf_path):
-    """
-    Convert a PDF file to a Base64 encoded string.
-
-    :param pdf_path: path to the pdf file
-    :return: Base64 string
-    """
-    with open(pdf_path, "rb") as f:
-        pdf_bytes = f.read()
-    pdf_str = base64.b64encode(pdf_bytes).decode("utf-8")
-    return pdf_str
+from pdf_stream import convert_pdf_to_base64
+from stream_sinks import ConsoleSink, format_stats, stream_to_sinks
 
 def prompt_func(data):
     user_input = data["user_input"]
@@ -58,10 +48,9 @@ print("pdfファイルの変換が完了したので、処理を開始します
 
 query = "PDFは何を解説しているか教えてください。"
 
-output = ""
-for chunk in chain.stream({"user_input": query, "pdf": pdf_b64}):
-    print(chunk, end="", flush=True)
-    output += chunk
+# 出力はチャンクが届くたびにsinksへ書き込む（ファイルにも保存する場合は FileSink("outputs/output.txt") を追加）
+sinks = [ConsoleSink()]
+output, stats = stream_to_sinks(chain.stream({"user_input": query, "pdf": pdf_b64}), sinks)
 
-print("\n=== Output ===")
-print(output)
+print("=== Stats ===")
+print(format_stats(stats))
@@ -1,5 +1,4 @@
 import os
-import base64
 from io import BytesIO
 from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_core.output_parsers import StrOutputParser
@@ -7,24 +6,16 @@ from langchain_openai import ChatOpenAI
 from langchain_core.runnables import RunnableLambda
 from dotenv import load_dotenv, find_dotenv
 
+from pdf_stream import convert_pdf_to_data_url
+from stream_sinks import ConsoleSink, format_stats, stream_to_sinks
+
 _ = load_dotenv(find_dotenv())
 api_key = os.getenv("OPENAI_APIKEY")
 
-def convert_pdf_to_base64(pdf_path):
-    """
-    Convert a PDF file to a Base64 encoded string.
-
-    :param pdf_path: path to the pdf file
-    :return: Base64 string
-    """
-    with open(pdf_path, "rb") as f:
-        pdf_bytes = f.read()
-    pdf_str = base64.b64encode(pdf_bytes).decode("utf-8")
-    return pdf_str
-
 def prompt_func(data):
     user_input = data["user_input"]
-    pdf = data["pdf"]
+    # "data:application/pdf;base64,..."形式の文字列。ここで再度連結しないことで巨大な文字列のコピーを避ける
+    pdf_data_url = data["pdf_data_url"]
     pdf_file_path = data["pdf_file_path"]
 
     message = [
@@ -39,7 +30,7 @@ def prompt_func(data):
                     "type": "file",
                     "file": {
                         "filename": f"{pdf_file_path}",
-                        "file_data": f"data:application/pdf;base64,{pdf}"
+                        "file_data": pdf_data_url
                     }
                 },
             ]
@@ -63,7 +54,7 @@ model = ChatOpenAI(
 chain = prompt_func | model | StrOutputParser()
 
 file_path = "inputs/DeepSeek-R1-paper-asap-r3.pdf"
-pdf_b64 = convert_pdf_to_base64(file_path)
+pdf_data_url = convert_pdf_to_data_url(file_path)
 
 print("pdfファイルの変換が完了したので、処理を開始します。")
 
@@ -71,14 +62,16 @@ print("pdfファイルの変換が完了したので、処理を開始します
 query = "5ページ目の年表を説明してください。図と説明をつなぐ線に着目して、時系列がずれないように正確に解説してください。"
 
 #以下でも良い
-#output = chain.invoke({"user_input": query, "pdf": pdf_b64, "pdf_file_path": file_path})
+#output = chain.invoke({"user_input": query, "pdf_data_url": pdf_data_url, "pdf_file_path": file_path})
 
 #stream出力
-output = ""
-for chunk in chain.stream({"user_input": query, "pdf": pdf_b64, "pdf_file_path": file_path}):
-    print(chunk, end="", flush=True)
-    output += chunk
+# 出力はチャンクが届くたびにsinksへ書き込む（ファイルにも保存する場合は FileSink("outputs/output.txt") を追加）
+sinks = [ConsoleSink()]
+output, stats = stream_to_sinks(
+    chain.stream({"user_input": query, "pdf_data_url": pdf_data_url, "pdf_file_path": file_path}),
+    sinks
+)
 
-print("\n=== Output ===")
-print(output)
+print("=== Stats ===")
+print(format_stats(stats))
 
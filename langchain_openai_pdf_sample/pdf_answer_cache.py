@@ -0,0 +1,220 @@
+import os
+import re
+import time
+import sqlite3
+import unicodedata
+
+import numpy as np
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
+
+from pdf_index import compute_file_hash, load_embedding_model
+from pdf_retrieval_langchain import encode_pdf, full_prompt_func, load_model
+from stream_sinks import ConsoleSink, format_stats, stream_to_sinks
+
+
+CACHE_PATH = "answer_cache/answers.sqlite3"
+
+
+def normalize_question(question):
+    """
+    質問文を正規化する関数
+    全角/半角の違い、大文字/小文字、空白や句読点の違いだけの質問を同じキーとして扱うため
+    """
+    question = unicodedata.normalize("NFKC", question).lower()
+    return re.sub(r"[\s、。,.!?！？「」『』()（）]+", "", question)
+
+
+class AnswerCache:
+    """
+    (ドキュメントハッシュ, モデル, 正規化した質問)をキーに回答を保存するキャッシュ
+    モデルは"openai/gpt-4o"のような文字列で、別のモデルの回答は返さない
+    ローカルのSQLiteに保存し、TTL（有効期限）とLRU（最大件数を超えたら最も使われていないものから削除）で管理する
+    embedding_model_nameを指定した場合は、言い回しが異なる質問も類似度がsimilarity_threshold以上ならヒットとする
+    """
+
+    def __init__(self, cache_path=CACHE_PATH, ttl_seconds=7 * 24 * 3600, max_entries=10000,
+                 embedding_model_name=None, similarity_threshold=0.9):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.embedding_model = load_embedding_model(embedding_model_name) if embedding_model_name else None
+
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(cache_path)
+        # モデルの列がない古い形式のキャッシュは、どのモデルの回答か分からないため削除して作り直す
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(answers)")]
+        if columns and "model" not in columns:
+            self.conn.execute("DROP TABLE answers")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                doc_hash TEXT NOT NULL,
+                model TEXT NOT NULL,
+                question_key TEXT NOT NULL,
+                question TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                embedding BLOB,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (doc_hash, model, question_key)
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS answers_last_access ON answers (last_access)")
+        self.conn.commit()
+
+    def _embed(self, question):
+        vector = self.embedding_model.encode([question], normalize_embeddings=True)
+        return np.asarray(vector, dtype=np.float32)[0]
+
+    def get(self, doc_hash, question, model=""):
+        """
+        キャッシュから回答を取得する関数
+        完全一致（正規化後）を優先し、見つからない場合は埋め込みの類似度で検索する
+        最終的な出力は、回答の文字列。ヒットしなかった場合はNone
+        """
+        now = time.time()
+        expire_before = now - self.ttl_seconds
+        key = normalize_question(question)
+
+        row = self.conn.execute(
+            "SELECT question_key, answer FROM answers "
+            "WHERE doc_hash = ? AND model = ? AND question_key = ? AND created_at >= ?",
+            (doc_hash, model, key, expire_before),
+        ).fetchone()
+
+        if row is None and self.embedding_model is not None:
+            rows = self.conn.execute(
+                "SELECT question_key, answer, embedding FROM answers "
+                "WHERE doc_hash = ? AND model = ? AND created_at >= ? AND embedding IS NOT NULL",
+                (doc_hash, model, expire_before),
+            ).fetchall()
+            if rows:
+                query_vec = self._embed(question)
+                matrix = np.stack([np.frombuffer(r[2], dtype=np.float32) for r in rows])
+                sims = matrix @ query_vec
+                best = int(np.argmax(sims))
+                if sims[best] >= self.similarity_threshold:
+                    row = rows[best][:2]
+
+        if row is None:
+            return None
+
+        # LRUのため、最終アクセス時刻を更新する
+        self.conn.execute(
+            "UPDATE answers SET last_access = ? WHERE doc_hash = ? AND model = ? AND question_key = ?",
+            (now, doc_hash, model, row[0]),
+        )
+        self.conn.commit()
+        return row[1]
+
+    def put(self, doc_hash, question, answer, model=""):
+        """
+        回答をキャッシュに保存する関数
+        保存後、期限切れのものと最大件数を超えた分を削除する
+        """
+        now = time.time()
+        embedding = self._embed(question).tobytes() if self.embedding_model is not None else None
+        self.conn.execute(
+            "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (doc_hash, model, normalize_question(question), question, answer, embedding, now, now),
+        )
+        self.evict(now)
+        self.conn.commit()
+
+    def evict(self, now=None):
+        """
+        期限切れのエントリと、max_entriesを超えた古いエントリ（最終アクセスが古い順）を削除する関数
+        """
+        now = now or time.time()
+        self.conn.execute("DELETE FROM answers WHERE created_at < ?", (now - self.ttl_seconds,))
+        self.conn.execute(
+            "DELETE FROM answers WHERE rowid IN ("
+            "SELECT rowid FROM answers ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def close(self):
+        self.conn.close()
+
+
+class CachedAnswerChain:
+    """
+    chainの前段に回答キャッシュを挟むラッパー
+    chain.streamと同じく回答の文字列をチャンクごとに返すため、呼び出し側はキャッシュの有無を意識しなくてよい
+    inputsには、chainへの入力に加えて"doc_hash"と"user_input"が必要
+    modelは、キャッシュのキーに含めるモデル名（"openai/gpt-4o"など）
+    prepareを指定した場合は、キャッシュにヒットしなかったときだけ呼び出し、戻り値の辞書をinputsに追加する
+    （PDFの変換など、chainの実行にだけ必要な重い処理を遅延させるため）
+    出力に文字列以外を混ぜないように、キャッシュにヒットしたかどうかはlast_hitとstatsに記録する
+    """
+
+    def __init__(self, chain, cache, model=""):
+        self.chain = chain
+        self.cache = cache
+        self.model = model
+        self.last_hit = False
+        self.stats = {"hits": 0, "misses": 0}
+
+    def stream(self, inputs, prepare=None):
+        doc_hash = inputs["doc_hash"]
+        question = inputs["user_input"]
+
+        answer = self.cache.get(doc_hash, question, self.model)
+        self.last_hit = answer is not None
+        if answer is not None:
+            self.stats["hits"] += 1
+            yield answer
+            return
+
+        self.stats["misses"] += 1
+        if prepare is not None:
+            inputs = {**inputs, **prepare()}
+        chunks = []
+        for chunk in self.chain.stream(inputs):
+            chunks.append(chunk)
+            yield chunk
+        # 最後まで生成できた回答のみを保存する
+        self.cache.put(doc_hash, question, "".join(chunks), self.model)
+
+    def invoke(self, inputs, prepare=None):
+        return "".join(self.stream(inputs, prepare))
+
+
+def main():
+    # ========== 設定 ==========
+    # "openai" もしくは "gemini"
+    provider = "openai"
+    # 言い回しの異なる質問もヒットさせる場合は、オフラインの埋め込みモデルを指定する
+    embedding_model_name = None
+    #embedding_model_name = "intfloat/multilingual-e5-small"
+
+    file_path = "inputs/DeepSeek-R1-paper-asap-r3.pdf"
+    query = "PDFは何を解説しているか教えてください。"
+    # =========================
+
+    model = load_model(provider)
+    chain = RunnableLambda(full_prompt_func) | model | StrOutputParser()
+    cache = AnswerCache(embedding_model_name=embedding_model_name)
+    model_name = getattr(model, "model_name", None) or getattr(model, "model", "")
+    cached_chain = CachedAnswerChain(chain, cache, model=f"{provider}/{model_name}")
+
+    doc_hash = compute_file_hash(file_path)
+    inputs = {"user_input": query, "doc_hash": doc_hash, "pdf_file_path": file_path, "provider": provider}
+
+    def prepare():
+        # キャッシュにヒットした場合はPDFの変換も不要なため、ヒットしなかった場合だけ変換する
+        pdf_str = encode_pdf(file_path, provider)
+        print("pdfファイルの変換が完了したので、処理を開始します。")
+        return {"pdf": pdf_str}
+
+    output, stats = stream_to_sinks(cached_chain.stream(inputs, prepare), [ConsoleSink()])
+    if cached_chain.last_hit:
+        print("キャッシュにヒットしました。")
+
+    print("=== Stats ===")
+    print(format_stats(stats))
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
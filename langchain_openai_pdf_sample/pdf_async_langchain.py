@@ -0,0 +1,156 @@
+import asyncio
+import time
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
+
+from pdf_retrieval_langchain import encode_pdf, full_prompt_func, load_model
+from stream_sinks import ConsoleSink, astream_to_sinks, format_stats
+
+
+def build_chain(provider, model_name=None):
+    """
+    providerごとのPDF Q&Aチェーンを作成する関数
+    """
+    return RunnableLambda(full_prompt_func) | load_model(provider, model_name) | StrOutputParser()
+
+
+async def encode_pdf_for_providers(pdf_path, providers):
+    """
+    各providerに合わせた形式でPDFを変換する関数
+    変換はブロッキング処理のため別スレッドで並列に実行し、同じ形式の変換は1回にまとめる
+    最終的な出力は、{provider: 変換後の文字列} の辞書
+    """
+    # OpenAIはdata URL形式、それ以外はbase64文字列のため、最大2種類の変換で済む
+    kinds = {provider: ("data_url" if provider == "openai" else "base64") for provider in providers}
+    representative = {kind: provider for provider, kind in kinds.items()}
+    results = await asyncio.gather(*(
+        asyncio.to_thread(encode_pdf, pdf_path, provider) for provider in representative.values()
+    ))
+    encoded = dict(zip(representative.keys(), results))
+    return {provider: encoded[kind] for provider, kind in kinds.items()}
+
+
+def build_inputs(query, pdf_path, provider, pdf_str):
+    return {"user_input": query, "pdf": pdf_str, "pdf_file_path": pdf_path, "provider": provider}
+
+
+async def _timed_ainvoke(provider, chain, inputs):
+    """
+    チェーンを実行し、(provider, 回答, 所要時間) を返す
+    """
+    start = time.perf_counter()
+    answer = await chain.ainvoke(inputs)
+    return provider, answer, time.perf_counter() - start
+
+
+async def _cancel_all(tasks):
+    """
+    実行中のタスクをすべてキャンセルし、終了まで待つ関数
+    待たずに終了すると、HTTP接続などの後処理が行われないままイベントループが終了してしまうため
+    """
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def race(chains, pdf_path, query, timeout=None):
+    """
+    同じ質問を複数のproviderへ同時に送り、最初に完了した回答を返す関数（レイテンシ重視モード）
+    chainsは、{provider: chain} の辞書
+    失敗したproviderは無視し、残りのproviderの完了を待つ。回答が得られた時点で残りのリクエストはキャンセルする
+    最終的な出力は、(provider, 回答, 所要時間)
+    """
+    pdf_strs = await encode_pdf_for_providers(pdf_path, list(chains))
+    tasks = {
+        asyncio.create_task(_timed_ainvoke(provider, chain, build_inputs(query, pdf_path, provider, pdf_strs[provider])))
+        for provider, chain in chains.items()
+    }
+
+    errors = []
+    pending = set(tasks)
+    try:
+        async with asyncio.timeout(timeout):
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    errors.append(task.exception())
+    finally:
+        await _cancel_all(pending)
+
+    raise RuntimeError(f"すべてのproviderでエラーが発生しました: {errors}")
+
+
+async def compare(chains, pdf_path, query, timeout=None):
+    """
+    同じ質問を複数のproviderへ同時に送り、すべての回答を集める関数（比較モード）
+    timeoutを過ぎたproviderはキャンセルし、エラーとして記録する
+    最終的な出力は、{provider: {"answer": 回答, "seconds": 所要時間} もしくは {"error": エラー}} の辞書
+    """
+    pdf_strs = await encode_pdf_for_providers(pdf_path, list(chains))
+
+    async def run(provider, chain):
+        inputs = build_inputs(query, pdf_path, provider, pdf_strs[provider])
+        try:
+            _, answer, seconds = await asyncio.wait_for(_timed_ainvoke(provider, chain, inputs), timeout)
+            return provider, {"answer": answer, "seconds": seconds}
+        except Exception as e:
+            return provider, {"error": repr(e)}
+
+    results = await asyncio.gather(*(run(provider, chain) for provider, chain in chains.items()))
+    return dict(results)
+
+
+async def stream(chain, pdf_path, query, provider, sinks=None):
+    """
+    1つのproviderで回答をストリーム出力する関数
+    """
+    pdf_str = await asyncio.to_thread(encode_pdf, pdf_path, provider)
+    return await astream_to_sinks(
+        chain.astream(build_inputs(query, pdf_path, provider, pdf_str)),
+        sinks if sinks is not None else [ConsoleSink()],
+    )
+
+
+async def main():
+    # ========== 設定 ==========
+    # "latency": 最初に完了した回答を返す / "compare": すべての回答を集める / "stream": 1つ目のproviderでストリーム出力する
+    mode = "latency"
+    providers = ["openai", "gemini"]
+    # 1リクエストあたりのタイムアウト（秒）
+    timeout = 120
+
+    file_path = "inputs/DeepSeek-R1-paper-asap-r3.pdf"
+    query = "PDFは何を解説しているか教えてください。"
+    # =========================
+
+    chains = {provider: build_chain(provider) for provider in providers}
+
+    if mode == "latency":
+        provider, answer, seconds = await race(chains, file_path, query, timeout=timeout)
+        print(f"=== {provider} ({seconds:.2f}s) ===")
+        print(answer)
+
+    elif mode == "compare":
+        results = await compare(chains, file_path, query, timeout=timeout)
+        for provider, result in results.items():
+            if "error" in result:
+                print(f"=== {provider} (エラー) ===")
+                print(result["error"])
+            else:
+                print(f"=== {provider} ({result['seconds']:.2f}s) ===")
+                print(result["answer"])
+
+    elif mode == "stream":
+        provider = providers[0]
+        _, stats = await stream(chains[provider], file_path, query, provider)
+        print("=== Stats ===")
+        print(format_stats(stats))
+
+    else:
+        raise ValueError(f"未対応のmodeです: {mode}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,192 @@
+import os
+import json
+import asyncio
+import datetime
+from pathlib import Path
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
+
+from pdf_index import PdfChunkIndex, compute_file_hash, format_chunks_for_prompt
+from pdf_retrieval_langchain import encode_pdf, full_prompt_func, retrieval_prompt_func, load_model
+
+
+def find_pdfs(input_dir):
+    """
+    ディレクトリ以下のPDFファイルを再帰的に探索する関数
+    処理順を毎回同じにするため、パスでソートして返す
+    """
+    return sorted(p for p in Path(input_dir).rglob("*") if p.is_file() and p.suffix.lower() == ".pdf")
+
+
+def load_done_keys(output_path):
+    """
+    出力済みのJSONLを読み込み、処理済みの(ドキュメントハッシュ, 質問)の集合を返す関数
+    途中で中断された場合に最終行が壊れていることがあるため、読めない行は無視する
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            done.add((record["doc_hash"], record["question"]))
+    return done
+
+
+class JsonlWriter:
+    """
+    複数のタスクから安全にJSONLへ追記するためのクラス
+    1件ごとにflushするため、途中で停止しても完了済みの回答は失われない
+    """
+
+    def __init__(self, output_path):
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        self.f = open(output_path, "a", encoding="utf-8")
+        self.lock = asyncio.Lock()
+
+    async def write(self, record):
+        async with self.lock:
+            self.f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+async def process_document(pdf_path, questions, chain, mode, provider, done,
+                           writer, request_semaphore, doc_semaphore, top_k):
+    """
+    1つのPDFに対して、未処理の質問をすべて実行する関数
+    doc_semaphoreで同時に開くPDFの数を、request_semaphoreで同時に実行するリクエスト数を制限する
+    最終的な出力は出力した回答の数。PDFを読み込めなかった場合はNoneを返す（他のPDFの処理は続ける）
+    """
+    async with doc_semaphore:
+        todo = []
+        try:
+            # ハッシュ計算やbase64変換はブロッキング処理のため、別スレッドで実行する
+            doc_hash = await asyncio.to_thread(compute_file_hash, pdf_path)
+            todo = [q for q in questions if (doc_hash, q) not in done]
+            if not todo:
+                print(f"スキップ（処理済み）: {pdf_path}")
+                return 0
+            # 同じ内容のPDFが複数ある場合に二重に処理しないよう、先に処理済みとして登録する
+            done.update((doc_hash, q) for q in todo)
+
+            if mode == "full":
+                pdf_str = await asyncio.to_thread(encode_pdf, str(pdf_path), provider)
+                index = None
+            else:
+                pdf_str = None
+                index = await asyncio.to_thread(PdfChunkIndex.build_or_load, str(pdf_path))
+        except Exception as e:
+            # 読み込めないPDF（破損・権限など）は出力せずに次のPDFへ進む（次回の実行時に再処理される）
+            print(f"エラー発生（PDFを読み込めません）: {pdf_path}: {e!r}")
+            if todo:
+                done.difference_update((doc_hash, q) for q in todo)
+            return None
+
+        async def ask(question):
+            if index is None:
+                inputs = {"user_input": question, "pdf": pdf_str, "pdf_file_path": str(pdf_path), "provider": provider}
+            else:
+                chunks = sorted(index.search(question, top_k=top_k), key=lambda c: (c["page"], c["id"]))
+                inputs = {"user_input": question, "context": format_chunks_for_prompt(chunks)}
+
+            async with request_semaphore:
+                try:
+                    answer = await chain.ainvoke(inputs)
+                except Exception as e:
+                    # 失敗した質問は出力しないため、次回の実行時に再処理される
+                    print(f"エラー発生: {pdf_path} / {question}: {e}")
+                    return 0
+
+            await writer.write({
+                "doc_hash": doc_hash,
+                "question": question,
+                "file": str(pdf_path),
+                "answer": answer,
+                "mode": mode,
+                "provider": provider,
+                "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            })
+            return 1
+
+        results = await asyncio.gather(*(ask(q) for q in todo))
+        print(f"完了: {pdf_path} ({sum(results)}/{len(todo)}件)")
+        return sum(results)
+
+
+async def run_bulk(input_dir, questions, output_path, provider="openai", mode="full",
+                   max_concurrency=8, max_open_documents=4, top_k=5):
+    """
+    ディレクトリ内のすべてのPDFに同じ質問セットを適用し、回答をJSONLに出力する関数
+    出力済みの(ドキュメントハッシュ, 質問)はスキップするため、中断しても再実行で続きから処理できる
+    """
+    model = load_model(provider)
+    prompt_func = full_prompt_func if mode == "full" else retrieval_prompt_func
+    chain = RunnableLambda(prompt_func) | model | StrOutputParser()
+
+    pdfs = find_pdfs(input_dir)
+    done = load_done_keys(output_path)
+    print(f"{len(pdfs)}件のPDFを処理します。（処理済みの回答: {len(done)}件）")
+
+    request_semaphore = asyncio.Semaphore(max_concurrency)
+    doc_semaphore = asyncio.Semaphore(max_open_documents)
+    writer = JsonlWriter(output_path)
+    try:
+        results = await asyncio.gather(*(
+            process_document(pdf_path, questions, chain, mode, provider, done,
+                             writer, request_semaphore, doc_semaphore, top_k)
+            for pdf_path in pdfs
+        ), return_exceptions=True)
+    finally:
+        # return_exceptions=Trueのため、全てのPDFの処理が終わってから閉じる
+        writer.close()
+
+    for pdf_path, result in zip(pdfs, results):
+        if isinstance(result, Exception):
+            print(f"エラー発生: {pdf_path}: {result!r}")
+    results = [None if isinstance(result, Exception) else result for result in results]
+    failed = [str(pdf_path) for pdf_path, result in zip(pdfs, results) if result is None]
+    print(f"新たに{sum(r for r in results if r is not None)}件の回答を出力しました: {output_path}")
+    if failed:
+        print(f"処理できなかったPDF: {len(failed)}件")
+        for path in failed:
+            print(f"  {path}")
+
+
+def main():
+    # ========== 設定 ==========
+    input_dir = "inputs"
+    output_path = "outputs/answers.jsonl"
+    # "openai" もしくは "gemini"
+    provider = "openai"
+    # "full": PDF全体を入力する / "retrieval": 関連するチャンクのみを入力する
+    mode = "full"
+    # 同時に実行するリクエスト数
+    max_concurrency = 8
+    # 同時に開くPDFの数（base64文字列をメモリに保持する数）
+    max_open_documents = 4
+
+    questions = [
+        "PDFは何を解説しているか教えてください。",
+        "PDFの結論を3行でまとめてください。",
+    ]
+    # =========================
+
+    asyncio.run(run_bulk(
+        input_dir,
+        questions,
+        output_path,
+        provider=provider,
+        mode=mode,
+        max_concurrency=max_concurrency,
+        max_open_documents=max_open_documents,
+    ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+import os
+import re
+import json
+import math
+import hashlib
+from collections import Counter
+
+import numpy as np
+from pypdf import PdfReader
+
+
+# インデックスの保存先。ドキュメントのハッシュごとにサブディレクトリを作成する
+INDEX_DIR = "index_cache"
+
+
+def compute_file_hash(file_path, block_size=1024 * 1024):
+    """
+    ファイルのsha256ハッシュを計算する関数
+    file_pathは、ハッシュを計算するファイルのパス
+    巨大なファイルでもメモリを消費しないように、block_sizeごとに読み込む
+    """
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def extract_pages_text(pdf_path):
+    """
+    PDFからページごとのテキストを抽出する関数
+    pdf_pathは、PDFファイルのパス
+    最終的な出力は、ページ番号(1始まり)とテキストを持つ辞書のリスト
+    例: [{"page": 1, "text": "1ページ目のテキスト"}, ...]
+    """
+    reader = PdfReader(pdf_path)
+    pages = []
+    for i, page in enumerate(reader.pages):
+        text = page.extract_text() or ""
+        pages.append({"page": i + 1, "text": text})
+    return pages
+
+
+def split_into_chunks(pages, chunk_size=800, chunk_overlap=100):
+    """
+    ページごとのテキストをチャンクに分割する関数
+    pagesは、extract_pages_textの出力
+    chunk_sizeは、1チャンクあたりの最大文字数
+    chunk_overlapは、前後のチャンクで重複させる文字数
+    チャンクはページをまたがないように分割し、元のページ番号を保持する
+    例: [{"id": 0, "page": 1, "text": "チャンクのテキスト"}, ...]
+    """
+    if chunk_overlap >= chunk_size:
+        raise ValueError("chunk_overlapはchunk_sizeより小さくしてください。")
+
+    chunks = []
+    step = chunk_size - chunk_overlap
+    for page in pages:
+        # 連続する空白を詰めてから分割する
+        text = re.sub(r"\s+", " ", page["text"]).strip()
+        if not text:
+            continue
+        for start in range(0, len(text), step):
+            piece = text[start:start + chunk_size]
+            chunks.append({"id": len(chunks), "page": page["page"], "text": piece})
+            if start + chunk_size >= len(text):
+                break
+    return chunks
+
+
+def estimate_text_tokens(text):
+    """
+    テキストのトークン数を見積もる関数
+    英数字はおよそ4文字で1トークン、日本語などの非ASCII文字はおよそ1文字で1トークンとして計算する
+    """
+    non_ascii = len(re.findall(r"[^\x00-\x7f]", text))
+    return (len(text) - non_ascii) // 4 + non_ascii
+
+
+def tokenize(text):
+    """
+    BM25用にテキストをトークンに分割する関数
+    英数字は単語単位、日本語などの非ASCII文字は文字bigram単位で分割する
+    （形態素解析器に依存せず、日本語のPDFでも検索できるようにするため）
+    """
+    text = text.lower()
+    tokens = re.findall(r"[a-z0-9]+", text)
+    for run in re.findall(r"[^\x00-\x7f\s]+", text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class BM25Index:
+    """
+    Okapi BM25によるキーワード検索インデックス
+    documentsは、検索対象のテキストのリスト
+    """
+
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_tfs = [Counter(tokenize(doc)) for doc in documents]
+        self.doc_lens = [sum(tf.values()) for tf in self.doc_tfs]
+        self.avg_len = (sum(self.doc_lens) / len(self.doc_lens)) if self.doc_lens else 0.0
+
+        # 各トークンが出現するドキュメント数からidfを計算
+        df = Counter()
+        for tf in self.doc_tfs:
+            df.update(tf.keys())
+        n = len(self.doc_tfs)
+        self.idf = {
+            token: math.log(1 + (n - freq + 0.5) / (freq + 0.5))
+            for token, freq in df.items()
+        }
+
+    def get_scores(self, query):
+        """
+        クエリに対する各ドキュメントのBM25スコアをnumpy配列で返す
+        """
+        query_tokens = tokenize(query)
+        scores = np.zeros(len(self.doc_tfs), dtype=np.float32)
+        for i, tf in enumerate(self.doc_tfs):
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lens[i] / (self.avg_len or 1.0))
+            score = 0.0
+            for token in query_tokens:
+                freq = tf.get(token)
+                if not freq:
+                    continue
+                score += self.idf[token] * freq * (self.k1 + 1) / (freq + norm)
+            scores[i] = score
+        return scores
+
+
+def load_embedding_model(model_name):
+    """
+    オフラインで動作する埋め込みモデルを読み込む関数
+    model_nameは、sentence-transformersのモデル名もしくはローカルのモデルディレクトリ
+    sentence-transformersはオプションの依存関係のため、インストールされていない場合はエラーを出す
+    """
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError as e:
+        raise ImportError(
+            "埋め込みモデルを利用するには sentence-transformers をインストールしてください。"
+        ) from e
+    return SentenceTransformer(model_name)
+
+
+def _embedding_file_name(model_name):
+    """
+    埋め込みモデル名からベクトルの保存ファイル名を生成する
+    """
+    slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name)
+    return f"embeddings_{slug}.npy"
+
+
+class PdfChunkIndex:
+    """
+    PDFのチャンクに対するローカル検索インデックス
+    BM25に加えて、埋め込みモデルが指定された場合はベクトル検索を併用する
+    インデックスは INDEX_DIR/<ドキュメントハッシュ>/ に保存し、次回以降は再利用する
+    """
+
+    def __init__(self, chunks, index_path, embedding_model=None, embeddings=None):
+        self.chunks = chunks
+        self.index_path = index_path
+        self.bm25 = BM25Index([chunk["text"] for chunk in chunks])
+        self.embedding_model = embedding_model
+        # embeddingsはnp.memmapとして読み込まれ、必要な行だけがメモリに載る
+        self.embeddings = embeddings
+
+    @classmethod
+    def build_or_load(cls, pdf_path, embedding_model_name=None,
+                      chunk_size=800, chunk_overlap=100, index_dir=INDEX_DIR):
+        """
+        PDFのインデックスを読み込む。存在しない場合は作成して保存する
+        pdf_pathは、PDFファイルのパス
+        embedding_model_nameは、ベクトル検索に利用する埋め込みモデル名。Noneの場合はBM25のみ
+        """
+        doc_hash = compute_file_hash(pdf_path)
+        index_path = os.path.join(index_dir, doc_hash)
+        chunks_path = os.path.join(index_path, "chunks.json")
+
+        # チャンクの読み込み、もしくは作成
+        chunks = None
+        if os.path.exists(chunks_path):
+            with open(chunks_path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            # チャンク設定が異なる場合は作り直す
+            if saved["chunk_size"] == chunk_size and saved["chunk_overlap"] == chunk_overlap:
+                chunks = saved["chunks"]
+
+        if chunks is None:
+            print("インデックスを作成します。")
+            pages = extract_pages_text(pdf_path)
+            chunks = split_into_chunks(pages, chunk_size, chunk_overlap)
+            os.makedirs(index_path, exist_ok=True)
+            with open(chunks_path, "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "source": os.path.basename(pdf_path),
+                        "chunk_size": chunk_size,
+                        "chunk_overlap": chunk_overlap,
+                        "chunks": chunks,
+                    },
+                    f,
+                    ensure_ascii=False,
+                )
+            # チャンクが変わった場合は古いベクトルも無効
+            for name in os.listdir(index_path):
+                if name.startswith("embeddings_"):
+                    os.remove(os.path.join(index_path, name))
+        else:
+            print("保存済みのインデックスを読み込みます。")
+
+        embedding_model = None
+        embeddings = None
+        if embedding_model_name:
+            embedding_model = load_embedding_model(embedding_model_name)
+            emb_path = os.path.join(index_path, _embedding_file_name(embedding_model_name))
+            if not os.path.exists(emb_path):
+                vectors = embedding_model.encode(
+                    [chunk["text"] for chunk in chunks],
+                    normalize_embeddings=True,
+                )
+                vectors = np.asarray(vectors, dtype=np.float32)
+                # .npy形式で保存し、読み込み時はmemmapとして開く
+                out = np.lib.format.open_memmap(
+                    emb_path, mode="w+", dtype=np.float32, shape=vectors.shape
+                )
+                out[:] = vectors
+                out.flush()
+                del out
+            embeddings = np.load(emb_path, mmap_mode="r")
+
+        return cls(chunks, index_path, embedding_model, embeddings)
+
+    def search(self, query, top_k=5, alpha=0.5):
+        """
+        クエリに関連するチャンクを上位top_k件返す関数
+        alphaは、ベクトル検索スコアの重み（0〜1）。埋め込みモデルがない場合はBM25のみを利用する
+        最終的な出力は、チャンクの辞書にスコアを追加したリスト（ページ順ではなくスコア順）
+        """
+        if not self.chunks:
+            return []
+
+        scores = self.bm25.get_scores(query)
+        # スケールを揃えるため、最大値で正規化する
+        if scores.max() > 0:
+            scores = scores / scores.max()
+
+        if self.embeddings is not None:
+            query_vec = self.embedding_model.encode([query], normalize_embeddings=True)
+            query_vec = np.asarray(query_vec, dtype=np.float32)[0]
+            # 正規化済みのため内積がコサイン類似度になる
+            sims = np.asarray(self.embeddings @ query_vec, dtype=np.float32)
+            scores = (1 - alpha) * scores + alpha * sims
+
+        top_k = min(top_k, len(self.chunks))
+        top_ids = np.argsort(-scores)[:top_k]
+        return [dict(self.chunks[i], score=float(scores[i])) for i in top_ids]
+
+
+def format_chunks_for_prompt(chunks):
+    """
+    検索結果のチャンクをプロンプトに埋め込むテキストに整形する関数
+    LLMが参照元を示せるように、ページ番号を付与する
+    """
+    return "\n\n".join(f"[p.{chunk['page']}]\n{chunk['text']}" for chunk in chunks)
@@ -0,0 +1,163 @@
+import os
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
+from dotenv import load_dotenv, find_dotenv
+
+from pdf_index import PdfChunkIndex, format_chunks_for_prompt
+from pdf_stream import convert_pdf_to_base64, convert_pdf_to_data_url
+from stream_sinks import ConsoleSink, format_stats, stream_to_sinks
+
+_ = load_dotenv(find_dotenv())
+api_key = os.getenv("OPENAI_APIKEY")
+
+SYSTEM_PROMPT = "あなたは日本語を話す優秀なアシスタントです。回答には必ず日本語で答えてください。また考える過程も出力してください。"
+
+
+def encode_pdf(pdf_path, provider):
+    """
+    providerに合わせた形式でPDFを文字列に変換する関数
+    OpenAIはdata URL形式、Geminiはbase64文字列をそのまま入力する
+    """
+    if provider == "openai":
+        return convert_pdf_to_data_url(pdf_path)
+    return convert_pdf_to_base64(pdf_path)
+
+
+def load_model(provider, model_name=None, **kwargs):
+    """
+    providerに応じてモデルを作成する関数
+    providerは、"openai" もしくは "gemini"
+    model_nameは、利用するモデル名。Noneの場合はproviderごとの既定のモデル
+    kwargsは、モデルにそのまま渡す追加の引数（rate_limiterなど）
+    """
+    if provider == "openai":
+        from langchain_openai import ChatOpenAI
+        model_name = model_name or "gpt-4o"
+        if not model_name.startswith("o"):
+            # o1などの推論モデルはtemperature/top_pを指定できないため、それ以外のモデルのみ指定する
+            kwargs = {"temperature": 0.001, "top_p": 0.001, **kwargs}
+        return ChatOpenAI(
+            model=model_name,
+            openai_api_key=api_key,
+            **kwargs
+        )
+    if provider == "gemini":
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        return ChatGoogleGenerativeAI(
+            model=model_name or "gemini-2.0-flash-001",
+            temperature=0.001,
+            top_p=0.001,
+            **kwargs
+        )
+    raise ValueError(f"未対応のproviderです: {provider}")
+
+
+def full_prompt_func(data):
+    """
+    PDF全体をそのまま入力する従来のプロンプト
+    providerごとにPDFの渡し方が異なるため、dataの"provider"で切り替える
+    dataの"pdf"は、encode_pdfでproviderに合わせて変換した文字列
+    """
+    user_input = data["user_input"]
+    pdf = data["pdf"]
+
+    if data["provider"] == "openai":
+        pdf_content = {
+            "type": "file",
+            "file": {
+                "filename": f"{data['pdf_file_path']}",
+                "file_data": pdf
+            }
+        }
+    else:
+        pdf_content = {
+            'type': 'media',
+            'mime_type': "application/pdf",
+            'data': pdf
+        }
+
+    message = [
+        SystemMessage(content=SYSTEM_PROMPT),
+        HumanMessage(
+            content=[
+                {
+                    "type": "text",
+                    "text": f"{user_input}"
+                },
+                pdf_content,
+            ]
+        )
+    ]
+
+    return message
+
+
+def retrieval_prompt_func(data):
+    """
+    検索で取得したチャンクのテキストのみを入力するプロンプト
+    PDF全体を送らないため、長いドキュメントでも高速かつ低コストで処理できる
+    """
+    user_input = data["user_input"]
+    context = data["context"]
+
+    message = [
+        SystemMessage(content=SYSTEM_PROMPT + "\n以下のPDFの抜粋のみを根拠に回答し、参照したページ番号を示してください。"),
+        HumanMessage(
+            content=[
+                {
+                    "type": "text",
+                    "text": f"# PDFの抜粋\n{context}\n\n# 質問\n{user_input}"
+                },
+            ]
+        )
+    ]
+
+    return message
+
+
+def main():
+    # ========== 設定 ==========
+    # "full": PDF全体を入力する / "retrieval": 関連するチャンクのみを入力する
+    mode = "retrieval"
+    # "openai" もしくは "gemini"
+    provider = "openai"
+    # 検索で取得するチャンク数
+    top_k = 5
+    # ベクトル検索に利用するオフライン埋め込みモデル。Noneの場合はBM25のみ
+    embedding_model_name = None
+    #embedding_model_name = "intfloat/multilingual-e5-small"
+
+    file_path = "inputs/DeepSeek-R1-paper-asap-r3.pdf"
+    query = "PDFは何を解説しているか教えてください。"
+    # =========================
+
+    model = load_model(provider)
+
+    if mode == "full":
+        chain = RunnableLambda(full_prompt_func) | model | StrOutputParser()
+        pdf_str = encode_pdf(file_path, provider)
+        inputs = {"user_input": query, "pdf": pdf_str, "pdf_file_path": file_path, "provider": provider}
+        print("pdfファイルの変換が完了したので、処理を開始します。")
+
+    elif mode == "retrieval":
+        chain = RunnableLambda(retrieval_prompt_func) | model | StrOutputParser()
+        index = PdfChunkIndex.build_or_load(file_path, embedding_model_name=embedding_model_name)
+        chunks = index.search(query, top_k=top_k)
+        print(f"検索結果のページ: {[chunk['page'] for chunk in chunks]}")
+        # LLMが読みやすいように、ページ順に並べ替えてから入力する
+        chunks = sorted(chunks, key=lambda chunk: (chunk["page"], chunk["id"]))
+        inputs = {"user_input": query, "context": format_chunks_for_prompt(chunks)}
+        print("チャンクの検索が完了したので、処理を開始します。")
+
+    else:
+        raise ValueError(f"未対応のmodeです: {mode}")
+
+    output, stats = stream_to_sinks(chain.stream(inputs), [ConsoleSink()])
+
+    print("=== Stats ===")
+    print(format_stats(stats))
+
+
+if __name__ == "__main__":
+    main()
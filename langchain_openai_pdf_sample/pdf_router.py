@@ -0,0 +1,216 @@
+import os
+import re
+import json
+import time
+import datetime
+from collections import defaultdict
+from langchain_core.messages.ai import add_usage
+from langchain_core.runnables import RunnableLambda
+
+from pdf_index import estimate_text_tokens, extract_pages_text
+from pdf_retrieval_langchain import encode_pdf, full_prompt_func, load_model
+
+
+# ルーティング対象のモデル一覧
+# qualityは、1: 要約など軽いタスク向け / 2: 図表・レイアウトの読み取り向け / 3: 複雑な推論向け
+# 価格は100万トークンあたりのドル。latency_priorは実行記録がない場合に利用する1リクエストあたりの目安の秒数
+MODEL_CATALOG = [
+    {"provider": "gemini", "model": "gemini-2.0-flash-001", "context_window": 1_000_000,
+     "input_price": 0.10, "output_price": 0.40, "quality": 1, "latency_prior": 8.0},
+    {"provider": "openai", "model": "gpt-4o-mini", "context_window": 128_000,
+     "input_price": 0.15, "output_price": 0.60, "quality": 1, "latency_prior": 10.0},
+    {"provider": "openai", "model": "gpt-4o", "context_window": 128_000,
+     "input_price": 2.50, "output_price": 10.00, "quality": 2, "latency_prior": 15.0},
+    {"provider": "openai", "model": "o1", "context_window": 200_000,
+     "input_price": 15.00, "output_price": 60.00, "quality": 3, "latency_prior": 60.0},
+]
+
+# 質問の種類ごとに必要なquality
+REQUIRED_QUALITY = {"summary": 1, "general": 1, "layout": 2, "reasoning": 3}
+
+# 質問の種類を判定するためのキーワード
+LAYOUT_KEYWORDS = ["ページ目", "図表", "年表", "一覧表", "グラフ", "数値", "レイアウト", "時系列", "矢印", "正確"]
+# 「図」「表」「線」は「意図」「発表」「代表」「路線」などの単語にも含まれるため、
+# 前後が漢字でない場合（「図の」「表1」「線を」など）だけ一致させる
+LAYOUT_CHAR_PATTERN = re.compile(r"(?<![\u4e00-\u9fff])[図表線](?![\u4e00-\u9fff])")
+REASONING_KEYWORDS = ["証明", "導出", "計算", "厳密", "矛盾"]
+SUMMARY_KEYWORDS = ["要約", "まとめ", "概要", "何を解説", "何について"]
+
+# PDFを入力した場合、テキストに加えてページ画像分のトークンが消費されるため、1ページあたりの目安を加算する
+TOKENS_PER_PAGE_IMAGE = 800
+# 回答として想定する出力トークン数
+EXPECTED_OUTPUT_TOKENS = 1500
+
+RUNS_PATH = "outputs/model_runs.jsonl"
+
+
+def estimate_tokens(pdf_path):
+    """
+    PDFを入力した場合の入力トークン数を見積もる関数
+    抽出したテキストのトークン数に、ページ画像分のトークン数を加算する
+    最終的な出力は、(ページ数, 見積もりトークン数)
+    """
+    pages = extract_pages_text(pdf_path)
+    text = "".join(page["text"] for page in pages)
+    tokens = estimate_text_tokens(text) + TOKENS_PER_PAGE_IMAGE * len(pages)
+    return len(pages), tokens
+
+
+def classify_query(query):
+    """
+    質問の種類を判定する関数
+    "layout": 特定のページの図表や年表など、レイアウトを正確に読み取る必要がある質問
+    "reasoning": 計算や導出など、複雑な推論が必要な質問
+    "summary": PDF全体の要約など、大まかな内容を問う質問
+    "general": 上記以外
+    """
+    if any(keyword in query for keyword in REASONING_KEYWORDS):
+        return "reasoning"
+    if any(keyword in query for keyword in LAYOUT_KEYWORDS) or LAYOUT_CHAR_PATTERN.search(query):
+        return "layout"
+    if any(keyword in query for keyword in SUMMARY_KEYWORDS):
+        return "summary"
+    return "general"
+
+
+class RunStats:
+    """
+    モデルごとの実行記録（レイテンシ・トークン数）を保存し、ルーティングにフィードバックするクラス
+    記録はJSONLに追記し、次回以降の実行でも利用する
+    """
+
+    def __init__(self, runs_path=RUNS_PATH):
+        self.runs_path = runs_path
+        self.runs = defaultdict(list)
+        if os.path.exists(runs_path):
+            with open(runs_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        run = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.runs[run["model"]].append(run)
+
+    def record(self, run):
+        """
+        実行記録を1件追加する
+        """
+        self.runs[run["model"]].append(run)
+        os.makedirs(os.path.dirname(self.runs_path) or ".", exist_ok=True)
+        with open(self.runs_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(run, ensure_ascii=False) + "\n")
+
+    def mean_latency(self, model_name, default):
+        """
+        直近の実行の平均レイテンシ（秒）を返す。記録がない場合はdefaultを返す
+        """
+        runs = self.runs.get(model_name, [])[-20:]
+        if not runs:
+            return default
+        return sum(run["latency"] for run in runs) / len(runs)
+
+    def token_correction(self, model_name):
+        """
+        実際の入力トークン数と見積もりの比率の平均を返す
+        見積もりがずれているモデルでも、実行を重ねるごとに正確に選択できるようにするため
+        """
+        runs = [
+            run for run in self.runs.get(model_name, [])[-20:]
+            if run.get("input_tokens") and run.get("estimated_tokens")
+        ]
+        if not runs:
+            return 1.0
+        return sum(run["input_tokens"] / run["estimated_tokens"] for run in runs) / len(runs)
+
+
+def choose_model(estimated_tokens, query_type, stats, objective="cost", catalog=MODEL_CATALOG):
+    """
+    見積もりトークン数と質問の種類から、条件を満たすモデルの中で最も安い（もしくは速い）モデルを選ぶ関数
+    objectiveは、"cost" もしくは "latency"
+    最終的な出力は、MODEL_CATALOGの要素に見積もり値を追加した辞書
+    """
+    required = REQUIRED_QUALITY[query_type]
+    candidates = []
+    for entry in catalog:
+        if entry["quality"] < required:
+            continue
+        tokens = int(estimated_tokens * stats.token_correction(entry["model"]))
+        if tokens + EXPECTED_OUTPUT_TOKENS > entry["context_window"]:
+            continue
+        cost = (tokens * entry["input_price"] + EXPECTED_OUTPUT_TOKENS * entry["output_price"]) / 1_000_000
+        latency = stats.mean_latency(entry["model"], entry["latency_prior"])
+        candidates.append(dict(entry, estimated_tokens=tokens, estimated_cost=cost, estimated_latency=latency))
+
+    if not candidates:
+        raise ValueError(f"条件を満たすモデルがありません。（見積もりトークン数: {estimated_tokens}）")
+
+    key = "estimated_cost" if objective == "cost" else "estimated_latency"
+    # 同じ値の場合は、より高品質なモデルを優先する
+    return min(candidates, key=lambda c: (c[key], -c["quality"]))
+
+
+def route_and_stream(pdf_path, query, stats, objective="cost"):
+    """
+    質問とPDFに応じてモデルを選択し、回答をストリーム出力する関数
+    実行後、レイテンシとトークン数をstatsに記録する
+    """
+    page_count, estimated_tokens = estimate_tokens(pdf_path)
+    query_type = classify_query(query)
+    choice = choose_model(estimated_tokens, query_type, stats, objective)
+    print(f"{page_count}ページ / 見積もり{estimated_tokens}トークン / 質問の種類: {query_type}")
+    print(f"選択したモデル: {choice['provider']}/{choice['model']} "
+          f"(見積もりコスト ${choice['estimated_cost']:.4f}, 見積もりレイテンシ {choice['estimated_latency']:.1f}s)")
+
+    kwargs = {"stream_usage": True} if choice["provider"] == "openai" else {}
+    model = load_model(choice["provider"], choice["model"], **kwargs)
+    chain = RunnableLambda(full_prompt_func) | model
+
+    pdf_str = encode_pdf(pdf_path, choice["provider"])
+    inputs = {"user_input": query, "pdf": pdf_str, "pdf_file_path": pdf_path, "provider": choice["provider"]}
+
+    start = time.perf_counter()
+    # チャンクを毎回結合するとチャンク数の2乗の時間がかかるため、テキストはリストに集め、usage_metadataだけ集計する
+    parts = []
+    usage = None
+    for chunk in chain.stream(inputs):
+        text = chunk.content if isinstance(chunk.content, str) else chunk.text()
+        print(text, end="", flush=True)
+        parts.append(text)
+        if chunk.usage_metadata:
+            usage = add_usage(usage, chunk.usage_metadata)
+    latency = time.perf_counter() - start
+    output = "".join(parts)
+
+    stats.record({
+        "provider": choice["provider"],
+        "model": choice["model"],
+        "query_type": query_type,
+        "pages": page_count,
+        "estimated_tokens": estimated_tokens,
+        "input_tokens": usage["input_tokens"] if usage else None,
+        "output_tokens": usage["output_tokens"] if usage else None,
+        "latency": latency,
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+    })
+    return output
+
+
+def main():
+    # ========== 設定 ==========
+    # "cost": 最も安いモデルを選ぶ / "latency": 最も速いモデルを選ぶ
+    objective = "cost"
+
+    file_path = "inputs/DeepSeek-R1-paper-asap-r3.pdf"
+    #query = "PDFは何を解説しているか教えてください。"
+    query = "5ページ目の年表を説明してください。図と説明をつなぐ線に着目して、時系列がずれないように正確に解説してください。"
+    # =========================
+
+    stats = RunStats()
+    output = route_and_stream(file_path, query, stats, objective)
+
+    print("\n=== Output ===")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
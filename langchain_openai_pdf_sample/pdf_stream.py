@@ -0,0 +1,78 @@
+import os
+import mmap
+import base64
+
+
+# base64は3バイト単位で4文字に変換されるため、チャンクサイズは3の倍数にする
+# （途中のチャンクでパディング"="が入らないようにするため）
+CHUNK_SIZE = 3 * 256 * 1024
+
+PDF_DATA_URL_PREFIX = "data:application/pdf;base64,"
+
+
+def base64_length(size):
+    """
+    sizeバイトのデータをbase64に変換したときの文字数を返す関数
+    """
+    return 4 * ((size + 2) // 3)
+
+
+def iter_pdf_base64(pdf_path, chunk_size=CHUNK_SIZE):
+    """
+    PDFファイルをbase64に変換し、チャンクごとにbytesで返すジェネレータ
+    ファイルはmmapで読み込むため、ファイル全体をPythonのメモリに載せることはない
+    pdf_pathは、PDFファイルのパス
+    chunk_sizeは、1回に変換するバイト数（3の倍数）
+    """
+    if chunk_size % 3 != 0:
+        raise ValueError("chunk_sizeは3の倍数にしてください。")
+
+    with open(pdf_path, "rb") as f:
+        # 空のファイルはmmapできないため、そのまま終了する
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            for start in range(0, len(view), chunk_size):
+                yield base64.b64encode(view[start:start + chunk_size])
+
+
+def write_pdf_base64(pdf_path, out, prefix=""):
+    """
+    PDFファイルをbase64に変換しながら、バイナリのファイルオブジェクトoutへ書き込む関数
+    リクエストボディやファイルへ直接書き込むことで、base64文字列全体をメモリに保持せずに済む
+    prefixは、先頭に書き込む文字列（"data:application/pdf;base64,"など）
+    最終的な出力は、書き込んだバイト数
+    """
+    written = 0
+    if prefix:
+        written += out.write(prefix.encode("ascii"))
+    for chunk in iter_pdf_base64(pdf_path):
+        written += out.write(chunk)
+    return written
+
+
+def convert_pdf_to_base64(pdf_path, prefix=""):
+    """
+    PDFファイルをbase64文字列に変換する関数
+    ファイル全体をread()せず、mmapからチャンクごとに変換して事前に確保したバッファへ書き込む
+    prefixを指定すると、先頭に付与した文字列を返す（data URLを後から連結し直すコピーを避けるため）
+    """
+    size = os.path.getsize(pdf_path)
+    prefix_bytes = prefix.encode("ascii")
+    buffer = bytearray(len(prefix_bytes) + base64_length(size))
+    buffer[:len(prefix_bytes)] = prefix_bytes
+
+    pos = len(prefix_bytes)
+    for chunk in iter_pdf_base64(pdf_path):
+        buffer[pos:pos + len(chunk)] = chunk
+        pos += len(chunk)
+
+    return buffer.decode("ascii")
+
+
+def convert_pdf_to_data_url(pdf_path):
+    """
+    PDFファイルを"data:application/pdf;base64,..."形式の文字列に変換する関数
+    OpenAIのfile入力にそのまま渡すことができる
+    """
+    return convert_pdf_to_base64(pdf_path, prefix=PDF_DATA_URL_PREFIX)
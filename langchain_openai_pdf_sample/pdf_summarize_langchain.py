@@ -0,0 +1,261 @@
+import os
+import asyncio
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
+from langchain_core.rate_limiters import InMemoryRateLimiter
+
+from pdf_index import extract_pages_text, split_into_chunks
+from pdf_retrieval_langchain import SYSTEM_PROMPT, encode_pdf, full_prompt_func, load_model
+from stream_sinks import ConsoleSink, astream_to_sinks, format_stats
+
+
+# この値以下のPDFは、従来通りPDF全体を1回のリクエストで処理する（高速パス）
+FAST_PATH_MAX_BYTES = 5 * 1024 * 1024
+FAST_PATH_MAX_PAGES = 30
+
+
+def map_prompt_func(data):
+    """
+    map処理用のプロンプト。1チャンク分のテキストを要約させる
+    """
+    message = [
+        SystemMessage(content=SYSTEM_PROMPT),
+        HumanMessage(
+            content=[
+                {
+                    "type": "text",
+                    "text": f"以下はPDFの{data['pages']}ページ目の抜粋です。{data['user_input']}\n"
+                            f"この抜粋の範囲で要点を簡潔にまとめてください。\n\n{data['text']}"
+                },
+            ]
+        )
+    ]
+    return message
+
+
+def reduce_prompt_func(data):
+    """
+    reduce処理用のプロンプト。複数の部分要約を1つに統合させる
+    """
+    summaries = "\n\n".join(data["summaries"])
+    message = [
+        SystemMessage(content=SYSTEM_PROMPT),
+        HumanMessage(
+            content=[
+                {
+                    "type": "text",
+                    "text": f"以下はPDFの各部分の要約です。{data['user_input']}\n"
+                            f"重複を除き、ページ順の流れを保ったまま1つの要約に統合してください。\n\n{summaries}"
+                },
+            ]
+        )
+    ]
+    return message
+
+
+def refine_prompt_func(data):
+    """
+    refine処理用のプロンプト。これまでの要約に新しいチャンクの内容を反映させる
+    """
+    message = [
+        SystemMessage(content=SYSTEM_PROMPT),
+        HumanMessage(
+            content=[
+                {
+                    "type": "text",
+                    "text": f"{data['user_input']}\n# これまでの要約\n{data['summary']}\n\n"
+                            f"# 追加の抜粋（{data['pages']}ページ目）\n{data['text']}\n\n"
+                            "追加の抜粋の内容を反映して、要約を更新してください。"
+                },
+            ]
+        )
+    ]
+    return message
+
+
+def group_chunks_by_size(chunks, max_chars):
+    """
+    チャンクを、ページ順を保ったままmax_chars以下のグループにまとめる関数
+    最終的な出力は、{"pages": "1-3", "text": "..."} の辞書のリスト
+    """
+    groups = []
+    current = []
+    size = 0
+    for chunk in chunks:
+        if current and size + len(chunk["text"]) > max_chars:
+            groups.append(current)
+            current, size = [], 0
+        current.append(chunk)
+        size += len(chunk["text"])
+    if current:
+        groups.append(current)
+
+    results = []
+    for group in groups:
+        first, last = group[0]["page"], group[-1]["page"]
+        pages = f"{first}" if first == last else f"{first}-{last}"
+        results.append({"pages": pages, "text": "\n".join(chunk["text"] for chunk in group)})
+    return results
+
+
+async def map_summaries(chain, sections, user_input, max_concurrency):
+    """
+    各セクションの要約（map処理）を並列に実行する関数
+    max_concurrencyで同時実行数を制限し、完了したものから部分要約を表示する
+    最終的な出力は、ページ順に並んだ部分要約のリスト
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def summarize(i, section):
+        async with semaphore:
+            summary = await chain.ainvoke({"user_input": user_input, **section})
+        return i, f"[p.{section['pages']}]\n{summary}"
+
+    tasks = [asyncio.create_task(summarize(i, section)) for i, section in enumerate(sections)]
+    results = [None] * len(sections)
+    try:
+        for done, future in enumerate(asyncio.as_completed(tasks), start=1):
+            i, summary = await future
+            results[i] = summary
+            # 部分要約を完了順にストリーム表示
+            print(f"\n--- 部分要約 {done}/{len(sections)} ---")
+            print(summary, flush=True)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    return results
+
+
+async def reduce_summaries(chain, summaries, user_input, fan_in, max_concurrency):
+    """
+    部分要約を階層的に統合する（reduce処理）関数
+    fan_in個ずつまとめて要約し、1つになるまで繰り返す
+    """
+    if fan_in < 2:
+        raise ValueError(f"fan_inは2以上を指定してください: {fan_in}")
+    if not summaries:
+        raise ValueError("統合する部分要約がありません。")
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def combine(group):
+        async with semaphore:
+            return await chain.ainvoke({"user_input": user_input, "summaries": group})
+
+    level = 1
+    while len(summaries) > 1:
+        groups = [summaries[i:i + fan_in] for i in range(0, len(summaries), fan_in)]
+        print(f"\n統合処理 第{level}段: {len(summaries)}件 -> {len(groups)}件")
+        summaries = await asyncio.gather(*(combine(group) for group in groups))
+        level += 1
+    return summaries[0]
+
+
+def split_into_sections(pdf_path, max_chars):
+    """
+    PDFのテキストを抽出し、max_chars文字程度のセクションに分割する関数
+    テキストを抽出できない場合（スキャンした画像だけのPDFなど）はエラーにする
+    """
+    pages = extract_pages_text(pdf_path)
+    chunks = split_into_chunks(pages, chunk_size=4000, chunk_overlap=200)
+    sections = group_chunks_by_size(chunks, max_chars)
+    if not sections:
+        raise ValueError(
+            f"PDFからテキストを抽出できませんでした（{len(pages)}ページ）。"
+            "スキャンした画像だけのPDFは、OCRでテキストを付けてから実行してください。")
+    print(f"{len(pages)}ページを{len(sections)}個のセクションに分割しました。")
+    return sections
+
+
+async def map_reduce(model, pdf_path, user_input, max_chars=12000, fan_in=5, max_concurrency=4):
+    """
+    map-reduce方式でPDFを要約する関数
+    """
+    map_chain = RunnableLambda(map_prompt_func) | model | StrOutputParser()
+    reduce_chain = RunnableLambda(reduce_prompt_func) | model | StrOutputParser()
+
+    if fan_in < 2:
+        raise ValueError(f"fan_inは2以上を指定してください: {fan_in}")
+    sections = split_into_sections(pdf_path, max_chars)
+
+    summaries = await map_summaries(map_chain, sections, user_input, max_concurrency)
+    return await reduce_summaries(reduce_chain, summaries, user_input, fan_in, max_concurrency)
+
+
+async def refine(model, pdf_path, user_input, max_chars=12000):
+    """
+    refine方式でPDFを要約する関数
+    先頭のセクションから順に要約を更新していくため並列化はできないが、文脈を保ちやすい
+    """
+    map_chain = RunnableLambda(map_prompt_func) | model | StrOutputParser()
+    refine_chain = RunnableLambda(refine_prompt_func) | model | StrOutputParser()
+
+    sections = split_into_sections(pdf_path, max_chars)
+
+    summary = await map_chain.ainvoke({"user_input": user_input, **sections[0]})
+    for i, section in enumerate(sections[1:], start=2):
+        summary = await refine_chain.ainvoke({"user_input": user_input, "summary": summary, **section})
+        print(f"\n--- 要約の更新 {i}/{len(sections)} ---")
+        print(summary, flush=True)
+    return summary
+
+
+def is_small_pdf(pdf_path):
+    """
+    PDFが高速パス（PDF全体を1回で入力）で処理できる大きさか判定する関数
+    """
+    if os.path.getsize(pdf_path) > FAST_PATH_MAX_BYTES:
+        return False
+    from pypdf import PdfReader
+    return len(PdfReader(pdf_path).pages) <= FAST_PATH_MAX_PAGES
+
+
+async def main():
+    # ========== 設定 ==========
+    # "openai" もしくは "gemini"
+    provider = "gemini"
+    # "map_reduce" もしくは "refine"
+    method = "map_reduce"
+    # map処理の同時実行数
+    max_concurrency = 4
+    # 1秒あたりのリクエスト数の上限
+    requests_per_second = 2
+
+    file_path = "inputs/DeepSeek-R1-paper-asap-r3.pdf"
+    query = "PDFは何を解説しているか教えてください。"
+    # =========================
+
+    rate_limiter = InMemoryRateLimiter(
+        requests_per_second=requests_per_second,
+        check_every_n_seconds=0.1,
+        max_bucket_size=max_concurrency,
+    )
+    model = load_model(provider, rate_limiter=rate_limiter)
+
+    if is_small_pdf(file_path):
+        # 小さいPDFは従来通りPDF全体を1回で処理する
+        print("PDFが小さいため、PDF全体を入力して処理します。")
+        chain = RunnableLambda(full_prompt_func) | model | StrOutputParser()
+        pdf_str = encode_pdf(file_path, provider)
+        output, stats = await astream_to_sinks(
+            chain.astream({"user_input": query, "pdf": pdf_str, "pdf_file_path": file_path, "provider": provider}),
+            [ConsoleSink()]
+        )
+        print("=== Stats ===")
+        print(format_stats(stats))
+        return
+
+    if method == "map_reduce":
+        output = await map_reduce(model, file_path, query, max_concurrency=max_concurrency)
+    elif method == "refine":
+        output = await refine(model, file_path, query)
+    else:
+        raise ValueError(f"未対応のmethodです: {method}")
+
+    print("\n=== Output ===")
+    print(output)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
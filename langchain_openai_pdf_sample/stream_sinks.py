@@ -0,0 +1,183 @@
+import io
+import os
+import sys
+import json
+import time
+
+from pdf_index import estimate_text_tokens
+
+
+class StreamSink:
+    """
+    ストリーム出力の書き込み先の基底クラス
+    write()はチャンクが届くたびに呼ばれ、close()はストリームの終了時に呼ばれる
+    """
+
+    def write(self, chunk):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ConsoleSink(StreamSink):
+    """
+    ターミナルにチャンクを逐次表示する
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    def write(self, chunk):
+        self.stream.write(chunk)
+        self.stream.flush()
+
+    def close(self):
+        self.stream.write("\n")
+        self.stream.flush()
+
+
+class FileSink(StreamSink):
+    """
+    テキストファイルにチャンクを逐次追記する
+    """
+
+    def __init__(self, file_path, mode="w"):
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        self.f = open(file_path, mode, encoding="utf-8")
+
+    def write(self, chunk):
+        self.f.write(chunk)
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class JsonlSink(StreamSink):
+    """
+    チャンクを1行ずつJSONLに書き込む
+    各行には、チャンクの番号と、ストリーム開始からの経過秒数を記録する
+    """
+
+    def __init__(self, file_path, mode="a"):
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        self.f = open(file_path, mode, encoding="utf-8")
+        self.index = 0
+        self.start = time.perf_counter()
+
+    def write(self, chunk):
+        record = {"index": self.index, "elapsed": time.perf_counter() - self.start, "chunk": chunk}
+        self.f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.f.flush()
+        self.index += 1
+
+    def close(self):
+        self.f.close()
+
+
+class WebSocketSink(StreamSink):
+    """
+    WebSocketでチャンクを逐次送信する
+    sendは、文字列を受け取って送信する関数（websocketsのsync clientの`ws.send`など）
+    """
+
+    def __init__(self, send, close=None):
+        self.send = send
+        self._close = close
+
+    def write(self, chunk):
+        self.send(json.dumps({"type": "chunk", "data": chunk}, ensure_ascii=False))
+
+    def close(self):
+        self.send(json.dumps({"type": "end"}))
+        if self._close is not None:
+            self._close()
+
+
+class StreamCollector:
+    """
+    ストリーム出力のチャンクを受け取り、sinksへ逐次書き込みながら全体の出力を組み立てるクラス
+    `output += chunk`のように文字列を連結し直すのではなく、io.StringIOのバッファに追記するため
+    出力が長くなってもコピーのコストが増えない
+    あわせて、最初のチャンクまでの時間（TTFT）と1秒あたりのトークン数を計測する
+    """
+
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+        self.buffer = io.StringIO()
+        self.start = time.perf_counter()
+        self.first_chunk_at = None
+        self.end = None
+        self.chunk_count = 0
+
+    def add(self, chunk):
+        if self.first_chunk_at is None:
+            self.first_chunk_at = time.perf_counter()
+        self.chunk_count += 1
+        self.buffer.write(chunk)
+        for sink in self.sinks:
+            sink.write(chunk)
+
+    def close(self):
+        self.end = time.perf_counter()
+        for sink in self.sinks:
+            sink.close()
+
+    def getvalue(self):
+        return self.buffer.getvalue()
+
+    def stats(self):
+        """
+        計測結果を辞書で返す
+        トークン数は出力テキストからの見積もり値
+        """
+        end = self.end or time.perf_counter()
+        tokens = estimate_text_tokens(self.getvalue())
+        ttft = (self.first_chunk_at - self.start) if self.first_chunk_at is not None else None
+        generation_time = (end - self.first_chunk_at) if self.first_chunk_at is not None else 0.0
+        return {
+            "ttft": ttft,
+            "total_time": end - self.start,
+            "chunks": self.chunk_count,
+            "tokens": tokens,
+            "tokens_per_sec": tokens / generation_time if generation_time > 0 else None,
+        }
+
+
+def format_stats(stats):
+    """
+    計測結果を表示用の文字列に整形する関数
+    """
+    ttft = f"{stats['ttft']:.2f}s" if stats["ttft"] is not None else "-"
+    tps = f"{stats['tokens_per_sec']:.1f}" if stats["tokens_per_sec"] is not None else "-"
+    return (f"TTFT: {ttft} / 合計: {stats['total_time']:.2f}s / "
+            f"チャンク数: {stats['chunks']} / 約{stats['tokens']}トークン / {tps} tokens/s")
+
+
+def stream_to_sinks(stream, sinks=()):
+    """
+    chain.streamなどのイテレータをsinksへ逐次書き込む関数
+    最終的な出力は、(出力全体の文字列, 計測結果の辞書)
+    """
+    collector = StreamCollector(sinks)
+    try:
+        for chunk in stream:
+            collector.add(chunk)
+    finally:
+        collector.close()
+    return collector.getvalue(), collector.stats()
+
+
+async def astream_to_sinks(stream, sinks=()):
+    """
+    chain.astreamなどの非同期イテレータをsinksへ逐次書き込む関数
+    最終的な出力は、(出力全体の文字列, 計測結果の辞書)
+    """
+    collector = StreamCollector(sinks)
+    try:
+        async for chunk in stream:
+            collector.add(chunk)
+    finally:
+        collector.close()
+    return collector.getvalue(), collector.stats()
@@ -0,0 +1,180 @@
+import asyncio
+from collections import defaultdict
+
+
+class TenantLimitExceeded(Exception):
+    """
+    テナントの同時実行数と待ち行列の上限を超えた場合のエラー
+    """
+
+
+class TenantLimiter:
+    """
+    テナントごとに同時実行数を制限するクラス
+    max_concurrencyを超えたリクエストは最大max_queue件まで待ち、それを超えた場合はTenantLimitExceededを送出する
+    テナントはクライアントが指定するため、実行中・待機中のリクエストがなくなったテナントの情報は削除する
+    """
+
+    def __init__(self, max_concurrency=4, max_queue=16):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.semaphores = defaultdict(lambda: asyncio.Semaphore(self.max_concurrency))
+        self.waiting = defaultdict(int)
+        self.running = defaultdict(int)
+
+    def slot(self, tenant):
+        return _TenantSlot(self, tenant)
+
+    def is_full(self, tenant):
+        """
+        テナントの同時実行数と待ち行列が上限に達しているか判定する関数
+        """
+        semaphore = self.semaphores.get(tenant)
+        return semaphore is not None and semaphore.locked() and self.waiting.get(tenant, 0) >= self.max_queue
+
+    def _release_tenant(self, tenant):
+        if self.running.get(tenant, 0) == 0 and self.waiting.get(tenant, 0) == 0:
+            self.semaphores.pop(tenant, None)
+            self.running.pop(tenant, None)
+            self.waiting.pop(tenant, None)
+
+    def stats(self):
+        return {
+            tenant: {"running": self.running[tenant], "waiting": self.waiting[tenant]}
+            for tenant in set(self.running) | set(self.waiting)
+        }
+
+
+class _TenantSlot:
+    """
+    `async with limiter.slot(tenant):` で利用するコンテキストマネージャ
+    """
+
+    def __init__(self, limiter, tenant):
+        self.limiter = limiter
+        self.tenant = tenant
+
+    async def __aenter__(self):
+        limiter = self.limiter
+        if limiter.is_full(self.tenant):
+            raise TenantLimitExceeded(f"テナント{self.tenant}の同時実行数の上限を超えました。")
+        semaphore = limiter.semaphores[self.tenant]
+        limiter.waiting[self.tenant] += 1
+        try:
+            await semaphore.acquire()
+        except BaseException:
+            limiter.waiting[self.tenant] -= 1
+            limiter._release_tenant(self.tenant)
+            raise
+        limiter.waiting[self.tenant] -= 1
+        limiter.running[self.tenant] += 1
+        return self
+
+    async def __aexit__(self, *exc):
+        self.limiter.running[self.tenant] -= 1
+        self.limiter.semaphores[self.tenant].release()
+        self.limiter._release_tenant(self.tenant)
+
+
+class MicroBatcher:
+    """
+    短い時間内に届いた互換性のあるリクエストをまとめて処理するクラス
+    同じキー（同じチェーン・同じ設定）のリクエストをmax_wait秒またはmax_batch_size件まで集め、
+    runnable.abatchで一括実行する
+    dedupe_keyを指定した場合、dedupe_key(inputs)が同じリクエストは1回だけ実行し、結果を共有する
+    （画像生成のように同じ入力でも異なる結果が欲しい場合は指定しない）
+    """
+
+    def __init__(self, max_batch_size=8, max_wait=0.02, max_concurrency=8, dedupe_key=None):
+        self.dedupe_key = dedupe_key
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_concurrency = max_concurrency
+        self.queues = {}
+        self.workers = {}
+        self.running_batches = set()
+        self.batch_count = 0
+        self.request_count = 0
+
+    async def submit(self, key, runnable, inputs):
+        """
+        リクエストを待ち行列に追加し、結果を待つ関数
+        keyは、一緒に実行できるリクエストを識別する文字列
+        """
+        if key not in self.queues:
+            self.queues[key] = asyncio.Queue()
+            self.workers[key] = asyncio.create_task(self._worker(key, runnable))
+        future = asyncio.get_running_loop().create_future()
+        await self.queues[key].put((inputs, future))
+        return await future
+
+    async def _worker(self, key, runnable):
+        queue = self.queues[key]
+        while True:
+            batch = [await queue.get()]
+            deadline = asyncio.get_running_loop().time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # 処理中に呼び出し元がキャンセルしたリクエストは除外する
+            batch = [(inputs, future) for inputs, future in batch if not future.cancelled()]
+            if batch:
+                # 実行中も次のリクエストを集められるように、バッチは別タスクで実行する
+                task = asyncio.create_task(self._run_batch(runnable, batch))
+                self.running_batches.add(task)
+                task.add_done_callback(self.running_batches.discard)
+
+    async def _run_batch(self, runnable, batch):
+        # 同じ入力をまとめ、1回だけ実行する
+        unique = {}
+        try:
+            for i, (inputs, future) in enumerate(batch):
+                key = self.dedupe_key(inputs) if self.dedupe_key is not None else i
+                unique.setdefault(key, (inputs, []))[1].append(future)
+        except Exception as e:
+            # キーを作成できない入力があった場合も、呼び出し元が待ち続けないようにバッチ全体をエラーにする
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batch_count += 1
+        self.request_count += len(batch)
+
+        groups = list(unique.values())
+        try:
+            results = await runnable.abatch(
+                [inputs for inputs, _ in groups],
+                config={"max_concurrency": self.max_concurrency},
+                return_exceptions=True,
+            )
+        except Exception as e:
+            results = [e] * len(groups)
+
+        for (_, futures), result in zip(groups, results):
+            for future in futures:
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    async def close(self):
+        tasks = list(self.workers.values()) + list(self.running_batches)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.workers.clear()
+        self.queues.clear()
+
+    def stats(self):
+        return {
+            "batches": self.batch_count,
+            "requests": self.request_count,
+            "mean_batch_size": (self.request_count / self.batch_count) if self.batch_count else 0.0,
+        }
@@ -0,0 +1,100 @@
+import asyncio
+import time
+import base64
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+# 1x1ピクセルの透明なPNG（モックの画像生成で返す画像）
+MOCK_PNG_BASE64 = base64.b64encode(bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082"
+)).decode("utf-8")
+
+
+def _last_text(messages):
+    """
+    最後のメッセージのテキスト部分を取り出す
+    """
+    content = messages[-1].content if messages else ""
+    if isinstance(content, str):
+        return content
+    return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+
+
+class MockChatModel(BaseChatModel):
+    """
+    ローカルでの動作確認・テスト用のチャットモデル
+    APIを呼び出さずに、入力の先頭を含む固定の回答を返す
+    latencyは最初のチャンクまでの待ち時間（秒）、chunk_delayはチャンク間の待ち時間（秒）
+    """
+
+    model_name: str = "mock-chat"
+    latency: float = 0.2
+    chunk_delay: float = 0.02
+    chunk_size: int = 8
+
+    @property
+    def _llm_type(self) -> str:
+        return "mock-chat"
+
+    def _answer(self, messages: List[BaseMessage]) -> str:
+        return f"[{self.model_name}] 「{_last_text(messages)[:40]}」への回答です。"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._answer(messages)))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._answer(messages)))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.latency)
+        answer = self._answer(messages)
+        for i in range(0, len(answer), self.chunk_size):
+            if i:
+                time.sleep(self.chunk_delay)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=answer[i:i + self.chunk_size]))
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Any = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.latency)
+        answer = self._answer(messages)
+        for i in range(0, len(answer), self.chunk_size):
+            if i:
+                await asyncio.sleep(self.chunk_delay)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=answer[i:i + self.chunk_size]))
+
+
+class MockImageModel(MockChatModel):
+    """
+    ローカルでの動作確認・テスト用の画像生成モデル
+    Geminiの画像生成と同じく、テキストと画像(data URL)のリストをcontentとして返す
+    """
+
+    model_name: str = "mock-image"
+
+    @property
+    def _llm_type(self) -> str:
+        return "mock-image"
+
+    def _content(self, messages):
+        return [
+            f"「{_last_text(messages)[:40]}」の画像を生成しました。",
+            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{MOCK_PNG_BASE64}"}},
+        ]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._content(messages)))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._content(messages)))])
@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import base64
+import asyncio
+import binascii
+import hashlib
+import contextlib
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from sse_starlette.sse import EventSourceResponse
+
+from batching import MicroBatcher, TenantLimiter, TenantLimitExceeded
+from service_chains import Backends, validate_and_extract_base64
+
+
+PDF_PROVIDERS = ("openai", "gemini")
+
+
+def pdf_dedupe_key(inputs):
+    """
+    PDF Q&Aで同じリクエストとみなすキー
+    PDFのbase64文字列は巨大なため、そのままではなくハッシュを利用する
+    """
+    pdf_hash = hashlib.sha256(inputs["pdf"].encode("ascii")).hexdigest()
+    return (inputs["provider"], inputs["user_input"], pdf_hash)
+
+
+def get_tenant(request):
+    """
+    リクエストのテナントIDを取得する。ヘッダがない場合は"default"とする
+    """
+    return request.headers.get("x-tenant-id", "default")
+
+
+async def read_json(request, required):
+    """
+    リクエストボディのJSONを読み込み、必須のキーが存在するか確認する関数
+    不正な場合は、エラーメッセージの文字列を返す
+    """
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        return None, "リクエストボディがJSONではありません。"
+    if not isinstance(body, dict):
+        return None, "リクエストボディはJSONオブジェクトにしてください。"
+    missing = [key for key in required if not body.get(key)]
+    if missing:
+        return None, f"必須の項目がありません: {missing}"
+    return body, None
+
+
+def is_base64(value):
+    """
+    base64の文字列として読み込めるか確認する関数（PDFの重複判定のハッシュや、モデルへの入力の前に確認する）
+    """
+    if not isinstance(value, str):
+        return False
+    try:
+        base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        return False
+    return True
+
+
+def read_count(body, max_count):
+    """
+    リクエストのn（生成する数）を読み込む関数
+    不正な場合は、(None, エラーメッセージ) を返す
+    """
+    n = body.get("n", 1)
+    if isinstance(n, bool) or not isinstance(n, int) or not 1 <= n <= max_count:
+        return None, f"nは1〜{max_count}の整数で指定してください。"
+    return n, None
+
+
+def error_response(message, status_code):
+    return JSONResponse({"error": message}, status_code=status_code)
+
+
+def image_response(responses):
+    """
+    画像生成モデルの出力を、テキストとbase64画像のリストに整形する
+    """
+    results = []
+    for response in responses:
+        if isinstance(response, Exception):
+            results.append({"error": str(response)})
+            continue
+        try:
+            contents = validate_and_extract_base64(response)
+        except ValueError as e:
+            results.append({"error": str(e)})
+            continue
+        results.append({
+            "text": "".join(c["str"] for c in contents if "str" in c),
+            "images": [c["base64"] for c in contents if "base64" in c],
+        })
+    return results
+
+
+async def pdf_ask(request: Request):
+    """
+    POST /pdf/ask
+    {"question": "...", "pdf_base64": "...", "provider": "gemini", "filename": "a.pdf", "stream": false}
+    stream=trueの場合はSSEで回答をチャンクごとに返す
+    """
+    state = request.app.state
+    body, error = await read_json(request, ["question", "pdf_base64"])
+    if error:
+        return error_response(error, 400)
+    provider = body.get("provider", "gemini")
+    if provider not in PDF_PROVIDERS:
+        return error_response(f"未対応のproviderです: {provider}", 400)
+    if not is_base64(body["pdf_base64"]):
+        return error_response("pdf_base64がbase64の文字列ではありません。", 400)
+
+    inputs = {
+        "user_input": body["question"],
+        "pdf": body["pdf_base64"],
+        "filename": body.get("filename"),
+        "provider": provider,
+    }
+    chain = state.backends.pdf_chains[provider]
+    tenant = get_tenant(request)
+
+    if not body.get("stream"):
+        try:
+            async with state.limiter.slot(tenant):
+                answer = await state.pdf_batcher.submit(f"pdf:{provider}", chain, inputs)
+        except TenantLimitExceeded as e:
+            return error_response(str(e), 429)
+        except Exception as e:
+            return error_response(repr(e), 502)
+        return JSONResponse({"provider": provider, "answer": answer})
+
+    if state.limiter.is_full(tenant):
+        return error_response(f"テナント{tenant}の同時実行数の上限を超えました。", 429)
+
+    async def events():
+        # スロットはジェネレータの中で確保する（ストリームを開始する前にクライアントが切断した場合は確保しない）
+        start = time.perf_counter()
+        first = None
+        try:
+            async with state.limiter.slot(tenant):
+                async for chunk in chain.astream(inputs):
+                    if first is None:
+                        first = time.perf_counter() - start
+                    yield {"event": "chunk", "data": json.dumps({"text": chunk}, ensure_ascii=False)}
+            yield {"event": "end", "data": json.dumps({"ttft": first, "total_time": time.perf_counter() - start})}
+        except Exception as e:
+            yield {"event": "error", "data": json.dumps({"error": repr(e)}, ensure_ascii=False)}
+
+    return EventSourceResponse(events())
+
+
+async def _run_image(request, chain, key, inputs, n):
+    state = request.app.state
+    try:
+        async with state.limiter.slot(get_tenant(request)):
+            responses = await asyncio.gather(
+                *(state.image_batcher.submit(key, chain, inputs) for _ in range(n)),
+                return_exceptions=True,
+            )
+    except TenantLimitExceeded as e:
+        return error_response(str(e), 429)
+    return JSONResponse({"results": image_response(responses)})
+
+
+async def image_generate(request: Request):
+    """
+    POST /image/generate
+    {"prompt": "...", "n": 1}
+    """
+    body, error = await read_json(request, ["prompt"])
+    if error:
+        return error_response(error, 400)
+    n, error = read_count(body, request.app.state.max_images)
+    if error:
+        return error_response(error, 400)
+    chain = request.app.state.backends.image_generation_chain
+    return await _run_image(request, chain, "image:generate", {"user_input": body["prompt"]}, n)
+
+
+async def image_edit(request: Request):
+    """
+    POST /image/edit
+    {"prompt": "...", "image_base64": "...", "mime_type": "image/png", "n": 1}
+    """
+    body, error = await read_json(request, ["prompt", "image_base64"])
+    if error:
+        return error_response(error, 400)
+    n, error = read_count(body, request.app.state.max_images)
+    if error:
+        return error_response(error, 400)
+    inputs = {"user_input": body["prompt"], "image": body["image_base64"], "mime_type": body.get("mime_type")}
+    chain = request.app.state.backends.image_editing_chain
+    return await _run_image(request, chain, "image:edit", inputs, n)
+
+
+async def health(request: Request):
+    return JSONResponse({"status": "ok", "mock": request.app.state.backends.mock})
+
+
+async def metrics(request: Request):
+    state = request.app.state
+    return JSONResponse({
+        "pdf_batcher": state.pdf_batcher.stats(),
+        "image_batcher": state.image_batcher.stats(),
+        "tenants": state.limiter.stats(),
+    })
+
+
+def create_app(mock=None, tenant_max_concurrency=4, tenant_max_queue=16,
+               max_batch_size=8, max_wait=0.02, max_images=4):
+    """
+    ASGIアプリを作成する関数
+    mockがNoneの場合は、環境変数SERVICE_MOCKが"1"のときにモックモデルを利用する
+    """
+    if mock is None:
+        mock = os.getenv("SERVICE_MOCK") == "1"
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        # 起動時に1回だけモデル・クライアントを作成し、以降のリクエストで使い回す
+        app.state.backends = Backends(mock=mock)
+        app.state.limiter = TenantLimiter(tenant_max_concurrency, tenant_max_queue)
+        app.state.pdf_batcher = MicroBatcher(max_batch_size, max_wait, dedupe_key=pdf_dedupe_key)
+        app.state.image_batcher = MicroBatcher(max_batch_size, max_wait)
+        app.state.max_images = max_images
+        try:
+            yield
+        finally:
+            await app.state.pdf_batcher.close()
+            await app.state.image_batcher.close()
+
+    routes = [
+        Route("/pdf/ask", pdf_ask, methods=["POST"]),
+        Route("/image/generate", image_generate, methods=["POST"]),
+        Route("/image/edit", image_edit, methods=["POST"]),
+        Route("/health", health, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+    ]
+    return Starlette(routes=routes, lifespan=lifespan)
+
+
+def main():
+    import uvicorn
+
+    # ========== 設定 ==========
+    host = "127.0.0.1"
+    port = 8000
+    # =========================
+
+    uvicorn.run(create_app(), host=host, port=port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import os
+from dotenv import load_dotenv, find_dotenv
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
+
+from mock_providers import MockChatModel, MockImageModel
+
+_ = load_dotenv(find_dotenv())
+
+
+PDF_SYSTEM_PROMPT = "あなたは日本語を話す優秀なアシスタントです。回答には必ず日本語で答えてください。また考える過程も出力してください。"
+
+IMAGE_GENERATION_PROMPT = """
+# 目的
+あなたのタスクは画像生成です。ユーザが指定した内容で新しい画像を生成してください。
+
+----以下がユーザの入力です----
+"""
+
+IMAGE_EDITING_PROMPT = """
+# 目的
+あなたのタスクは画像編集です。ユーザが入力した画像を元に、ユーザが指定した内容で新しい画像を生成してください。
+
+# ルール
+ユーザが指示した内容に関係のない物体は、元の画像と全く同一にしてください。
+ユーザが指示した内容だけをユーザの指示に忠実に編集して、画像を生成してください。
+
+----以下がユーザの入力です----
+"""
+
+
+def pdf_prompt_func(data):
+    """
+    PDF Q&A用のプロンプト
+    dataの"pdf"はbase64文字列。OpenAIの場合はdata URL形式に変換して入力する
+    """
+    if data["provider"] == "openai":
+        pdf_content = {
+            "type": "file",
+            "file": {
+                "filename": data.get("filename") or "input.pdf",
+                "file_data": f"data:application/pdf;base64,{data['pdf']}"
+            }
+        }
+    else:
+        pdf_content = {
+            'type': 'media',
+            'mime_type': "application/pdf",
+            'data': data["pdf"]
+        }
+
+    return [
+        SystemMessage(content=PDF_SYSTEM_PROMPT),
+        HumanMessage(content=[{"type": "text", "text": f"{data['user_input']}"}, pdf_content]),
+    ]
+
+
+def image_generation_prompt_func(data):
+    """
+    画像生成用のプロンプト
+    gemini-2.0-flash-exp-image-generationではsystem_messageを利用できないので、HumanMessageを利用する
+    """
+    return [
+        HumanMessage(content=IMAGE_GENERATION_PROMPT),
+        HumanMessage(content=[{"type": "text", "text": f"{data['user_input']}"}]),
+    ]
+
+
+def image_editing_prompt_func(data):
+    """
+    画像編集用のプロンプト
+    """
+    return [
+        HumanMessage(content=IMAGE_EDITING_PROMPT),
+        HumanMessage(content=[
+            {"type": "text", "text": f"{data['user_input']}"},
+            {"image_url": {"url": f"data:{data.get('mime_type') or 'image/png'};base64,{data['image']}"}},
+        ]),
+    ]
+
+
+def validate_and_extract_base64(response):
+    """
+    LLMの生の出力結果responseを受け取り、base64文字列や生成されたテキストを抽出して辞書のリストを返す関数
+    最終的な出力は、LLM出力がテキストの場合は`str`キーをもち、画像の場合は`base64`キーを持つ辞書のリスト
+    # 例: [{"str": "出力テキスト"}, {"base64": "base64文字列"}]
+    """
+    if not hasattr(response, 'content'):
+        raise ValueError("responseにcontent属性が存在しません。")
+
+    content = response.content
+    if not isinstance(content, list) or len(content) == 0:
+        raise ValueError("response.contentが空、またはリスト型ではありません。")
+
+    extracted_list = []
+    for idx, item in enumerate(content):
+        if isinstance(item, str):
+            extracted_list.append({"str": item})
+        elif isinstance(item, dict):
+            image_url = item.get('image_url')
+            if not isinstance(image_url, dict):
+                raise ValueError(f"content[{idx}] の image_urlが辞書型ではありません。（型: {type(image_url)}）")
+            url = image_url.get('url')
+            if not isinstance(url, str) or ',' not in url:
+                raise ValueError(f"content[{idx}] のurlが不正です。")
+            extracted_list.append({"base64": url.split(',')[-1]})
+        else:
+            raise ValueError(f"content[{idx}] は想定外の型です。（型: {type(item)}）")
+
+    return extracted_list
+
+
+class Backends:
+    """
+    サービスで利用するチェーンをまとめて保持するクラス
+    サーバ起動時に1回だけ作成し、リクエストごとにモデルやクライアントを作り直さないようにする
+    mock=Trueの場合は、APIを呼び出さないローカルのモックモデルを利用する
+    """
+
+    def __init__(self, mock=False):
+        self.mock = mock
+        self.pdf_chains = {
+            "openai": RunnableLambda(pdf_prompt_func) | self._load_pdf_model("openai") | StrOutputParser(),
+            "gemini": RunnableLambda(pdf_prompt_func) | self._load_pdf_model("gemini") | StrOutputParser(),
+        }
+        # 画像と一緒にテキストも出力させる
+        image_model = self._load_image_model().bind(
+            generation_config=dict(response_modalities=["TEXT", "IMAGE"])
+        )
+        self.image_generation_chain = RunnableLambda(image_generation_prompt_func) | image_model
+        self.image_editing_chain = RunnableLambda(image_editing_prompt_func) | image_model
+
+    def _load_pdf_model(self, provider):
+        if self.mock:
+            return MockChatModel(model_name=f"mock-{provider}")
+        if provider == "openai":
+            from langchain_openai import ChatOpenAI
+            return ChatOpenAI(
+                model="gpt-4o",
+                openai_api_key=os.getenv("OPENAI_APIKEY"),
+                temperature=0.001,
+                top_p=0.001
+            )
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        return ChatGoogleGenerativeAI(
+            model="gemini-2.0-flash-001",
+            google_api_key=os.getenv("GOOGLE_API_KEY"),
+            temperature=0.001,
+            top_p=0.001
+        )
+
+    def _load_image_model(self):
+        if self.mock:
+            return MockImageModel()
+        from langchain_google_genai import ChatGoogleGenerativeAI, Modality
+        return ChatGoogleGenerativeAI(
+            model="models/gemini-2.0-flash-exp-image-generation",
+            google_api_key=os.getenv("GOOGLE_API_KEY"),
+            response_modalities=[Modality.IMAGE, Modality.TEXT]
+        )
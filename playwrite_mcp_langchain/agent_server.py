@@ -0,0 +1,334 @@
+"""
+複数のユーザの会話を同時に処理するエージェントのサーバ
+1つのグラフと、MCPサーバ（Playwrightのブラウザを複数起動したもの）を全ての会話で共有する
+会話はX-User-IDヘッダとsession_idからthread_idを作成し、SQLiteに保存する
+
+AGENT_MOCK=1の場合は、スタブのMCPサーバとScriptedChatModelを利用する（APIキーやブラウザは不要）
+"""
+import os
+import json
+import time
+import asyncio
+import contextlib
+from collections import deque
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from sse_starlette.sse import EventSourceResponse
+
+from langchain_core.messages import HumanMessage
+from mcp_pool import MCPServerPool
+from parallel_tools import expand_replicas
+from sqlite_checkpointer import SQLiteDeltaSaver
+from agent_stream import astream_turn
+from tracing import TraceRecorder
+from prompt_cache import GeminiContextCacheBackend, LocalContextCacheBackend, PrefixCacheManager
+from planner_graph import url_planner
+from praywrite_mcp_langchain_tools import build_agent, google_api_key
+
+
+class SessionLimitExceeded(Exception):
+    """
+    同時に実行するターン数と待ち行列の上限を超えた場合のエラー
+    """
+
+
+class SessionLimiter:
+    """
+    サーバ全体で同時に実行するターン数を制限するクラス
+    max_concurrencyを超えたターンは最大max_queue件まで待ち、それを超えた場合はSessionLimitExceededを送出する
+    同じ会話（thread_id）のターンは、チェックポイントが競合しないように1件ずつ実行する
+    """
+
+    def __init__(self, max_concurrency=8, max_queue=32, latency_window=1000):
+        self.max_queue = max_queue
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.thread_locks = {}
+        self.thread_refs = {}
+        self.running = 0
+        self.waiting = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.queue_wait_seconds = 0.0
+        self.latencies = deque(maxlen=latency_window)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, thread_id):
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise SessionLimitExceeded("同時に処理できる会話の上限を超えました。しばらくしてから再度実行してください。")
+
+        start = time.perf_counter()
+        lock = self.thread_locks.setdefault(thread_id, asyncio.Lock())
+        self.thread_refs[thread_id] = self.thread_refs.get(thread_id, 0) + 1
+        self.waiting += 1
+        try:
+            await lock.acquire()
+            try:
+                await self.semaphore.acquire()
+            except BaseException:
+                lock.release()
+                raise
+        except BaseException:
+            self._release_thread(thread_id)
+            raise
+        finally:
+            self.waiting -= 1
+        self.queue_wait_seconds += time.perf_counter() - start
+        self.running += 1
+
+        started = time.perf_counter()
+        try:
+            yield
+            self.completed += 1
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.latencies.append(time.perf_counter() - started)
+            self.running -= 1
+            self.semaphore.release()
+            lock.release()
+            self._release_thread(thread_id)
+
+    def _release_thread(self, thread_id):
+        # 待っている他のターンがなければ、ロックを削除する（会話の数だけ増え続けないようにする）
+        self.thread_refs[thread_id] -= 1
+        if self.thread_refs[thread_id] == 0:
+            del self.thread_refs[thread_id]
+            del self.thread_locks[thread_id]
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        finished = self.completed + self.failed
+
+        def percentile(p):
+            return latencies[min(int(len(latencies) * p), len(latencies) - 1)] if latencies else 0.0
+
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "mean_queue_wait_seconds": self.queue_wait_seconds / finished if finished else 0.0,
+            "latency_p50_seconds": percentile(0.5),
+            "latency_p95_seconds": percentile(0.95),
+        }
+
+
+def get_thread_id(request, session_id):
+    """
+    X-User-IDヘッダとsession_idからthread_idを作成する。ヘッダがない場合は"anonymous"とする
+    """
+    user_id = request.headers.get("x-user-id", "anonymous")
+    return f"{user_id}:{session_id}"
+
+
+def error_response(message, status_code):
+    return JSONResponse({"error": message}, status_code=status_code)
+
+
+async def chat(request: Request):
+    """
+    POST /chat
+    {"message": "...", "session_id": "default", "stream": false, "mode": "react"}
+    stream=trueの場合はSSEで、モデルのトークン（token）とツールの進捗（tool_start, tool_end）を順に返す
+    mode="planner"の場合は、質問をサブタスクに分割して並列に実行するグラフ（planner_graph.py）で回答する
+    （会話の履歴は共通のため、同じsession_idでターンごとにmodeを切り替えられる）
+    """
+    state = request.app.state
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        return error_response("リクエストボディがJSONではありません。", 400)
+    if not isinstance(body, dict) or not body.get("message"):
+        return error_response("messageを指定してください。", 400)
+    mode = body.get("mode", "react")
+    if mode not in state.graphs:
+        return error_response(f"modeは{list(state.graphs)}のいずれかを指定してください。", 400)
+    graph = state.graphs[mode]
+
+    thread_id = get_thread_id(request, body.get("session_id", "default"))
+    config = {"configurable": {"thread_id": thread_id}}
+    if state.tracer is not None:
+        config["callbacks"] = [state.tracer]
+    inputs = {"messages": [HumanMessage([{"type": "text", "text": body["message"]}])]}
+
+    if body.get("stream"):
+        if state.limiter.waiting >= state.limiter.max_queue:
+            return error_response("同時に処理できる会話の上限を超えました。しばらくしてから再度実行してください。", 429)
+        return EventSourceResponse(chat_events(state, graph, thread_id, inputs, config))
+
+    start = time.perf_counter()
+    try:
+        async with state.limiter.slot(thread_id):
+            # ブラウザはターンの間だけこの会話に貸し出し、他の会話がページを操作しないようにする
+            async with state.tool_executor.lease(thread_id):
+                response = await graph.ainvoke(inputs, config)
+    except SessionLimitExceeded as e:
+        return error_response(str(e), 429)
+    except Exception as e:
+        return error_response(repr(e), 502)
+
+    if state.time_to_first_answer is None:
+        state.time_to_first_answer = time.perf_counter() - state.boot_start
+
+    return JSONResponse({
+        "thread_id": thread_id,
+        "answer": response["messages"][-1].content,
+        "elapsed": time.perf_counter() - start,
+    })
+
+
+async def chat_events(state, graph, thread_id, inputs, config):
+    """
+    /chatのSSEのイベントを作成する非同期ジェネレータ
+    """
+    try:
+        async with state.limiter.slot(thread_id):
+            async with state.tool_executor.lease(thread_id):
+                async for event in astream_turn(graph, inputs, config):
+                    if event["type"] == "final":
+                        if state.time_to_first_answer is None:
+                            state.time_to_first_answer = time.perf_counter() - state.boot_start
+                        message = event.pop("message")
+                        event["answer"] = message.content if message is not None else None
+                        event["thread_id"] = thread_id
+                    yield {"event": event.pop("type"), "data": json.dumps(event, ensure_ascii=False, default=str)}
+    except SessionLimitExceeded as e:
+        yield {"event": "error", "data": json.dumps({"error": str(e)}, ensure_ascii=False)}
+    except Exception as e:
+        yield {"event": "error", "data": json.dumps({"error": repr(e)}, ensure_ascii=False)}
+
+
+async def delete_session(request: Request):
+    """
+    DELETE /sessions/{session_id}
+    """
+    thread_id = get_thread_id(request, request.path_params["session_id"])
+    await asyncio.to_thread(request.app.state.checkpointer.delete_thread, thread_id)
+    return JSONResponse({"deleted": thread_id})
+
+
+async def health(request: Request):
+    servers = request.app.state.mcp_pool.stats()["servers"]
+    status = "ok" if all(s["status"] == "ready" for s in servers.values()) else "degraded"
+    return JSONResponse({"status": status, "mock": request.app.state.mock, "mcp_servers": servers})
+
+
+async def metrics(request: Request):
+    state = request.app.state
+    return JSONResponse({
+        "sessions": state.limiter.stats(),
+        "tools": state.tool_executor.lease_stats(),
+        "checkpointer": state.checkpointer.stats,
+        "mcp_servers": state.mcp_pool.stats(),
+        "stop_reasons": dict(state.turn_budget.stop_reasons),
+        "tool_router": state.tool_router.summary(),
+        "prompt_cache": state.prompt_cache.summary(),
+        "page_extractor": state.page_extractor.summary(),
+        "time_to_first_answer_seconds": state.time_to_first_answer,
+        "exported_spans": state.tracer.exported if state.tracer is not None else None,
+    })
+
+
+def mock_setup():
+    """
+    AGENT_MOCK=1の場合のモデルとMCPサーバの設定を作成する
+    """
+    from fake_llm import ScriptedChatModel
+    from stub_mcp_server import server_config
+
+    model = ScriptedChatModel(latency=0.05)
+    return model, {"playwright": server_config("playwright", latency=0.2, payload_chars=4000)}
+
+
+def create_app(mock=None, mcp_config_path="mcp_config.json", browser_replicas=3,
+               max_concurrency=8, max_queue=32, checkpoint_path="checkpoints/agent.sqlite",
+               trace_path="traces/agent_trace.jsonl"):
+    """
+    ASGIアプリを作成する関数
+    mockがNoneの場合は、環境変数AGENT_MOCKが"1"のときにモックを利用する
+    browser_replicasは、起動するPlaywright MCPの数（＝同時にブラウザを操作できる会話の数）
+    trace_pathは、ターンごとの処理時間のトレースを記録するファイル（Noneの場合は記録しない）
+    """
+    if mock is None:
+        mock = os.getenv("AGENT_MOCK") == "1"
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        app.state.boot_start = time.perf_counter()
+        app.state.time_to_first_answer = None
+        if mock:
+            model, mcp_servers = mock_setup()
+            # APIを呼び出さずにキャッシュの作成・延長を再現する
+            prompt_cache = PrefixCacheManager(LocalContextCacheBackend())
+            # ScriptedChatModelは計画のJSONを出力しないため、質問のURLごとにサブタスクを作成する
+            planner = url_planner
+        else:
+            from langchain_google_genai import ChatGoogleGenerativeAI
+
+            model = ChatGoogleGenerativeAI(
+                model="gemini-2.0-flash",
+                google_api_key=google_api_key,
+                temperature=0.001,
+            )
+            with open(mcp_config_path, "r") as f:
+                mcp_servers = json.load(f)["mcpServers"]
+            prompt_cache = PrefixCacheManager(GeminiContextCacheBackend(google_api_key, model.model))
+            planner = None
+        mcp_servers, replica_groups = expand_replicas(mcp_servers, {"playwright": browser_replicas})
+
+        checkpointer = SQLiteDeltaSaver(checkpoint_path)
+        await asyncio.to_thread(checkpointer.gc, max_age_seconds=30 * 24 * 3600, keep_last=50)
+
+        # 起動時に1回だけMCPサーバを起動し、以降の全ての会話で共有する（停止したサーバは自動で再起動する）
+        async with MCPServerPool(mcp_servers) as mcp_pool:
+            agent = build_agent(model, mcp_pool, replica_groups, checkpointer, prompt_cache, planner)
+            app.state.mock = mock
+            app.state.mcp_pool = mcp_pool
+            # リクエストのmodeごとのグラフ（checkpointerは共通）
+            app.state.graphs = {"react": agent["graph"], "planner": agent["planner_graph"]}
+            app.state.tool_executor = agent["tool_executor"]
+            app.state.turn_budget = agent["turn_budget"]
+            app.state.tool_router = agent["tool_router"]
+            app.state.prompt_cache = prompt_cache
+            app.state.page_extractor = agent["page_extractor"]
+            app.state.checkpointer = checkpointer
+            app.state.limiter = SessionLimiter(max_concurrency, max_queue)
+            app.state.tracer = TraceRecorder(trace_path) if trace_path else None
+            try:
+                yield
+            finally:
+                await prompt_cache.close()
+                await agent["page_extractor"].close()
+                if app.state.tracer is not None:
+                    app.state.tracer.flush()
+                checkpointer.close()
+
+    routes = [
+        Route("/chat", chat, methods=["POST"]),
+        Route("/sessions/{session_id}", delete_session, methods=["DELETE"]),
+        Route("/health", health, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+    ]
+    return Starlette(routes=routes, lifespan=lifespan)
+
+
+def main():
+    import uvicorn
+
+    # ========== 設定 ==========
+    host = "127.0.0.1"
+    port = 8001
+    # =========================
+
+    uvicorn.run(create_app(), host=host, port=port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import time
+
+from langchain_core.messages import AIMessage, ToolMessage
+
+
+def _text(content):
+    """
+    メッセージのcontent（文字列もしくはcontent blockのリスト）からテキストだけを取り出す
+    """
+    if isinstance(content, str):
+        return content
+    return "".join(
+        part if isinstance(part, str) else part.get("text", "")
+        for part in content
+        if isinstance(part, str) or (isinstance(part, dict) and part.get("type") == "text")
+    )
+
+
+async def astream_turn(graph, inputs, config):
+    """
+    グラフを1ターン実行し、モデルのトークンとツールの進捗をイベントとして順に返す非同期ジェネレータ
+    stream_mode="messages"でagentノードのトークンを、stream_mode="updates"でツールの開始・終了を取得する
+    イベント:
+        {"type": "token", "text": ...}                        モデルの出力（トークンごと）
+        {"type": "tool_start", "name": ..., "args": ...}      ツールの呼び出し開始
+        {"type": "tool_end", "name": ..., "chars": ..., "status": ..., "seconds": ...}
+        {"type": "final", "message": AIMessage, "ttft": ..., "total_time": ...}
+    ttftは、最初のトークン（もしくはツールの開始）までの秒数
+    """
+    start = time.perf_counter()
+    first = None
+    final = None
+    tool_started = None
+
+    async for mode, chunk in graph.astream(inputs, config, stream_mode=["messages", "updates"]):
+        if mode == "messages":
+            message, metadata = chunk
+            if metadata.get("langgraph_node") != "agent" or isinstance(message, ToolMessage):
+                continue
+            text = _text(message.content)
+            if text:
+                if first is None:
+                    first = time.perf_counter() - start
+                yield {"type": "token", "text": text}
+            continue
+
+        for node, update in chunk.items():
+            for message in (update or {}).get("messages", []):
+                if node == "agent" and isinstance(message, AIMessage):
+                    if message.tool_calls:
+                        if first is None:
+                            first = time.perf_counter() - start
+                        tool_started = time.perf_counter()
+                        for tool_call in message.tool_calls:
+                            yield {"type": "tool_start", "name": tool_call["name"], "args": tool_call["args"]}
+                    else:
+                        final = message
+                elif node == "tools" and isinstance(message, ToolMessage):
+                    yield {
+                        "type": "tool_end",
+                        "name": message.name,
+                        "chars": len(_text(message.content)),
+                        "status": message.status,
+                        "seconds": time.perf_counter() - tool_started if tool_started else None,
+                    }
+
+    yield {"type": "final", "message": final, "ttft": first, "total_time": time.perf_counter() - start}
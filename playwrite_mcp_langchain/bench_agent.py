@@ -0,0 +1,245 @@
+"""
+エージェントのグラフ（create_graph）全体のベンチマーク
+ScriptedChatModel（決まった手順でツールを呼び出すモデル）と、スタブのMCPサーバ（stub_mcp_server.py）を利用するため、
+APIキーやブラウザは不要で、毎回同じ処理になる
+
+以下の3つの実行方法で同じターンを実行し、1ターンあたりの時間と、1ステップ（ノードの実行）あたりのオーバーヘッドを比較する
+    direct:        LangGraphを使わずに、call_modelとcall_toolsと同じ処理をループで実行する（基準）
+    graph_memory:  create_graph + MemorySaver（LangGraphのオーバーヘッド）
+    graph_sqlite:  create_graph + SQLiteDeltaSaver（チェックポイントの保存のオーバーヘッド）
+最後に、graph_sqliteで複数の会話を同時に実行したときのturns/secと、ターン数に対するメモリの増え方を測定する
+"""
+import os
+import gc
+import time
+import asyncio
+import resource
+import tempfile
+import tracemalloc
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langgraph.checkpoint.memory import MemorySaver
+
+from fake_llm import ScriptedChatModel
+from history_manager import HistoryManager
+from mcp_pool import MCPServerPool
+from parallel_tools import ParallelToolExecutor, expand_replicas
+from praywrite_mcp_langchain_tools import GraphState, SYSTEM_PROMPT, create_graph
+from sqlite_checkpointer import SQLiteDeltaSaver
+from stub_mcp_server import server_config
+from tool_output_processor import ToolOutputProcessor
+from turn_budget import TurnBudget
+
+
+def make_components(model, mcp_pool, replica_groups):
+    """
+    build_agentと同じ構成で、グラフの部品（モデルのチェーン・履歴の管理・ツールの実行・上限の管理）を作成する関数
+    ツールの結果のキャッシュは、毎回ツールを実行した時間を測定するために利用しない
+    """
+    prompt = ChatPromptTemplate.from_messages([SystemMessage(content=SYSTEM_PROMPT), MessagesPlaceholder("messages")])
+    tool_output_processor = ToolOutputProcessor(max_chars=8000)
+    tool_executor = ParallelToolExecutor(
+        mcp_pool.server_name_to_tools,
+        replica_groups=replica_groups,
+        max_concurrency={"playwright": 1},
+        extra_tools=[tool_output_processor.fetch_tool],
+    )
+    return {
+        "model_chain": prompt | model.bind_tools(tool_executor.tools),
+        "history_manager": HistoryManager(max_tokens=30000, policy="elide_tools", keep_last_tool_messages=2),
+        "tool_output_processor": tool_output_processor,
+        "tool_executor": tool_executor,
+        "turn_budget": TurnBudget(max_steps=10, max_seconds=180, max_tokens=10_000_000),
+    }
+
+
+def make_graph(components, checkpointer):
+    return create_graph(
+        GraphState,
+        components["tool_executor"].tools,
+        components["model_chain"],
+        history_manager=components["history_manager"],
+        tool_output_processor=components["tool_output_processor"],
+        tool_executor=components["tool_executor"],
+        checkpointer=checkpointer,
+        turn_budget=components["turn_budget"],
+    )
+
+
+def make_direct_runner(components):
+    """
+    LangGraphを使わずに、グラフと同じ処理（履歴の整理 → モデル → ツール → 出力の加工 → ...）を実行する関数を作成する
+    会話の履歴はプロセス内の辞書に保存する
+    """
+    histories = {}
+
+    async def run_turn(thread_id, message):
+        messages = histories.setdefault(thread_id, [])
+        messages.append(message)
+        steps = 0
+        while True:
+            response = await components["model_chain"].ainvoke(components["history_manager"](messages))
+            messages.append(response)
+            steps += 1
+            if not response.tool_calls:
+                return steps
+            config = {"configurable": {"thread_id": thread_id}}
+            result = await components["tool_executor"].ainvoke({"messages": messages}, config)
+            messages.extend(components["tool_output_processor"](result["messages"], thread_id))
+            steps += 1
+
+    return run_turn
+
+
+def make_graph_runner(graph):
+    async def run_turn(thread_id, message):
+        response = await graph.ainvoke({"messages": [message]}, {"configurable": {"thread_id": thread_id}})
+        messages = response["messages"]
+        # このターンで追加されたAIMessage（agentノード）とその間のtoolsノードの実行の数をステップ数とする
+        turn_start = max(i for i, m in enumerate(messages) if isinstance(m, HumanMessage))
+        return sum(1 for m in messages[turn_start:] if isinstance(m, AIMessage)) * 2 - 1
+
+    return run_turn
+
+
+def make_message(turn, urls_per_turn):
+    urls = " ".join(f"https://example.com/t{turn}/p{i}" for i in range(urls_per_turn))
+    return HumanMessage([{"type": "text", "text": f"次のページを要約してください: {urls}"}])
+
+
+async def run_sequential(run_turn, turns, threads, urls_per_turn, warmup=5):
+    """
+    会話をthreads件に分けてturns回のターンを1件ずつ実行し、ターンごとの時間とステップ数を返す関数
+    """
+    for i in range(warmup):
+        await run_turn(f"warmup-{i}", make_message(-i - 1, urls_per_turn))
+    latencies = []
+    steps = 0
+    start = time.perf_counter()
+    for turn in range(turns):
+        turn_start = time.perf_counter()
+        steps += await run_turn(f"thread-{turn % threads}", make_message(turn, urls_per_turn))
+        latencies.append(time.perf_counter() - turn_start)
+    return {"elapsed": time.perf_counter() - start, "latencies": latencies, "steps": steps}
+
+
+async def run_concurrent(run_turn, turns, threads, urls_per_turn):
+    """
+    threads件の会話を同時に実行し（それぞれの会話の中では1ターンずつ）、turns回のターンにかかった時間を返す関数
+    """
+    async def worker(index):
+        for turn in range(index, turns, threads):
+            await run_turn(f"concurrent-{index}", make_message(turn, urls_per_turn))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(threads)))
+    return time.perf_counter() - start
+
+
+async def run_memory(run_turn, turns, threads, urls_per_turn, sample_every):
+    """
+    tracemallocでターン数に対するメモリ（Pythonのオブジェクト）の増え方を測定する関数
+    最終的な出力は、[(ターン数, 確保しているメモリのバイト数)] のリスト
+    """
+    gc.collect()
+    tracemalloc.start()
+    samples = [(0, tracemalloc.get_traced_memory()[0])]
+    try:
+        for turn in range(turns):
+            await run_turn(f"memory-{turn % threads}", make_message(turn, urls_per_turn))
+            if (turn + 1) % sample_every == 0:
+                gc.collect()
+                samples.append((turn + 1, tracemalloc.get_traced_memory()[0]))
+    finally:
+        tracemalloc.stop()
+    return samples
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+async def main():
+    # ========== 設定 ==========
+    # 測定するターン数（メモリの測定も同じターン数で行う）
+    turns = 120
+    # ターンを分ける会話の数（会話ごとに履歴とチェックポイントが増える）
+    threads = 4
+    # 1ターンで取得するページ数と、ツールを呼び出す回数（モデルの呼び出し回数はtool_rounds + 1）
+    urls_per_turn = 2
+    tool_rounds = 2
+    # モデルとツールの応答時間（秒）。0にするとエージェント自体のオーバーヘッドだけを測定できる
+    model_latency = 0.0
+    tool_latency = 0.0
+    # ツールの出力の文字数
+    payload_chars = 4000
+    # 起動するスタブのPlaywright MCPの数と、メモリを記録する間隔（ターン数）
+    replicas = 2
+    memory_sample_every = 20
+    # =========================
+
+    model = ScriptedChatModel(latency=model_latency, tool_rounds=tool_rounds)
+    mcp_servers, replica_groups = expand_replicas(
+        {"playwright": server_config("playwright", tool_latency, payload_chars)}, {"playwright": replicas})
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        async with MCPServerPool(mcp_servers, cache_dir=None) as mcp_pool:
+            await mcp_pool.wait_ready()
+
+            run_turn = make_direct_runner(make_components(model, mcp_pool, replica_groups))
+            results["direct"] = await run_sequential(run_turn, turns, threads, urls_per_turn)
+
+            graph = make_graph(make_components(model, mcp_pool, replica_groups), MemorySaver())
+            results["graph_memory"] = await run_sequential(make_graph_runner(graph), turns, threads, urls_per_turn)
+
+            checkpointer = SQLiteDeltaSaver(os.path.join(tmp, "bench.sqlite"))
+            graph = make_graph(make_components(model, mcp_pool, replica_groups), checkpointer)
+            run_turn = make_graph_runner(graph)
+            results["graph_sqlite"] = await run_sequential(run_turn, turns, threads, urls_per_turn)
+
+            concurrent_elapsed = await run_concurrent(run_turn, turns, threads, urls_per_turn)
+
+            sqlite_bytes = os.path.getsize(os.path.join(tmp, "bench.sqlite"))
+            checkpointer_stats = dict(checkpointer.stats)
+            checkpointer.close()
+
+            memory = {}
+            graph = make_graph(make_components(model, mcp_pool, replica_groups), MemorySaver())
+            memory["graph_memory"] = await run_memory(
+                make_graph_runner(graph), turns, threads, urls_per_turn, memory_sample_every)
+            saver = SQLiteDeltaSaver(os.path.join(tmp, "memory.sqlite"))
+            graph = make_graph(make_components(model, mcp_pool, replica_groups), saver)
+            memory["graph_sqlite"] = await run_memory(
+                make_graph_runner(graph), turns, threads, urls_per_turn, memory_sample_every)
+            saver.close()
+
+    print(f"ターン数: {turns}（会話{threads}件）, 1ターンのモデル呼び出し: {tool_rounds + 1}回, "
+          f"ツール呼び出し: {tool_rounds}回 x {urls_per_turn}ページ, "
+          f"モデルの応答時間: {model_latency}秒, ツールの応答時間: {tool_latency}秒, 出力: {payload_chars}文字")
+    print()
+    base = results["direct"]
+    base_per_step = base["elapsed"] / base["steps"]
+    print(f"{'':>14} {'turns/sec':>10} {'平均(ms)':>10} {'p95(ms)':>10} {'ステップ(ms)':>12} {'directとの差(ms/ステップ)':>24}")
+    for name, result in results.items():
+        mean = result["elapsed"] / turns
+        per_step = result["elapsed"] / result["steps"]
+        print(f"{name:>14} {turns / result['elapsed']:>10.1f} {mean * 1000:>10.2f} "
+              f"{percentile(result['latencies'], 0.95) * 1000:>10.2f} {per_step * 1000:>12.3f} "
+              f"{(per_step - base_per_step) * 1000:>24.3f}")
+    print()
+    print(f"graph_sqliteで会話{threads}件を同時に実行: {turns / concurrent_elapsed:.1f} turns/sec")
+    print(f"SQLiteのファイルサイズ: {sqlite_bytes / 1024:.0f}KB, チェックポイントの書き込み: {checkpointer_stats}")
+    print()
+    print("メモリ（tracemallocで測定したPythonのオブジェクト）:")
+    for name, samples in memory.items():
+        growth = (samples[-1][1] - samples[0][1]) / turns
+        points = ", ".join(f"{turn}: {size / 1024 / 1024:.1f}MB" for turn, size in samples)
+        print(f"  {name:>12}: {points}  （1ターンあたり {growth / 1024:.1f}KB）")
+    print(f"  プロセスの最大RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f}MB")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,170 @@
+"""
+ブラウザのコンテキストを使い回すMCPサーバ（browser_pool_mcp_server.py）のスループットのベンチマーク
+ローカルに静的なテスト用のサイト（本文・画像・Webフォントを含むページ）を起動し、
+同時にpages_in_flight件ずつページを取得したときの pages/sec とページあたりの時間を比較する
+
+    pool_1_full:    コンテキスト1個、画像・フォントも読み込む（1つのブラウザで1件ずつ処理するPlaywright MCPに相当）
+    pool_1_text:    コンテキスト1個、画像・フォントの読み込みを中止する
+    pool_N_text:    コンテキストN個、画像・フォントの読み込みを中止する
+    playwright_mcp: npxで起動するPlaywright MCP（include_playwright_mcp=Trueの場合のみ。npxとブラウザのダウンロードが必要）
+
+画像とフォントはローカルでは一瞬で返るため、asset_delay秒だけ待ってから返し、実際のサイトの読み込み時間を再現する
+事前に playwright install chromium でブラウザをインストールしておく
+"""
+import os
+import time
+import asyncio
+import tempfile
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from mcp_pool import MCPServerPool
+from browser_pool_mcp_server import server_config
+
+
+def write_site(root, pages, images_per_page, paragraphs):
+    """
+    テスト用のサイト（page_0.html 〜、画像、Webフォント）を作成する関数
+    """
+    os.makedirs(os.path.join(root, "assets"), exist_ok=True)
+    with open(os.path.join(root, "assets", "font.woff2"), "wb") as f:
+        f.write(os.urandom(64 * 1024))
+    for i in range(images_per_page):
+        with open(os.path.join(root, "assets", f"image_{i}.png"), "wb") as f:
+            f.write(os.urandom(128 * 1024))
+
+    for page in range(pages):
+        images = "\n".join(
+            f'<img src="/assets/image_{i}.png?page={page}" width="320" height="180">' for i in range(images_per_page))
+        body = "\n".join(
+            f"<p>テスト用のページ{page}の段落{j}です。エージェントが読み取る本文のテキストです。</p>" for j in range(paragraphs))
+        html = f"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>テストページ {page}</title>
+<style>@font-face {{ font-family: "Bench"; src: url("/assets/font.woff2?page={page}"); }}
+body {{ font-family: "Bench", sans-serif; }}</style></head>
+<body><h1>テストページ {page}</h1>
+<nav><a href="/page_{(page + 1) % pages}.html">次のページ</a></nav>
+{images}
+<article>{body}</article>
+</body></html>"""
+        with open(os.path.join(root, f"page_{page}.html"), "w", encoding="utf-8") as f:
+            f.write(html)
+
+
+class SlowAssetHandler(SimpleHTTPRequestHandler):
+    """
+    画像とフォントだけasset_delay秒待ってから返すハンドラ
+    """
+
+    asset_delay = 0.0
+
+    def do_GET(self):
+        if self.path.startswith("/assets/"):
+            time.sleep(self.asset_delay)
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_site(root, asset_delay):
+    handler = type("Handler", (SlowAssetHandler,), {"asset_delay": asset_delay})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(handler, directory=root))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+async def run_scenario(name, connection, urls, pages_in_flight):
+    """
+    1つのMCPサーバを起動し、urlsをpages_in_flight件ずつ同時に取得した結果を返す関数
+    """
+    async with MCPServerPool({name: connection}, cache_dir=None) as mcp_pool:
+        await mcp_pool.wait_ready()
+        tools = {tool.name: tool for tool in mcp_pool.server_name_to_tools[name]}
+        navigate = tools["browser_navigate"]
+        # ブラウザの起動（最初の呼び出し）は測定に含めない
+        start = time.perf_counter()
+        await navigate.ainvoke({"url": urls[0]})
+        warmup = time.perf_counter() - start
+
+        semaphore = asyncio.Semaphore(pages_in_flight)
+        latencies = []
+        chars = []
+
+        async def fetch(url):
+            async with semaphore:
+                fetch_start = time.perf_counter()
+                output = await navigate.ainvoke({"url": url})
+                latencies.append(time.perf_counter() - fetch_start)
+                chars.append(len(str(output)))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(fetch(url) for url in urls))
+        elapsed = time.perf_counter() - start
+
+        stats = None
+        if "browser_pool_stats" in tools:
+            stats = await tools["browser_pool_stats"].ainvoke({})
+    latencies.sort()
+    return {
+        "name": name,
+        "pages_per_sec": len(urls) / elapsed,
+        "p50": latencies[len(latencies) // 2],
+        "p95": latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)],
+        "chars": sum(chars) / len(chars),
+        "warmup": warmup,
+        "stats": stats,
+    }
+
+
+async def main():
+    # ========== 設定 ==========
+    # 取得するページ数と、同時に取得するページ数（エージェントが1ターンに取得するページ数や、同時に処理する会話の数に相当）
+    pages = 60
+    pages_in_flight = 8
+    # プールのコンテキストの数と、コンテキストを作り直すまでの取得回数
+    contexts = 4
+    max_uses = 20
+    # 1ページあたりの画像の数と段落の数、画像・フォント1件あたりの応答時間（秒）
+    images_per_page = 6
+    paragraphs = 40
+    asset_delay = 0.1
+    # Trueの場合は、npxで起動するPlaywright MCPも測定する
+    include_playwright_mcp = False
+    # =========================
+
+    scenarios = {
+        "pool_1_full": server_config(contexts=1, max_uses=max_uses, block=""),
+        "pool_1_text": server_config(contexts=1, max_uses=max_uses),
+        f"pool_{contexts}_text": server_config(contexts=contexts, max_uses=max_uses),
+    }
+    if include_playwright_mcp:
+        scenarios["playwright_mcp"] = {
+            "command": "npx", "args": ["@playwright/mcp@latest", "--headless", "--isolated"], "transport": "stdio"}
+
+    with tempfile.TemporaryDirectory() as root:
+        write_site(root, pages, images_per_page, paragraphs)
+        server, base_url = start_site(root, asset_delay)
+        urls = [f"{base_url}/page_{i}.html" for i in range(pages)]
+        try:
+            results = [await run_scenario(name, connection, urls, pages_in_flight)
+                       for name, connection in scenarios.items()]
+        finally:
+            server.shutdown()
+
+    print(f"ページ数: {pages}（同時に{pages_in_flight}件）, 1ページに画像{images_per_page}件とWebフォント, "
+          f"画像・フォントの応答時間: {asset_delay}秒, max_uses: {max_uses}")
+    print()
+    print(f"{'':>16} {'pages/sec':>10} {'p50(ms)':>10} {'p95(ms)':>10} {'出力(文字)':>10} {'初回(ms)':>10}")
+    for result in results:
+        print(f"{result['name']:>16} {result['pages_per_sec']:>10.1f} {result['p50'] * 1000:>10.0f} "
+              f"{result['p95'] * 1000:>10.0f} {result['chars']:>10.0f} {result['warmup'] * 1000:>10.0f}")
+    print()
+    for result in results:
+        if result["stats"] is not None:
+            print(f"{result['name']}: {result['stats']}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+"""
+1ターンに複数のtool_callsがある場合のツール実行時間を比較するベンチマーク
+スタブMCPサーバ（stub_mcp_server.py）を利用するため、APIキーやブラウザは不要
+
+比較する方式:
+    sequential: tool_callsを1件ずつ実行する（従来の逐次実行に相当）
+    tool_node: ToolNode（1つのブラウザを共有するため、サーバ側で1件ずつ処理される）
+    parallel: ParallelToolExecutor（ブラウザのサーバをreplicas個起動し、別のブラウザへ振り分ける）
+"""
+import time
+import asyncio
+
+from langchain_core.messages import AIMessage
+from langgraph.prebuilt import ToolNode
+from langchain_mcp_adapters.client import MultiServerMCPClient
+
+from parallel_tools import ParallelToolExecutor, expand_replicas
+from stub_mcp_server import server_config
+
+
+def make_tool_calls(num_pages):
+    """
+    記事num_pages件の取得と、ブラウザ以外のサーバへの検索1件を同じターンで呼び出すAIMessageを作成する
+    """
+    tool_calls = [
+        {"name": "browser_navigate", "args": {"url": f"https://example.com/articles/{i}"}, "id": f"call_{i}"}
+        for i in range(num_pages)
+    ]
+    tool_calls.append({"name": "search_pages", "args": {"query": "langchain"}, "id": "call_search"})
+    return AIMessage(content="", tool_calls=tool_calls)
+
+
+def check_order(message, messages):
+    """
+    ToolMessageがtool_callsと同じ順番で返っているか確認する
+    """
+    return [m.tool_call_id for m in messages] == [c["id"] for c in message.tool_calls]
+
+
+async def main():
+    # ========== 設定 ==========
+    num_pages = 6
+    replicas = 3
+    latency = 0.5
+    payload_chars = 4000
+    # =========================
+
+    mcp_servers = {
+        "playwright": server_config("playwright", latency, payload_chars),
+        "notionApi": server_config("notionApi", latency, payload_chars),
+    }
+    mcp_servers, replica_groups = expand_replicas(mcp_servers, {"playwright": replicas})
+    for name, config in mcp_servers.items():
+        config["env"] = dict(config["env"], STUB_SERVER_NAME=name)
+
+    message = make_tool_calls(num_pages)
+    state = {"messages": [message]}
+    config = {"configurable": {"thread_id": "bench"}}
+
+    async with MultiServerMCPClient(mcp_servers) as mcp_client:
+        server_tools = mcp_client.server_name_to_tools
+        # ブラウザ以外のサーバのツールは1つにまとめる（スタブは全サーバが同じツールを持つため）
+        server_tools = {
+            name: [t for t in tools if (t.name == "search_pages") == (name == "notionApi")]
+            for name, tools in server_tools.items()
+        }
+        single_tools = server_tools["playwright"] + server_tools["notionApi"]
+
+        results = {}
+
+        start = time.perf_counter()
+        tools_by_name = {t.name: t for t in single_tools}
+        for tool_call in message.tool_calls:
+            await tools_by_name[tool_call["name"]].ainvoke(tool_call["args"])
+        results["sequential"] = (time.perf_counter() - start, True)
+
+        tool_node = ToolNode(single_tools)
+        start = time.perf_counter()
+        output = await tool_node.ainvoke(state, config)
+        results["tool_node"] = (time.perf_counter() - start, check_order(message, output["messages"]))
+
+        executor = ParallelToolExecutor(
+            server_tools,
+            replica_groups=replica_groups,
+            max_concurrency={"playwright": 1, "notionApi": 4},
+        )
+        start = time.perf_counter()
+        output = await executor.ainvoke(state, config)
+        results["parallel"] = (time.perf_counter() - start, check_order(message, output["messages"]))
+
+    print(f"tool_calls: {len(message.tool_calls)}件（browser_navigate {num_pages}件 + search_pages 1件）, "
+          f"latency: {latency}秒, playwrightの起動数: {replicas}")
+    for name, (elapsed, ordered) in results.items():
+        print(f"{name:>10}: {elapsed:.2f}秒  順番の一致: {ordered}")
+    print(f"サーバごとの実行数: {dict(executor.stats)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
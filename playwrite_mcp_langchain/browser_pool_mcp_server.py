@@ -0,0 +1,397 @@
+"""
+複数のブラウザのコンテキストを使い回す、テキストの取得用のMCPサーバ（Playwright MCPの代わりに利用できる）
+npxで起動するPlaywright MCPは1つのブラウザで1件ずつページを操作するため、1プロセスで同時に取得できるページは1件だけになる
+このサーバは1つのChromiumの中にN個のコンテキスト（それぞれ独立したCookie・ページを持つ）を起動しておき、
+同時に届いたツールの呼び出しを空いているコンテキストへ振り分ける
+
+    - 画像・フォント・動画の読み込みを中止する（テキストの取得には不要なため）
+    - コンテキストはmax_uses回ページを取得したら作り直す（メモリの増加やCookieの蓄積を防ぐ）
+    - 同じ接続（MCPのセッション）の続けての呼び出し（browser_snapshotなど）は、直前にページを開いたコンテキストで実行する
+      そのコンテキストが他の接続に使われた後は、直前のURLを開き直してから実行する
+    - 前回と別の接続に貸し出すコンテキストは作り直し、前の接続のCookieやストレージを引き継がない
+    - browser_closeで、その接続のコンテキストを作り直す（Playwright MCPのbrowser_closeと同様に、ログイン状態などを消す）
+
+起動方法:
+    stdio:  python browser_pool_mcp_server.py --contexts 4
+    SSE:    python browser_pool_mcp_server.py --transport sse --port 8931 --contexts 4
+            （mcp_config.jsonで {"url": "http://127.0.0.1:8931/sse", "transport": "sse"} を指定し、
+             expand_replicasで複製すると、複製ごとに別の接続になり、1つのブラウザを共有する）
+事前に playwright install chromium でブラウザをインストールしておく
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import weakref
+import contextlib
+
+from mcp.server.fastmcp import Context, FastMCP
+
+
+DEFAULT_BLOCKED_RESOURCE_TYPES = ("image", "font", "media")
+
+
+class _ContextSlot:
+    """
+    ブラウザのコンテキストと、その中の1つのページ
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.context = None
+        self.page = None
+        self.uses = 0
+        self.busy = False
+        # このページを直前に開いた接続（Noneの場合は空いている）
+        self.owner = None
+        # このコンテキストを最後に利用した接続（Cookieやストレージを残している接続）
+        self.last_owner = None
+        self.last_used = 0.0
+
+
+class BrowserContextPool:
+    """
+    1つのChromiumの中で、size個のコンテキストを使い回すクラス
+    - lease(owner)で空いているコンテキストを借りる。ownerが直前に使ったコンテキストが空いていればそれを優先する
+    - 空いているコンテキストがない場合は、idle_seconds秒以上使われていない他の接続のコンテキストを借りる。それもなければ待つ
+    - blocked_resource_typesのリクエスト（画像・フォントなど）は中止する
+    - max_uses回ページを取得したコンテキストは、次に取得する前に作り直す
+    - 前回と別の接続に貸し出すコンテキストは、貸し出す前に作り直す（Cookie・ストレージを他の接続に引き継がない）
+    ページの取得はPlaywright MCPと同様にloadイベントまで待つ（画像・フォントを中止すると、その分だけ早く終わる）
+    """
+
+    def __init__(self, size=4, max_uses=50, blocked_resource_types=DEFAULT_BLOCKED_RESOURCE_TYPES,
+                 headless=True, idle_seconds=60.0, navigation_timeout=30.0):
+        self.size = size
+        self.max_uses = max_uses
+        self.blocked_resource_types = set(blocked_resource_types)
+        self.headless = headless
+        self.idle_seconds = idle_seconds
+        self.navigation_timeout = navigation_timeout
+        self.slots = [_ContextSlot(i) for i in range(size)]
+        # 接続 -> 直前にページを開いたコンテキスト、直前に開いたURL
+        self.current = {}
+        self.last_url = {}
+        self.playwright = None
+        self.browser = None
+        self.condition = None
+        self.start_lock = asyncio.Lock()
+        self.stats = {"navigations": 0, "recycles": 0, "owner_changes": 0, "steals": 0, "restores": 0,
+                      "blocked_requests": 0, "errors": 0, "wait_seconds": 0.0, "max_busy": 0}
+
+    async def start(self):
+        """
+        ブラウザとコンテキストを起動する（起動済みの場合は何もしない）
+        """
+        async with self.start_lock:
+            if self.browser is not None:
+                return
+            from playwright.async_api import async_playwright
+
+            self.condition = asyncio.Condition()
+            self.playwright = await async_playwright().start()
+            try:
+                self.browser = await self.playwright.chromium.launch(headless=self.headless)
+                # 最初の呼び出しを待たせないように、全てのコンテキストを起動しておく
+                await asyncio.gather(*(self._open(slot) for slot in self.slots))
+            except Exception:
+                # 次の呼び出しで起動し直せるように、途中まで起動したものを停止する
+                await self.close()
+                raise
+
+    async def close(self):
+        if self.browser is not None:
+            await self.browser.close()
+            self.browser = None
+        if self.playwright is not None:
+            await self.playwright.stop()
+            self.playwright = None
+
+    async def _block(self, route):
+        if route.request.resource_type in self.blocked_resource_types:
+            self.stats["blocked_requests"] += 1
+            await route.abort()
+        else:
+            await route.continue_()
+
+    async def _open(self, slot):
+        slot.context = await self.browser.new_context()
+        slot.context.set_default_timeout(self.navigation_timeout * 1000)
+        if self.blocked_resource_types:
+            await slot.context.route("**/*", self._block)
+        slot.page = await slot.context.new_page()
+        slot.uses = 0
+
+    async def _recycle(self, slot):
+        self.stats["recycles"] += 1
+        with contextlib.suppress(Exception):
+            await slot.context.close()
+        await self._open(slot)
+
+    # ========== コンテキストの貸し出し ==========
+
+    def _pick(self, owner, stateful):
+        """
+        ownerに貸し出すコンテキストを選ぶ。貸し出せない場合はNoneを返す
+        stateful=Trueの場合（直前のページを操作する呼び出し）は、直前のコンテキストが空くまで待つ
+        """
+        current = self.current.get(owner)
+        if current is not None:
+            if not current.busy:
+                return current
+            if stateful:
+                return None
+        free = [slot for slot in self.slots if not slot.busy and slot.owner is None]
+        if free:
+            # 作り直さずに使えるコンテキスト（最後に利用したのが同じ接続か、まだ誰も利用していない）を優先する
+            return min(free, key=lambda slot: slot.last_owner not in (None, owner))
+        now = time.monotonic()
+        idle = [slot for slot in self.slots if not slot.busy and now - slot.last_used >= self.idle_seconds]
+        if idle:
+            return min(idle, key=lambda slot: slot.last_used)
+        return None
+
+    @contextlib.asynccontextmanager
+    async def lease(self, owner, stateful=False):
+        await self.start()
+        start = time.perf_counter()
+        async with self.condition:
+            while True:
+                slot = self._pick(owner, stateful)
+                if slot is not None:
+                    break
+                # 空きができれば起こされるが、他の接続のコンテキストがidle_seconds秒を過ぎる時刻にも確認し直す
+                # 直前のコンテキストが空くのを待つ場合（stateful）は、時間が経っても他のコンテキストは使わないため起こされるまで待つ
+                timeout = None
+                current = self.current.get(owner)
+                if not (stateful and current is not None and current.busy):
+                    idle_at = [s.last_used + self.idle_seconds for s in self.slots if not s.busy and s.owner is not None]
+                    if idle_at:
+                        timeout = max(min(idle_at) - time.monotonic(), 0.01)
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.condition.wait(), timeout)
+            if slot.owner is not None and slot.owner != owner:
+                # 他の接続のページを使うため、その接続は次の呼び出しで直前のURLを開き直す
+                self.stats["steals"] += 1
+                self.current.pop(slot.owner, None)
+            slot.busy = True
+            slot.owner = owner
+            self.stats["max_busy"] = max(self.stats["max_busy"], sum(1 for s in self.slots if s.busy))
+        self.stats["wait_seconds"] += time.perf_counter() - start
+        try:
+            if slot.last_owner is not None and slot.last_owner != owner:
+                # 前の接続のCookie・ストレージ・ページを引き継がないように、コンテキストを作り直す
+                self.stats["owner_changes"] += 1
+                await self._recycle(slot)
+            slot.last_owner = owner
+            yield slot
+        finally:
+            async with self.condition:
+                slot.busy = False
+                slot.last_used = time.monotonic()
+                if self.current.get(owner) is not slot:
+                    slot.owner = None
+                self.condition.notify_all()
+
+    def _set_current(self, owner, slot, url):
+        previous = self.current.get(owner)
+        if previous is not None and previous is not slot and not previous.busy:
+            previous.owner = None
+        self.current[owner] = slot
+        self.last_url[owner] = url
+
+    def release(self, owner):
+        """
+        接続が終了した場合に、その接続のコンテキストを空きに戻す
+        """
+        slot = self.current.pop(owner, None)
+        self.last_url.pop(owner, None)
+        if slot is not None and not slot.busy:
+            slot.owner = None
+        if self.condition is not None:
+            # 接続の終了はガベージコレクションから呼ばれるため、待っている呼び出しはイベントループで起こす
+            asyncio.get_running_loop().create_task(self._notify())
+
+    async def _notify(self):
+        async with self.condition:
+            self.condition.notify_all()
+
+    # ========== ページの操作 ==========
+
+    async def navigate(self, owner, url):
+        async with self.lease(owner) as slot:
+            if slot.uses >= self.max_uses:
+                await self._recycle(slot)
+            slot.uses += 1
+            self.stats["navigations"] += 1
+            try:
+                await slot.page.goto(url, wait_until="load")
+            except Exception:
+                self.stats["errors"] += 1
+                # ページが応答しなくなった場合に備えて、次の呼び出しでは作り直す
+                slot.uses = self.max_uses
+                raise
+            self._set_current(owner, slot, url)
+            return await render_page(slot.page)
+
+    async def run(self, owner, action):
+        """
+        直前に開いたページに対してaction(page)を実行し、実行後のページを返す
+        """
+        url = self.last_url.get(owner)
+        if url is None:
+            # 他の接続が開いたページを返さないように、まだページを開いていない接続はエラーにする
+            raise ValueError("ページを開いていません。先にbrowser_navigateでページを開いてください。")
+        async with self.lease(owner, stateful=True) as slot:
+            if self.current.get(owner) is not slot:
+                # 他の接続にコンテキストを使われた後のため、直前のURLを開き直す
+                self.stats["restores"] += 1
+                slot.uses += 1
+                await slot.page.goto(url, wait_until="load")
+            if action is not None:
+                await action(slot.page)
+            self._set_current(owner, slot, slot.page.url)
+            return await render_page(slot.page)
+
+    async def close_owner(self, owner):
+        """
+        ownerのコンテキストを作り直し、開いているページ・Cookie・ストレージを消す（browser_close）
+        """
+        self.last_url.pop(owner, None)
+        if self.current.get(owner) is None:
+            return
+        async with self.lease(owner, stateful=True) as slot:
+            await self._recycle(slot)
+            slot.last_owner = None
+            self.current.pop(owner, None)
+
+    def summary(self):
+        return {
+            **self.stats,
+            "contexts": self.size,
+            "busy": sum(1 for slot in self.slots if slot.busy),
+            "uses": [slot.uses for slot in self.slots],
+        }
+
+
+async def render_page(page):
+    """
+    ページのURL・タイトル・アクセシビリティツリーを、Playwright MCPと同じ形式のテキストにする
+    """
+    snapshot = await page.locator("body").aria_snapshot()
+    return (
+        f"- Page URL: {page.url}\n"
+        f"- Page Title: {await page.title()}\n"
+        f"- Page Snapshot\n"
+        f"```yaml\n{snapshot}\n```"
+    )
+
+
+pool = BrowserContextPool()
+mcp = FastMCP("browser-pool")
+_released = set()
+
+
+def owner_of(ctx):
+    """
+    MCPの接続ごとのキーを返す。接続が終了（ガベージコレクション）したら、その接続のコンテキストを空きに戻す
+    """
+    session = ctx.session
+    key = id(session)
+    if key not in _released:
+        _released.add(key)
+        weakref.finalize(session, _release, key)
+    return key
+
+
+def _release(key):
+    _released.discard(key)
+    with contextlib.suppress(RuntimeError):
+        pool.release(key)
+
+
+@mcp.tool()
+async def browser_navigate(url: str, ctx: Context) -> str:
+    """Navigate to a URL and return the accessibility snapshot of the page (images and fonts are not loaded)"""
+    return await pool.navigate(owner_of(ctx), url)
+
+
+@mcp.tool()
+async def browser_snapshot(ctx: Context) -> str:
+    """Capture accessibility snapshot of the current page"""
+    return await pool.run(owner_of(ctx), None)
+
+
+@mcp.tool()
+async def browser_navigate_back(ctx: Context) -> str:
+    """Go back to the previous page"""
+    async def back(page):
+        await page.go_back(wait_until="load")
+
+    return await pool.run(owner_of(ctx), back)
+
+
+@mcp.tool()
+async def browser_click(text: str, ctx: Context) -> str:
+    """Click the link or button whose visible text contains the given text, and return the snapshot of the resulting page"""
+    async def click(page):
+        await page.get_by_text(text).first.click()
+        await page.wait_for_load_state("load")
+
+    return await pool.run(owner_of(ctx), click)
+
+
+@mcp.tool()
+async def browser_close(ctx: Context) -> str:
+    """Close the page and clear the cookies and storage of this connection"""
+    await pool.close_owner(owner_of(ctx))
+    return "The page was closed and the cookies and storage were cleared."
+
+
+@mcp.tool()
+async def browser_pool_stats() -> str:
+    """Return the usage statistics of the browser context pool"""
+    return str(pool.summary())
+
+
+def server_config(contexts=4, max_uses=50, block="image,font,media"):
+    """
+    MultiServerMCPClient（MCPServerPool）に渡す、このサーバをstdioで起動する設定を作成する関数
+    """
+    return {
+        "command": sys.executable,
+        "args": [os.path.abspath(__file__), "--contexts", str(contexts), "--max-uses", str(max_uses), "--block", block],
+        "transport": "stdio",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ブラウザのコンテキストを使い回すMCPサーバ")
+    parser.add_argument("--transport", choices=["stdio", "sse"], default="stdio")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8931)
+    parser.add_argument("--contexts", type=int, default=4, help="起動するコンテキストの数（同時に取得できるページ数）")
+    parser.add_argument("--max-uses", type=int, default=50, help="コンテキストを作り直すまでのページの取得回数")
+    parser.add_argument("--block", default=",".join(DEFAULT_BLOCKED_RESOURCE_TYPES),
+                        help="読み込みを中止するリソースの種類（カンマ区切り。空の場合は中止しない）")
+    parser.add_argument("--idle-seconds", type=float, default=60.0,
+                        help="この秒数以上使われていないコンテキストは、他の接続に貸し出す")
+    parser.add_argument("--headed", action="store_true", help="ブラウザの画面を表示する")
+    args = parser.parse_args()
+
+    global pool
+    pool = BrowserContextPool(
+        size=args.contexts,
+        max_uses=args.max_uses,
+        blocked_resource_types=[t for t in args.block.split(",") if t],
+        headless=not args.headed,
+        idle_seconds=args.idle_seconds,
+    )
+    mcp.settings.host = args.host
+    mcp.settings.port = args.port
+    mcp.run(transport=args.transport)
+
+
+if __name__ == "__main__":
+    main()
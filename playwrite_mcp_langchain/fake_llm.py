@@ -0,0 +1,82 @@
+import re
+import time
+import asyncio
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    APIキーなしでエージェントを動かすための、決まった手順でツールを呼び出すチャットモデル
+    - 最後のメッセージがHumanMessageの場合: 質問に含まれるURL（なければdefault_urls）をtool_nameで取得するtool_callsを返す
+    - 最後のメッセージがToolMessageの場合: 取得したツールの出力の文字数を含む回答を返す
+      tool_roundsが2以上の場合は、そのターンでtool_rounds回ツールを呼び出すまで、URLに?step=nを付けて取得し直す
+    ツールをbindしていない（もしくはtool_choice="none"でbindした）場合は、常に回答を返す（要約や計画のまとめ用）
+    ただし、cached_content（ツールの定義を含むGeminiのキャッシュ）を指定した場合は、ツールをbindした場合と同じにする
+    latencyは、1回の呼び出しで待つ秒数（モデルの応答時間の代わり）
+    usage_metadataには、入力・出力の文字数から推定したトークン数を設定する（同じ入力には常に同じ値になる）
+    """
+
+    tool_name: str = "browser_navigate"
+    default_urls: list[str] = ["https://example.com/"]
+    latency: float = 0.0
+    answer_chars: int = 200
+    tool_rounds: int = 1
+    tools_bound: bool = False
+
+    @property
+    def _llm_type(self):
+        return "scripted-chat-model"
+
+    def bind_tools(self, tools, tool_choice=None, **kwargs):
+        # ツールの呼び出し方は固定のため、bindしたツールは利用しない
+        return self.model_copy(update={"tools_bound": tool_choice != "none"})
+
+    def _respond(self, messages, tools_bound):
+        turn_start = max((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), default=0)
+        rounds = sum(1 for m in messages[turn_start:] if isinstance(m, AIMessage) and m.tool_calls)
+        if tools_bound and rounds < self.tool_rounds:
+            human = messages[turn_start]
+            text = human.content if isinstance(human.content, str) else " ".join(
+                part.get("text", "") for part in human.content if isinstance(part, dict))
+            urls = re.findall(r"https?://\S+", text) or self.default_urls
+            if rounds > 0:
+                urls = [f"{url}{'&' if '?' in url else '?'}step={rounds}" for url in urls]
+            tool_calls = [
+                {"name": self.tool_name, "args": {"url": url}, "id": f"call_{len(messages)}_{i}"}
+                for i, url in enumerate(urls)
+            ]
+            return AIMessage(content="", tool_calls=tool_calls)
+
+        tool_chars = 0
+        for message in reversed(messages):
+            if not isinstance(message, ToolMessage):
+                break
+            tool_chars += len(str(message.content))
+        if tool_chars:
+            answer = f"ツールの出力（{tool_chars}文字）を確認しました。"
+        else:
+            answer = f"入力（{len(str(messages[-1].content))}文字）を確認しました。"
+        return AIMessage(content=(answer * (self.answer_chars // len(answer) + 1))[:self.answer_chars])
+
+    def _result(self, messages, **kwargs):
+        message = self._respond(messages, self.tools_bound or kwargs.get("cached_content") is not None)
+        # 1トークンを4文字として推定する
+        input_tokens = sum(len(str(m.content)) for m in messages) // 4
+        output_tokens = len(str(message.content)) // 4 + 10 * len(message.tool_calls)
+        message.usage_metadata = {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+        }
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        return self._result(messages, **kwargs)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        return self._result(messages, **kwargs)
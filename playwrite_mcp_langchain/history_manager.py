@@ -0,0 +1,150 @@
+import hashlib
+from langchain_core.messages import HumanMessage, SystemMessage, ToolMessage
+from langchain_core.messages.utils import count_tokens_approximately, trim_messages
+from langgraph.constants import TAG_NOSTREAM
+
+
+SUMMARY_PROMPT = """
+以下はユーザとAIアシスタントの過去の会話です。
+今後の会話で必要になる事実（ユーザの要望、訪問したURL、取得できた情報、結論）を漏らさずに、簡潔な日本語で要約してください。
+"""
+
+
+def render_transcript(messages, max_chars_per_message=2000):
+    """
+    メッセージ列を要約用のテキストに変換する関数
+    tool_callsを含むメッセージをそのまま渡すと、ツールをbindしていないモデルではエラーになることがあるため、テキストにしてから渡す
+    """
+    lines = []
+    for message in messages:
+        content = message.content if isinstance(message.content, str) else str(message.content)
+        line = f"[{message.type}] {content[:max_chars_per_message]}"
+        for tool_call in getattr(message, "tool_calls", None) or []:
+            line += f"\n(ツール呼び出し: {tool_call['name']} {tool_call['args']})"
+        lines.append(line)
+    return "\n\n".join(lines)
+
+
+def _message_key(messages):
+    """
+    メッセージ列を識別するキーを作成する（要約のキャッシュに利用する）
+    """
+    h = hashlib.sha256()
+    for message in messages:
+        h.update(message.type.encode("utf-8"))
+        h.update(str(message.content).encode("utf-8"))
+    return h.hexdigest()
+
+
+class HistoryManager:
+    """
+    call_modelの前に会話履歴をトークン予算内に収めるクラス
+    GraphStateのmessagesは毎ターン増え続け、特にPlaywrightのページスナップショットを含むToolMessageが巨大になるため、
+    モデルに入力する履歴だけを以下のpolicyで縮める（チェックポイントに保存される履歴はそのまま）
+
+    policy:
+        "trim": 古いメッセージから削除する
+        "elide_tools": 直近keep_last_tool_messages件以外のToolMessageの中身を省略する
+        "summarize": 直近keep_last_turns回のやり取りより前の会話をsummarizerで要約する（古いToolMessageは省略する）
+    いずれのpolicyでも、最後にmax_tokensを超えている場合は古いメッセージから削除する
+    """
+
+    def __init__(self, max_tokens=30000, policy="elide_tools", keep_last_tool_messages=2,
+                 elided_preview_chars=200, keep_last_turns=2, summarizer=None,
+                 token_counter=count_tokens_approximately):
+        if policy not in ("trim", "elide_tools", "summarize"):
+            raise ValueError(f"未対応のpolicyです: {policy}")
+        if policy == "summarize" and summarizer is None:
+            raise ValueError("policy='summarize'の場合はsummarizerを指定してください。")
+
+        self.max_tokens = max_tokens
+        self.policy = policy
+        self.keep_last_tool_messages = keep_last_tool_messages
+        self.elided_preview_chars = elided_preview_chars
+        self.keep_last_turns = keep_last_turns
+        self.summarizer = summarizer
+        self.token_counter = token_counter
+        self.summary_cache = {}
+        # 直近の呼び出しで削減したトークン数（推定）
+        self.last_stats = {}
+
+    def __call__(self, messages):
+        before = self.token_counter(messages)
+
+        if self.policy == "elide_tools":
+            messages = self.elide_tool_messages(messages)
+        elif self.policy == "summarize":
+            messages = self.summarize(self.elide_tool_messages(messages))
+
+        messages = self.trim(messages)
+
+        self.last_stats = {"before_tokens": before, "after_tokens": self.token_counter(messages)}
+        return messages
+
+    def elide_tool_messages(self, messages):
+        """
+        直近keep_last_tool_messages件以外のToolMessageの中身を、先頭の一部だけを残して省略する関数
+        tool_call_idは残すため、AIMessageのtool_callsとの対応関係は崩れない
+        """
+        tool_indexes = [i for i, m in enumerate(messages) if isinstance(m, ToolMessage)]
+        keep = set(tool_indexes[-self.keep_last_tool_messages:]) if self.keep_last_tool_messages else set()
+
+        result = []
+        for i, message in enumerate(messages):
+            if isinstance(message, ToolMessage) and i not in keep:
+                content = message.content if isinstance(message.content, str) else str(message.content)
+                if len(content) > self.elided_preview_chars:
+                    preview = content[:self.elided_preview_chars]
+                    message = message.model_copy(update={
+                        "content": f"{preview}\n...（古いツールの出力のため省略しました。元の長さ: {len(content)}文字）"
+                    })
+            result.append(message)
+        return result
+
+    def summarize(self, messages):
+        """
+        直近keep_last_turns回のやり取り（HumanMessageから始まる区間）より前の会話を要約に置き換える関数
+        同じ範囲の要約はキャッシュし、毎回要約し直さないようにする
+        """
+        human_indexes = [i for i, m in enumerate(messages) if isinstance(m, HumanMessage)]
+        if len(human_indexes) <= self.keep_last_turns:
+            return messages
+
+        split = human_indexes[-self.keep_last_turns]
+        old, recent = messages[:split], messages[split:]
+
+        key = _message_key(old)
+        if key not in self.summary_cache:
+            # 要約の出力は回答ではないため、graph.astream(stream_mode="messages")に流さない
+            response = self.summarizer.invoke([
+                SystemMessage(content=SUMMARY_PROMPT),
+                HumanMessage(content=render_transcript(old)),
+            ], config={"tags": [TAG_NOSTREAM]})
+            # 古い要約はもう使われないため、キャッシュが増え続けないように削除する
+            if len(self.summary_cache) >= 128:
+                self.summary_cache.clear()
+            self.summary_cache[key] = response.content
+        summary = self.summary_cache[key]
+
+        return [HumanMessage(content=f"（これまでの会話の要約）\n{summary}"), *recent]
+
+    def trim(self, messages):
+        """
+        max_tokensを超えている場合に、古いメッセージから削除する関数
+        HumanMessageから始まるように削除するため、tool_callsとToolMessageの対応関係は崩れない
+        """
+        if self.token_counter(messages) <= self.max_tokens:
+            return messages
+        trimmed = trim_messages(
+            messages,
+            max_tokens=self.max_tokens,
+            token_counter=self.token_counter,
+            strategy="last",
+            start_on="human",
+            allow_partial=False,
+        )
+        # 最新のHumanMessageだけで予算を超える場合でも、少なくとも現在のターンは入力する
+        if not trimmed:
+            human_indexes = [i for i, m in enumerate(messages) if isinstance(m, HumanMessage)]
+            trimmed = messages[human_indexes[-1]:] if human_indexes else messages
+        return trimmed
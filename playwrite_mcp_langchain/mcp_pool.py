@@ -0,0 +1,285 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+
+from langchain_core.callbacks import adispatch_custom_event
+from langchain_core.tools import StructuredTool, ToolException
+from langchain_mcp_adapters.tools import _convert_call_tool_result
+from mcp import ClientSession, StdioServerParameters
+from mcp.client.sse import sse_client
+from mcp.client.stdio import stdio_client
+from mcp.shared.exceptions import McpError
+
+from tracing import MCP_CALL_EVENT
+
+
+def config_hash(connection):
+    """
+    サーバの設定（コマンド・引数・環境変数など）から、ツールのスキーマのキャッシュのキーを作成する
+    環境変数にAPIキーが含まれる場合があるため、設定そのものではなくハッシュをファイル名に利用する
+    """
+    return hashlib.sha256(json.dumps(connection, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+async def _trace_mcp_call(server, tool, wait_seconds, call_seconds, ok):
+    """
+    MCPサーバの呼び出しの秒数を、カスタムイベントとしてコールバック（tracing.TraceRecorder）に送る関数
+    ツールの実行の外から呼ばれた場合（親の実行がない場合）は何もしない
+    """
+    try:
+        await adispatch_custom_event(MCP_CALL_EVENT, {
+            "server": server, "tool": tool, "wait_seconds": wait_seconds, "call_seconds": call_seconds, "ok": ok,
+        })
+    except RuntimeError:
+        pass
+
+
+class _ServerSlot:
+    """
+    1つのMCPサーバの状態
+    """
+
+    def __init__(self, name, connection):
+        self.name = name
+        self.connection = connection
+        self.session = None
+        self.ready = asyncio.Event()
+        self.restart_event = asyncio.Event()
+        self.schemas = None
+        self.schemas_ready = asyncio.Event()
+        self.status = "starting"
+        self.restarts = 0
+        self.last_error = None
+        self.startup_seconds = None
+        self.task = None
+
+
+class MCPServerPool:
+    """
+    MCPサーバを起動時に立ち上げ、プロセスを使い回すクラス（MultiServerMCPClientの代わりに利用する）
+    - 全てのサーバを並行して起動する（MultiServerMCPClientは1台ずつ順番に起動する）
+    - ツールのスキーマを設定のハッシュをキーにcache_dirへ保存し、次回の起動時はサーバの起動を待たずにツールを作成する
+      （npxの解決やブラウザの起動が終わる前にモデルへの入力を受け付けられる。ツールの呼び出しはサーバの起動を待つ）
+    - health_interval秒ごとにpingを送り、応答がない・プロセスが終了したサーバは再起動する
+    - ツールは呼び出しのたびに現在のセッションを参照するため、再起動してもグラフやモデルを作り直す必要はない
+
+    server_name_to_toolsは、MultiServerMCPClientと同じ {サーバ名: [ツールのリスト]} の辞書
+    """
+
+    def __init__(self, connections, cache_dir="mcp_cache", health_interval=30.0, ping_timeout=10.0,
+                 call_timeout=120.0, startup_timeout=120.0, restart_backoff=1.0):
+        self.connections = connections
+        self.cache_dir = cache_dir
+        self.health_interval = health_interval
+        self.ping_timeout = ping_timeout
+        self.call_timeout = call_timeout
+        self.startup_timeout = startup_timeout
+        self.restart_backoff = restart_backoff
+        self.slots = {name: _ServerSlot(name, connection) for name, connection in connections.items()}
+        self.server_name_to_tools = {}
+        self.closing = False
+        self.health_task = None
+        self.started_at = None
+        self.tools_ready_seconds = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def get_tools(self):
+        return [tool for tools in self.server_name_to_tools.values() for tool in tools]
+
+    # ========== 起動・停止 ==========
+
+    async def start(self):
+        """
+        全てのサーバの起動を開始し、ツールが作成できた時点で戻る関数
+        スキーマのキャッシュがあるサーバは起動を待たない
+        """
+        self.started_at = time.perf_counter()
+        for slot in self.slots.values():
+            cached = self._load_cache(slot)
+            if cached is not None:
+                slot.schemas = cached
+                slot.schemas_ready.set()
+            slot.task = asyncio.create_task(self._supervise(slot))
+
+        for slot in self.slots.values():
+            try:
+                await asyncio.wait_for(slot.schemas_ready.wait(), self.startup_timeout)
+            except asyncio.TimeoutError:
+                await self.close()
+                raise RuntimeError(f"MCPサーバ{slot.name}が{self.startup_timeout}秒以内に起動しませんでした: {slot.last_error}")
+            self.server_name_to_tools[slot.name] = [self._make_tool(slot, schema) for schema in slot.schemas]
+        self.tools_ready_seconds = time.perf_counter() - self.started_at
+        self.health_task = asyncio.create_task(self._health_loop())
+
+    async def wait_ready(self):
+        """
+        全てのサーバの起動が完了するまで待つ関数
+        """
+        await asyncio.gather(*(slot.ready.wait() for slot in self.slots.values()))
+
+    async def close(self):
+        self.closing = True
+        tasks = [slot.task for slot in self.slots.values() if slot.task is not None]
+        if self.health_task is not None:
+            tasks.append(self.health_task)
+            self.health_task.cancel()
+        for slot in self.slots.values():
+            slot.restart_event.set()
+        # サーバの接続はそれぞれのタスクの中で閉じる（anyioのキャンセルスコープは作成したタスクで閉じる必要があるため）
+        done, pending = await asyncio.wait(tasks, timeout=10) if tasks else (set(), set())
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def restart(self, name, reason=None):
+        """
+        サーバを再起動する（実行中の_superviseが接続を閉じて、起動し直す）
+        """
+        slot = self.slots[name]
+        if slot.ready.is_set():
+            slot.last_error = reason
+            slot.ready.clear()
+            slot.restart_event.set()
+
+    def _transport(self, connection):
+        connection = dict(connection)
+        transport = connection.pop("transport", "stdio")
+        if transport == "sse":
+            return sse_client(connection["url"], connection.get("headers"))
+        env = dict(connection.get("env") or {})
+        # npxなどはPATHが必要なため、指定されていない場合は現在のPATHを渡す
+        env.setdefault("PATH", os.environ.get("PATH", ""))
+        return stdio_client(StdioServerParameters(command=connection["command"], args=connection.get("args", []), env=env))
+
+    async def _supervise(self, slot):
+        """
+        サーバを起動し、再起動の指示があるかプロセスが終了するまで接続を保持する。終了後は起動し直す
+        """
+        while not self.closing:
+            slot.restart_event.clear()
+            slot.status = "starting"
+            start = time.perf_counter()
+            try:
+                async with self._transport(slot.connection) as (read, write):
+                    async with ClientSession(read, write) as session:
+                        await session.initialize()
+                        result = await session.list_tools()
+                        schemas = [
+                            {"name": t.name, "description": t.description or "", "inputSchema": t.inputSchema}
+                            for t in result.tools
+                        ]
+                        self._save_cache(slot, schemas)
+                        if slot.schemas is None:
+                            slot.schemas = schemas
+                            slot.schemas_ready.set()
+                        elif [s["name"] for s in schemas] != [s["name"] for s in slot.schemas]:
+                            slot.last_error = "ツールの一覧がキャッシュと異なります。次回の起動時から新しい一覧を利用します。"
+
+                        slot.session = session
+                        slot.status = "ready"
+                        slot.startup_seconds = time.perf_counter() - start
+                        slot.ready.set()
+                        await slot.restart_event.wait()
+            except Exception as e:
+                slot.last_error = repr(e)
+            finally:
+                slot.session = None
+                slot.ready.clear()
+
+            if self.closing:
+                break
+            slot.status = "restarting"
+            slot.restarts += 1
+            await asyncio.sleep(min(self.restart_backoff * slot.restarts, 30))
+        slot.status = "closed"
+
+    async def _health_loop(self):
+        while not self.closing:
+            await asyncio.sleep(self.health_interval)
+            for slot in self.slots.values():
+                session = slot.session
+                if session is None or not slot.ready.is_set():
+                    continue
+                try:
+                    await asyncio.wait_for(session.send_ping(), self.ping_timeout)
+                except Exception as e:
+                    self.restart(slot.name, reason=f"pingに応答しません: {e!r}")
+
+    # ========== ツール ==========
+
+    def _make_tool(self, slot, schema):
+        pool = self
+
+        async def call_tool(**arguments):
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(slot.ready.wait(), pool.startup_timeout)
+            except asyncio.TimeoutError:
+                raise ToolException(f"MCPサーバ{slot.name}が起動していません: {slot.last_error}")
+            session = slot.session
+            called = time.perf_counter()
+            ok = False
+            try:
+                result = await asyncio.wait_for(session.call_tool(schema["name"], arguments), pool.call_timeout)
+                ok = not result.isError
+            except McpError as e:
+                # サーバからのエラー応答（引数の誤りなど）は再起動しない
+                raise ToolException(str(e))
+            except Exception as e:
+                # 応答がない・プロセスが終了した場合は再起動し、エラーをモデルに返す
+                pool.restart(slot.name, reason=repr(e))
+                raise ToolException(f"MCPサーバ{slot.name}との通信に失敗したため再起動します。もう一度実行してください: {e!r}")
+            finally:
+                await _trace_mcp_call(slot.name, schema["name"], called - start, time.perf_counter() - called, ok)
+            return _convert_call_tool_result(result)
+
+        return StructuredTool(
+            name=schema["name"],
+            description=schema["description"],
+            args_schema=schema["inputSchema"],
+            coroutine=call_tool,
+            response_format="content_and_artifact",
+        )
+
+    # ========== スキーマのキャッシュ ==========
+
+    def _cache_path(self, slot):
+        return os.path.join(self.cache_dir, f"{slot.name.replace('#', '_')}-{config_hash(slot.connection)}.json")
+
+    def _load_cache(self, slot):
+        if not self.cache_dir or not os.path.exists(self._cache_path(slot)):
+            return None
+        with open(self._cache_path(slot), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _save_cache(self, slot, schemas):
+        if not self.cache_dir:
+            return
+        path = self._cache_path(slot)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(schemas, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def stats(self):
+        return {
+            "tools_ready_seconds": self.tools_ready_seconds,
+            "servers": {
+                name: {
+                    "status": slot.status,
+                    "restarts": slot.restarts,
+                    "startup_seconds": slot.startup_seconds,
+                    "last_error": slot.last_error,
+                }
+                for name, slot in self.slots.items()
+            },
+        }
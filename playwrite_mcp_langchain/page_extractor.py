@@ -0,0 +1,323 @@
+import re
+import json
+import time
+
+from langchain_core.runnables import RunnableConfig
+from langchain_core.tools import StructuredTool
+
+
+# 本文の抽出の前に削除する要素
+DEFAULT_DROP_TAGS = ("script", "style", "noscript", "template", "svg", "iframe", "form", "button",
+                     "nav", "header", "footer", "aside")
+# class・idがこのパターンに一致する要素は、本文ではない（メニュー・広告・関連記事など）とみなして削除する
+BOILERPLATE_PATTERN = re.compile(
+    r"(?i)(^|[-_\s])(nav|menu|sidebar|footer|header|banner|breadcrumb|share|social|related|recommend|"
+    r"advert|ads?|promo|cookie|comments?|popup|modal)([-_\s]|$)")
+BLOCK_TAGS = ("h1", "h2", "h3", "h4", "h5", "h6", "p", "li", "pre", "blockquote", "td", "dt", "dd", "figcaption")
+# いいねの数を表すJSONのキー（Next.jsの__NEXT_DATA__など。zenn.devはlikedCount）
+LIKE_KEY_PATTERN = re.compile(r'"(?:likedCount|liked_count|likesCount|likes_count|likeCount|like_count)"\s*:\s*(\d+)')
+
+DEFAULT_USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"
+
+
+def _clean(text):
+    return re.sub(r"\s+", " ", text or "").strip()
+
+
+def _meta(doc, *names):
+    for name in names:
+        values = doc.xpath(f'//meta[@property="{name}" or @name="{name}"]/@content')
+        if values and _clean(values[0]):
+            return _clean(values[0])
+    return None
+
+
+def _json_ld(doc):
+    items = []
+    for script in doc.xpath('//script[@type="application/ld+json"]'):
+        try:
+            data = json.loads(script.text or "")
+        except ValueError:
+            continue
+        for item in data if isinstance(data, list) else [data]:
+            if isinstance(item, dict):
+                items.extend(item.get("@graph", [item]) if isinstance(item.get("@graph"), list) else [item])
+    return [item for item in items if isinstance(item, dict)]
+
+
+def _author_name(author):
+    if isinstance(author, list):
+        author = author[0] if author else None
+    if isinstance(author, dict):
+        return author.get("name")
+    return author if isinstance(author, str) else None
+
+
+def extract_metadata(doc):
+    """
+    タイトル・説明・著者・公開日・いいねの数を、metaタグ・JSON-LD・ページに埋め込まれたJSONから取得する関数
+    見つからない項目はNoneにする
+    """
+    ld = next((item for item in _json_ld(doc) if item.get("headline") or item.get("author")), {})
+    likes = None
+    for statistic in ld.get("interactionStatistic") or []:
+        if isinstance(statistic, dict) and "Like" in str(statistic.get("interactionType")):
+            likes = statistic.get("userInteractionCount")
+    if likes is None:
+        for script in doc.xpath('//script[@id="__NEXT_DATA__" or @type="application/json"]'):
+            match = LIKE_KEY_PATTERN.search(script.text or "")
+            if match:
+                likes = int(match.group(1))
+                break
+    titles = doc.xpath("//title/text()")
+    return {
+        "title": _meta(doc, "og:title", "twitter:title") or ld.get("headline") or (_clean(titles[0]) if titles else None),
+        "description": _meta(doc, "og:description", "description"),
+        "author": _meta(doc, "author", "article:author") or _author_name(ld.get("author")),
+        "published": _meta(doc, "article:published_time") or ld.get("datePublished"),
+        "likes": likes,
+        "site_name": _meta(doc, "og:site_name"),
+    }
+
+
+def _paragraph_chars(element):
+    return sum(len(_clean(p.text_content())) for p in element.iter("p"))
+
+
+def _remove_boilerplate(doc):
+    """
+    classやidがメニュー・広告などに一致する要素を削除する関数
+    "layout has-sidebar"のように本文を囲む要素のclassにも一致することがあるため、
+    article・main要素を含む要素と、ページの段落の半分以上を含む要素は削除しない
+    """
+    from lxml import etree
+
+    etree.strip_elements(doc, etree.Comment, *DEFAULT_DROP_TAGS, with_tail=False)
+    body = doc.xpath("//body")
+    total = _paragraph_chars(body[0]) if body else 0
+    for element in doc.xpath("//body//*[@class or @id]"):
+        if element.tag in ("article", "main") or element.get("role") == "main" or element.getparent() is None:
+            continue
+        label = f"{element.get('class', '')} {element.get('id', '')}"
+        if not BOILERPLATE_PATTERN.search(label):
+            continue
+        if element.xpath('.//article | .//main | .//*[@role="main"]'):
+            continue
+        if total and _paragraph_chars(element) * 2 >= total:
+            continue
+        element.drop_tree()
+
+
+def _main_element(doc):
+    """
+    本文を含む要素を選ぶ関数
+    article・main要素があればそれを、なければ段落（p）の文字数の合計が最も大きい要素を選ぶ
+    """
+    for xpath in ("//article", "//main", '//*[@role="main"]'):
+        candidates = [e for e in doc.xpath(xpath) if len(_clean(e.text_content())) >= 200]
+        if candidates:
+            return max(candidates, key=lambda e: len(e.text_content()))
+    scores = {}
+    for paragraph in doc.xpath("//p"):
+        length = len(_clean(paragraph.text_content()))
+        parent = paragraph.getparent()
+        if parent is None or length < 25:
+            continue
+        scores[parent] = scores.get(parent, 0) + length
+        grandparent = parent.getparent()
+        if grandparent is not None:
+            scores[grandparent] = scores.get(grandparent, 0) + length / 2
+    if scores:
+        return max(scores, key=scores.get)
+    body = doc.xpath("//body")
+    return body[0] if body else doc
+
+
+def _blocks(element):
+    """
+    本文の要素から、見出し・段落・リストなどのテキストを順番に取り出す関数
+    リンクがほとんどの短い行（メニューやタグの一覧）は除く
+    """
+    lines = []
+    for block in element.iter(*BLOCK_TAGS):
+        # 他のブロックを含む要素（段落を含むliなど）は、内側のブロックで取り出す
+        if block.tag != "pre" and any(child.tag in BLOCK_TAGS for child in block.iterdescendants()):
+            continue
+        if any(ancestor.tag == "pre" for ancestor in block.iterancestors()):
+            continue
+        text = block.text_content().strip() if block.tag == "pre" else _clean(block.text_content())
+        if not text:
+            continue
+        link_chars = sum(len(_clean(a.text_content())) for a in block.iter("a"))
+        if block.tag != "pre" and len(text) < 80 and link_chars >= len(text) * 0.8:
+            continue
+        if block.tag in ("h1", "h2", "h3", "h4", "h5", "h6"):
+            text = f"{'#' * int(block.tag[1])} {text}"
+        elif block.tag == "li":
+            text = f"- {text}"
+        if not lines or lines[-1] != text:
+            lines.append(text)
+    if not lines:
+        lines = [_clean(element.text_content())]
+    return "\n".join(lines)
+
+
+def decode_html(content, encoding=None):
+    """
+    HTMLのバイト列を文字列にする関数
+    文字コードは、レスポンスのContent-Type、metaタグのcharset、UTF-8の順に決める
+    """
+    if encoding is None:
+        match = re.search(rb"""<meta[^>]+charset=["']?([\w-]+)""", content[:4096], re.IGNORECASE)
+        encoding = match.group(1).decode("ascii") if match else "utf-8"
+    try:
+        return content.decode(encoding, errors="replace")
+    except LookupError:
+        return content.decode("utf-8", errors="replace")
+
+
+def extract_html(html, url=None, encoding=None):
+    """
+    HTML（文字列もしくはバイト列）から、メタデータと本文のテキストを取り出す関数
+    最終的な出力は、{"url", "title", "description", "author", "published", "likes", "site_name", "text"} の辞書
+    """
+    import lxml.html
+
+    if isinstance(html, bytes):
+        html = decode_html(html, encoding)
+    # XML宣言を含む文字列はlxmlで読み込めないため削除する
+    html = re.sub(r"^\s*<\?xml[^>]*\?>", "", html)
+    doc = lxml.html.fromstring(html, base_url=url)
+    metadata = extract_metadata(doc)
+    _remove_boilerplate(doc)
+    return {"url": url, **metadata, "text": _blocks(_main_element(doc))}
+
+
+def snapshot_to_text(snapshot):
+    """
+    Playwright MCPのスナップショット（アクセシビリティツリーのYAML）から、URL・タイトルと表示されているテキストだけを取り出す関数
+    """
+    url = title = None
+    lines = []
+    for line in snapshot.splitlines():
+        if line.startswith("- Page URL:"):
+            url = line.split(":", 1)[1].strip()
+            continue
+        if line.startswith("- Page Title:"):
+            title = line.split(":", 1)[1].strip()
+            continue
+        # - heading "タイトル" [level=1] [ref=e5]  /  - text: 本文  /  - /url: https://...
+        match = re.match(r'^\s*- (?:(\w+)(?: "((?:[^"\\]|\\.)*)")?[^:]*(?::\s*(.*))?)$', line)
+        if not match or line.strip().startswith("- /"):
+            continue
+        role, name, value = match.groups()
+        text = _clean(name or value or "")
+        if not text or role in ("img", "separator"):
+            continue
+        if role == "heading":
+            text = f"# {text}"
+        if not lines or lines[-1] != text:
+            lines.append(text)
+    return {"url": url, "title": title, "text": "\n".join(lines)}
+
+
+class PageExtractor:
+    """
+    ページのタイトル・いいねの数などのメタデータと本文だけを、上限の文字数までのJSONで返すツール（read_page）を作成するクラス
+    browser_navigateはアクセシビリティツリー全体を返すため、記事を読むだけのページでは入力のほとんどがメニューや装飾になる
+    - まずブラウザを使わずにHTTPでHTMLを取得し、lxmlで本文を取り出す（静的なページはブラウザを起動・操作しない）
+    - HTMLを取得できない・本文がmin_static_chars文字未満の場合（JavaScriptで描画するページなど）は、
+      browser_fetch(url, thread_id)でブラウザから取得したスナップショットからテキストを取り出す
+    read_pageはRunnableConfigのthread_idを受け取り、browser_fetchに渡す（会話に貸し出されているブラウザで取得するため）
+    """
+
+    def __init__(self, browser_fetch=None, max_chars=6000, min_static_chars=400, timeout=15.0,
+                 max_bytes=5_000_000, user_agent=DEFAULT_USER_AGENT):
+        self.browser_fetch = browser_fetch
+        self.max_chars = max_chars
+        self.min_static_chars = min_static_chars
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.user_agent = user_agent
+        self.client = None
+        self.stats = {"http": 0, "browser": 0, "errors": 0, "html_chars": 0, "output_chars": 0, "seconds": 0.0}
+        self.tool = self._build_tool()
+
+    async def fetch_html(self, url):
+        """
+        HTTPでHTMLを取得する。HTML以外・取得に失敗した場合はNoneを返す
+        """
+        import httpx
+
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                follow_redirects=True, timeout=self.timeout, headers={"User-Agent": self.user_agent})
+        try:
+            async with self.client.stream("GET", url) as response:
+                if response.status_code != 200 or "html" not in response.headers.get("content-type", ""):
+                    return None
+                chunks = []
+                size = 0
+                async for chunk in response.aiter_bytes():
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    if size >= self.max_bytes:
+                        break
+                return b"".join(chunks), response.charset_encoding, str(response.url)
+        except httpx.HTTPError:
+            return None
+
+    async def extract(self, url, thread_id=None):
+        """
+        ページを取得して、メタデータと本文の辞書を返す（sourceは"http"もしくは"browser"）
+        """
+        start = time.perf_counter()
+        result = None
+        fetched = await self.fetch_html(url)
+        if fetched is not None:
+            content, encoding, final_url = fetched
+            self.stats["html_chars"] += len(content)
+            try:
+                result = {**extract_html(content, final_url, encoding), "source": "http"}
+            except Exception:
+                result = None
+
+        if (result is None or len(result["text"]) < self.min_static_chars) and self.browser_fetch is not None:
+            snapshot = await self.browser_fetch(url, thread_id)
+            page = snapshot_to_text(snapshot)
+            # HTTPで取得できたメタデータ（いいねの数など）は残し、本文はブラウザで表示したものにする
+            result = {**(result or {"url": url}), **{k: v for k, v in page.items() if v}, "source": "browser"}
+            self.stats["browser"] += 1
+        elif result is not None:
+            self.stats["http"] += 1
+
+        self.stats["seconds"] += time.perf_counter() - start
+        if result is None:
+            self.stats["errors"] += 1
+            return {"url": url, "error": "ページを取得できませんでした。browser_navigateで取得してください。"}
+
+        text = result["text"]
+        if len(text) > self.max_chars:
+            result["text"] = text[:self.max_chars]
+            result["truncated"] = f"全{len(text)}文字中 先頭{self.max_chars}文字"
+        result = {key: value for key, value in result.items() if value is not None}
+        self.stats["output_chars"] += len(result["text"])
+        return result
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def summary(self):
+        return dict(self.stats)
+
+    def _build_tool(self):
+        extractor = self
+
+        async def read_page(url: str, config: RunnableConfig) -> str:
+            """Read a web page (article) and return only its title, author, published date, likes and main body text as compact JSON. Prefer this over browser_navigate when you only need to read the content of a page."""
+            thread_id = ((config or {}).get("configurable") or {}).get("thread_id")
+            return json.dumps(await extractor.extract(url, thread_id), ensure_ascii=False)
+
+        return StructuredTool.from_function(coroutine=read_page)
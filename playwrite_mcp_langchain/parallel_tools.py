@@ -0,0 +1,348 @@
+import copy
+import time
+import asyncio
+import contextlib
+from collections import OrderedDict, defaultdict
+
+from langchain_core.messages import AIMessage, ToolMessage
+
+
+def expand_replicas(mcp_servers, replicas):
+    """
+    mcp_config.jsonのサーバ設定を複製し、同じMCPサーバを複数プロセス起動するための設定を作成する関数
+    replicasは、{サーバ名: 起動数} の辞書。例: {"playwright": 3}
+    複製したサーバは "playwright#2" のような名前になる
+    Playwright MCPは複数起動するとブラウザのプロファイルが競合し、会話に貸し出す場合は前の利用者のCookieが残るため、
+    複製元を含む全てに--isolatedを付与して、それぞれプロファイルを保存しない独立したブラウザにする
+    最終的な出力は、(新しいサーバ設定, {サーバ名: [複製を含むサーバ名のリスト]})
+    """
+    servers = dict(mcp_servers)
+    groups = {}
+    for name, count in replicas.items():
+        if name not in mcp_servers:
+            continue
+        names = [name] + [f"{name}#{i}" for i in range(2, count + 1)]
+        for server in names:
+            replica = copy.deepcopy(mcp_servers[name])
+            args = replica.get("args", [])
+            if any("playwright/mcp" in arg for arg in args) and "--isolated" not in args:
+                replica["args"] = args + ["--isolated"]
+            servers[server] = replica
+        groups[name] = names
+    return servers, groups
+
+
+class ParallelToolExecutor:
+    """
+    1ターンに複数のtool_callsがある場合に、MCPサーバをまたいで並列に実行するクラス（ToolNodeの代わりに利用する）
+    - サーバごとに同時実行数を制限する（Playwrightは1つのブラウザで同時に複数のページを操作できないため1にする）
+    - 同じサーバを複数起動している場合（expand_replicas）は、ページを開く呼び出し（page_opening_tools）を空いているサーバ（＝別のブラウザ）へ振り分ける
+      同じターンにクリックなどページの状態を使う呼び出しがある場合は振り分けず、全て直前と同じサーバで実行する
+      ターンの後は、最後にページを開いたサーバを直前のサーバとし、続くbrowser_clickなどをそのブラウザで実行する
+    - 結果のToolMessageは、tool_callsと同じ順番で返す
+
+    server_toolsは、{サーバ名: [ツールのリスト]}（MultiServerMCPClient.server_name_to_tools）
+    replica_groupsは、{グループ名: [サーバ名のリスト]}。同じグループのサーバは同じツールを持つ複製として扱う
+    extra_toolsは、MCPサーバ以外のツール（fetch_tool_outputなど）
+
+    複数のユーザが同時に利用する場合は、lease(thread_id)の中でグラフを実行する
+    その会話がleased_groupsのツールを初めて呼び出したときに空いている複製を1つ貸し出し、
+    ターンが終わるまで他の会話からは利用できないようにする（他のユーザのページを操作しないようにするため）
+    前回と別の会話に貸し出すときはreset_tool（browser_close）でブラウザを閉じ、前の会話のページやCookieを引き継がない
+
+    tool_cache（ToolResultCache）を指定した場合は、キャッシュにある結果はツールを実行せずに返す
+    ページの取得（browser_navigate）をキャッシュから返した場合はブラウザのページは移動していないため、
+    その会話が次に同じグループのツール（browser_clickなど）を実行する前に、実際にページを取得し直す
+    """
+
+    def __init__(self, server_tools, replica_groups=None, max_concurrency=None,
+                 default_max_concurrency=4, extra_tools=(), leased_groups=("playwright",),
+                 max_remembered_threads=10000, tool_cache=None, page_opening_tools=("browser_navigate",),
+                 reset_tool="browser_close"):
+        replica_groups = replica_groups or {}
+        max_concurrency = max_concurrency or {}
+
+        # 複製されたサーバはグループにまとめ、それ以外のサーバは1台だけのグループとする
+        grouped = {server for servers in replica_groups.values() for server in servers}
+        self.groups = dict(replica_groups)
+        for server in server_tools:
+            if server not in grouped:
+                self.groups[server] = [server]
+        self.groups["local"] = ["local"]
+        server_tools = dict(server_tools, local=list(extra_tools))
+
+        # サーバごとの {ツール名: ツール}、ツール名 -> グループ名
+        self.server_tools = {server: {t.name: t for t in tools} for server, tools in server_tools.items()}
+        self.tool_group = {}
+        for group, servers in self.groups.items():
+            for tool in server_tools.get(servers[0], []):
+                self.tool_group[tool.name] = group
+
+        self.semaphores = {
+            server: asyncio.Semaphore(max_concurrency.get(server, max_concurrency.get(group, default_max_concurrency)))
+            for group, servers in self.groups.items() for server in servers
+        }
+        # (thread_id, グループ名) -> 直前に利用したサーバ。ページの状態を引き継ぐため、単独の呼び出しは同じサーバへ送る
+        self.current_server = OrderedDict()
+        self.max_remembered_threads = max_remembered_threads
+        self.page_opening_tools = set(page_opening_tools)
+        self.stats = defaultdict(int)
+
+        self.tool_cache = tool_cache
+        # (thread_id, グループ名) -> キャッシュから返したため、まだ実行していないページの取得のtool_call
+        self.pending_replay = OrderedDict()
+        # (thread_id, グループ名) -> 実行中のtool_callsのタスク（wait_for_batchで、同じターンの他の呼び出しを待つため）
+        self.running = defaultdict(list)
+
+        # 貸し出し中の会話と、貸し出されているサーバ
+        self.leased_groups = [g for g in leased_groups if g in self.groups]
+        self.leasing_threads = set()
+        self.leases = {}
+        self.free_servers = {group: list(self.groups[group]) for group in self.leased_groups}
+        self.lease_condition = None
+        self.reset_tool = reset_tool
+        # サーバ -> 最後に貸し出した会話
+        self.last_lessee = {}
+        self.lease_waiting = 0
+        self.lease_wait_seconds = 0.0
+        self.lease_count = 0
+
+    @property
+    def tools(self):
+        """
+        モデルにbindするツールのリスト（複製されたサーバのツールは1つにまとめる）
+        """
+        return [
+            self.server_tools[servers[0]][name]
+            for group, servers in self.groups.items()
+            for name in self.server_tools.get(servers[0], {})
+        ]
+
+    def assign_servers(self, tool_calls, thread_id):
+        """
+        各tool_callを実行するサーバを決める関数
+        同じグループへの1つ目の呼び出しは直前と同じサーバへ、2つ目以降は別の複製へ順番に振り分ける
+        ページを開く呼び出し以外（前のページの状態を使う呼び出し）を含むグループは振り分けない
+        """
+        # ページの状態を使う呼び出しを含むグループ
+        stateful_groups = {
+            self.tool_group.get(tool_call["name"]) for tool_call in tool_calls
+            if tool_call["name"] not in self.page_opening_tools
+        }
+        assigned = []
+        counts = defaultdict(int)
+        for tool_call in tool_calls:
+            group = self.tool_group.get(tool_call["name"])
+            if group is None:
+                assigned.append(None)
+                continue
+            if (thread_id, group) in self.leases:
+                assigned.append(self.leases[(thread_id, group)])
+                continue
+            servers = self.groups[group]
+            current = self.current_server.get((thread_id, group), servers[0])
+            start = servers.index(current)
+            assigned.append(servers[(start + counts[group]) % len(servers)])
+            if group not in stateful_groups:
+                counts[group] += 1
+        return assigned
+
+    async def _run_one(self, tool_call, server, thread_id=None):
+        if server is None:
+            return ToolMessage(
+                content=f"Error: {tool_call['name']} is not a valid tool, try one of {list(self.tool_group)}.",
+                name=tool_call["name"], tool_call_id=tool_call["id"], status="error",
+            )
+        tool = self.server_tools[server][tool_call["name"]]
+        queued = time.perf_counter()
+        async with self.semaphores[server]:
+            self.stats[server] += 1
+            # 実行したサーバと同時実行数の空き待ちの秒数は、トレース（tracing.TraceRecorder）のツールのスパンに記録される
+            metadata = {"mcp_server": server, "queue_seconds": time.perf_counter() - queued}
+            # thread_idは、会話に貸し出されているブラウザを利用するローカルのツール（read_pageなど）のために渡す
+            config = {"metadata": metadata, "configurable": {"thread_id": thread_id}}
+            try:
+                # langchain_mcp_adapters のツールは引数の辞書を書き換えるため、履歴のtool_callsを汚さないようにコピーを渡す
+                output = await tool.ainvoke(dict(tool_call["args"]), config=config)
+            except Exception as e:
+                # ToolNodeと同様に、エラーはモデルに返して再試行できるようにする
+                return ToolMessage(
+                    content=f"Error: {e!r}\n Please fix your mistakes.",
+                    name=tool_call["name"], tool_call_id=tool_call["id"], status="error",
+                )
+        if isinstance(output, ToolMessage):
+            return output
+        content = output if isinstance(output, (str, list)) else str(output)
+        return ToolMessage(content=content, name=tool_call["name"], tool_call_id=tool_call["id"])
+
+    def _from_cache(self, tool_call):
+        if self.tool_cache is None:
+            return None
+        content = self.tool_cache.get(tool_call["name"], tool_call["args"])
+        if content is None:
+            return None
+        return ToolMessage(content=content, name=tool_call["name"], tool_call_id=tool_call["id"])
+
+    async def _execute(self, tool_call, server, thread_id=None):
+        output = await self._run_one(tool_call, server, thread_id)
+        if self.tool_cache is not None and output.status != "error":
+            self.tool_cache.put(tool_call["name"], tool_call["args"], output.content)
+        return output
+
+    async def ainvoke(self, state, config=None):
+        messages = state["messages"]
+        last_message = messages[-1]
+        if not isinstance(last_message, AIMessage) or not last_message.tool_calls:
+            return {"messages": []}
+
+        thread_id = ((config or {}).get("configurable") or {}).get("thread_id")
+        tool_calls = last_message.tool_calls
+        cached = [self._from_cache(tool_call) for tool_call in tool_calls]
+        pending = [tool_call for tool_call, hit in zip(tool_calls, cached) if hit is None]
+
+        if thread_id in self.leasing_threads:
+            for group in {self.tool_group.get(c["name"]) for c in pending} & set(self.leased_groups):
+                await self._acquire(thread_id, group)
+        servers = self.assign_servers(pending, thread_id)
+        await self._replay(pending, servers, thread_id)
+
+        tasks = [asyncio.ensure_future(self._execute(tool_call, server, thread_id))
+                 for tool_call, server in zip(pending, servers)]
+        keys = [(thread_id, self.tool_group.get(tool_call["name"])) for tool_call in pending]
+        for key, task in zip(keys, tasks):
+            self.running[key].append(task)
+        try:
+            # asyncio.gatherは引数の順番で結果を返すため、tool_callsと同じ順番になる
+            outputs = iter(await asyncio.gather(*tasks))
+        finally:
+            for key, task in zip(keys, tasks):
+                self.running[key].remove(task)
+                if not self.running[key]:
+                    del self.running[key]
+        results = [hit if hit is not None else next(outputs) for hit in cached]
+
+        # 最後にページを開いたサーバ（モデルが最後に見たページがあるブラウザ）を、次の呼び出しのサーバとして覚える
+        opened = {}
+        for tool_call, server in zip(pending, servers):
+            if server is None:
+                continue
+            group = self.tool_group[tool_call["name"]]
+            if tool_call["name"] in self.page_opening_tools or (thread_id, group) not in self.current_server:
+                opened[group] = server
+        for group, server in opened.items():
+            self._remember(thread_id, group, server)
+        self._update_replay(tool_calls, cached, thread_id)
+        return {"messages": results}
+
+    async def wait_for_batch(self, thread_id, tool_name):
+        """
+        その会話で実行中の、tool_nameと同じグループの呼び出しが終わるまで待つ
+        ローカルのツール（read_pageなど）が同じターンの途中で会話のブラウザを操作する前に呼び出し、
+        同じターンのbrowser_clickなどと順番が入れ替わって別のページを操作しないようにする
+        """
+        tasks = list(self.running.get((thread_id, self.tool_group.get(tool_name)), ()))
+        if tasks:
+            await asyncio.wait(tasks)
+
+    async def _replay(self, pending, servers, thread_id):
+        """
+        キャッシュから返したページの取得を、同じグループのツールを実行する前に実際に実行する
+        """
+        if self.tool_cache is None:
+            return
+        for tool_call, server in zip(pending, servers):
+            group = self.tool_group.get(tool_call["name"])
+            replay = self.pending_replay.pop((thread_id, group), None)
+            if replay is not None and server is not None and tool_call["name"] not in self.tool_cache.stateful_tools:
+                await self._execute(replay, server, thread_id)
+
+    def _update_replay(self, tool_calls, cached, thread_id):
+        if self.tool_cache is None:
+            return
+        for tool_call, hit in zip(tool_calls, cached):
+            if tool_call["name"] not in self.tool_cache.stateful_tools:
+                continue
+            key = (thread_id, self.tool_group.get(tool_call["name"]))
+            if hit is not None:
+                self.pending_replay[key] = tool_call
+                self.pending_replay.move_to_end(key)
+            else:
+                self.pending_replay.pop(key, None)
+        while len(self.pending_replay) > self.max_remembered_threads:
+            self.pending_replay.popitem(last=False)
+
+    def _remember(self, thread_id, group, server):
+        key = (thread_id, group)
+        self.current_server[key] = server
+        self.current_server.move_to_end(key)
+        if len(self.current_server) > self.max_remembered_threads:
+            self.current_server.popitem(last=False)
+
+    @contextlib.asynccontextmanager
+    async def lease(self, thread_id):
+        """
+        `async with executor.lease(thread_id):` の中でグラフを実行すると、
+        leased_groupsのサーバをその会話専用に貸し出し、終了時に返却する
+        """
+        if self.lease_condition is None:
+            self.lease_condition = asyncio.Condition()
+        self.leasing_threads.add(thread_id)
+        try:
+            yield
+        finally:
+            self.leasing_threads.discard(thread_id)
+            async with self.lease_condition:
+                for group in self.leased_groups:
+                    server = self.leases.pop((thread_id, group), None)
+                    if server is not None:
+                        self.free_servers[group].append(server)
+                self.lease_condition.notify_all()
+
+    async def _reset(self, server):
+        """
+        サーバのブラウザを閉じ、前の会話のページとCookieを次の会話に引き継がないようにする
+        次にツールを呼び出したときに、新しいブラウザが起動する
+        """
+        tool = self.server_tools[server].get(self.reset_tool)
+        if tool is None:
+            return
+        try:
+            async with self.semaphores[server]:
+                await tool.ainvoke({})
+        except Exception as e:
+            print(f"ブラウザのリセットに失敗しました（{server}）: {e!r}")
+
+    async def _acquire(self, thread_id, group):
+        if (thread_id, group) in self.leases:
+            return
+        start = time.perf_counter()
+        async with self.lease_condition:
+            self.lease_waiting += 1
+            try:
+                await self.lease_condition.wait_for(lambda: self.free_servers[group])
+            finally:
+                self.lease_waiting -= 1
+            # 前回のターンと同じサーバが空いていれば、ページの状態を引き継ぐためにそれを貸し出す
+            free = self.free_servers[group]
+            preferred = self.current_server.get((thread_id, group))
+            server = preferred if preferred in free else free[0]
+            free.remove(server)
+            self.leases[(thread_id, group)] = server
+            self._remember(thread_id, group, server)
+            previous = self.last_lessee.get(server)
+            self.last_lessee[server] = thread_id
+        if previous is not None and previous != thread_id:
+            await self._reset(server)
+        self.lease_count += 1
+        self.lease_wait_seconds += time.perf_counter() - start
+
+    def lease_stats(self):
+        return {
+            "leased": len(self.leases),
+            "waiting": self.lease_waiting,
+            "free": {group: len(servers) for group, servers in self.free_servers.items()},
+            "leases": self.lease_count,
+            "mean_wait_seconds": self.lease_wait_seconds / self.lease_count if self.lease_count else 0.0,
+            "calls_per_server": dict(self.stats),
+            "cache": self.tool_cache.summary() if self.tool_cache is not None else None,
+        }
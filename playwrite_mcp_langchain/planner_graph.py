@@ -0,0 +1,233 @@
+"""
+複数のページを調べる質問のための、計画（planner）→ 並列実行（executor）→ まとめ（synthesizer）のグラフ
+create_graphのReActのループは、ページの取得を1件ずつ順番に判断して進めるため、
+「この著者の一番いいねが多い記事を探して、取得して、分析して」のような質問では、取得の待ち時間が積み重なる
+
+    planner:    質問を、互いの依存関係（depends_on）を持つサブタスクに分割する
+    dispatch:   依存するサブタスクが終わったものを、Sendでexecuteへ同時に送る（全て終わったらagentへ）
+    execute:    1つのサブタスクを、ツールを使う小さなループ（最大max_worker_steps回）で実行する
+    agent:      全てのサブタスクの結果から最終的な回答を作成する
+                （ReActのグラフと同じ名前にし、astream_turnでトークンをそのまま表示できるようにする）
+
+会話の履歴（messages）はReActのグラフと同じ形式のため、同じcheckpointerとthread_idでリクエストごとにグラフを切り替えられる
+"""
+import re
+import operator
+from typing import Annotated, TypedDict
+
+from langchain_core.messages import AIMessage, AnyMessage, HumanMessage, SystemMessage
+from langchain_core.output_parsers import JsonOutputParser
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.graph import StateGraph, START, END
+from langgraph.types import Send
+
+from tool_router import message_text
+
+
+PLANNER_PROMPT = """
+あなたは、ブラウザでWebページを調べてユーザの質問に回答するための計画を作成します。
+ユーザの最後の質問を、それぞれ1つ（もしくは少数）のページを調べる小さなサブタスクに分割し、以下の形式のJSONだけを出力してください。
+{"subtasks": [{"id": "t1", "task": "サブタスクの内容（調べるURLがあれば含める）", "depends_on": []}]}
+
+- 互いに依存しないサブタスクは、depends_onを空にしてください（同時に実行されます）
+- 前のサブタスクの結果（記事のURLなど）が必要なサブタスクは、depends_onにそのサブタスクのidを指定してください
+- サブタスクは最大{max_subtasks}個までにしてください
+- 最終的な回答の作成はサブタスクに含めないでください（全てのサブタスクの結果から別に作成します）
+"""
+
+WORKER_PROMPT = """
+（システムからの指示）あなたは、以下のユーザの質問に回答するためのサブタスクの1つを担当しています。
+ツールを利用してサブタスクだけを実行し、分かったこと（URL、数値、要点）を簡潔に報告してください。質問全体への回答は不要です。
+
+サブタスク: {task}
+{context}
+ユーザの質問（他のサブタスクのURLは<URL>に置き換えています）: {question}
+"""
+
+URL_PATTERN = r"https?://[^\s　）)」]+"
+
+SYNTHESIZE_PROMPT = """
+（システムからの指示）ユーザの最後の質問に回答するために、以下のサブタスクを実行しました。
+サブタスクの結果だけを利用して、ユーザの質問に回答してください。結果が足りない場合は、分かったことと分からなかったことを分けて回答してください。
+
+{results}
+"""
+
+FORCE_FINAL_WORKER_PROMPT = "（システムからの指示）ツールの利用回数の上限に達しました。これまでに分かったことを報告してください。"
+
+
+def merge_results(current, update):
+    """
+    サブタスクの結果（{id: 結果}）をまとめるreducer
+    同時に実行したexecuteの結果を1つの辞書にまとめる。Noneを書き込んだ場合は空にする（新しいターンの開始時）
+    """
+    if update is None:
+        return {}
+    return {**(current or {}), **update}
+
+
+class PlannerState(TypedDict):
+    messages: Annotated[list[AnyMessage], operator.add]
+    plan: list[dict]
+    results: Annotated[dict, merge_results]
+
+
+def conversation(messages):
+    """
+    ツールをbindしていないモデルに渡せるように、会話の履歴からHumanMessageとツールを呼び出していないAIMessageだけを取り出す
+    """
+    return [
+        m for m in messages
+        if isinstance(m, HumanMessage) or (isinstance(m, AIMessage) and not m.tool_calls and m.content)
+    ]
+
+
+def normalize_plan(subtasks, max_subtasks):
+    """
+    サブタスクのidを一意にし、存在しないid・自分より後のサブタスクへの依存（循環の原因）を取り除く関数
+    """
+    plan = []
+    seen = set()
+    for i, subtask in enumerate(subtasks[:max_subtasks]):
+        if not isinstance(subtask, dict) or not subtask.get("task"):
+            continue
+        subtask_id = str(subtask.get("id") or f"t{i + 1}")
+        if subtask_id in seen:
+            subtask_id = f"{subtask_id}_{i + 1}"
+        depends_on = [str(d) for d in subtask.get("depends_on") or [] if str(d) in seen]
+        plan.append({"id": subtask_id, "task": str(subtask["task"]), "depends_on": depends_on})
+        seen.add(subtask_id)
+    return plan
+
+
+async def url_planner(question, history=None, max_subtasks=8):
+    """
+    質問に含まれるURLごとに、互いに依存しないサブタスクを作成する計画（モデルを使わない。モックやURLを列挙した質問用）
+    URLがない場合は、質問全体を1つのサブタスクにする
+    """
+    urls = list(dict.fromkeys(re.findall(URL_PATTERN, question)))
+    if not urls:
+        return [{"id": "t1", "task": question, "depends_on": []}]
+    return [
+        {"id": f"t{i + 1}", "task": f"{url} を開いて、質問に関係する内容を調べる", "depends_on": []}
+        for i, url in enumerate(urls[:max_subtasks])
+    ]
+
+
+def make_llm_planner(model, max_subtasks=8):
+    """
+    モデルに計画（JSON）を作成させる関数を作成する
+    JSONを読み取れない場合は、url_plannerの計画にする
+    """
+    parser = JsonOutputParser()
+    prompt = PLANNER_PROMPT.replace("{max_subtasks}", str(max_subtasks))
+
+    async def planner(question, history):
+        response = await model.ainvoke([SystemMessage(content=prompt), *history])
+        try:
+            subtasks = parser.parse(message_text(response)).get("subtasks", [])
+        except Exception:
+            subtasks = []
+        return subtasks or await url_planner(question, history, max_subtasks)
+
+    return planner
+
+
+def create_planner_graph(state: PlannerState, planner, model_chain, synthesizer, tool_executor,
+                         tool_output_processor=None, history_manager=None, tool_router=None,
+                         final_model_chain=None, checkpointer=None, max_subtasks=8, max_worker_steps=4):
+    """
+    計画 → 並列実行 → まとめのグラフを作成する関数
+    planner:      (質問, 会話の履歴) -> サブタスクのリスト を返す非同期関数（make_llm_plannerもしくはurl_planner）
+    model_chain:  サブタスクを実行するモデルのチェーン（tool_routerを指定した場合はサブタスクごとにツールを選ぶ）
+    synthesizer:  最終的な回答を作成するモデル（ツールはbindしない）
+    サブタスクは、ParallelToolExecutorのleaseで会話とは別にブラウザを借りるため、Playwright MCPの起動数まで同時に実行される
+    """
+
+    def history_of(messages):
+        if history_manager is not None:
+            messages = history_manager(messages)
+        return conversation(messages)
+
+    async def make_plan(state: state):
+        history = history_of(state["messages"])
+        question = next((message_text(m) for m in reversed(history) if isinstance(m, HumanMessage)), "")
+        subtasks = await planner(question, history)
+        return {"plan": normalize_plan(subtasks, max_subtasks), "results": None}
+
+    def dispatch(state: state):
+        """
+        依存するサブタスクが全て終わったサブタスクを、Sendで同時にexecuteへ送る
+        """
+        results = state.get("results") or {}
+        question = next((message_text(m) for m in reversed(state["messages"]) if isinstance(m, HumanMessage)), "")
+        ready = [
+            subtask for subtask in state["plan"]
+            if subtask["id"] not in results and all(d in results for d in subtask["depends_on"])
+        ]
+        if not ready:
+            return "agent"
+        return [
+            Send("execute", {
+                "subtask": subtask,
+                # サブタスク以外のページを開かないように、質問のURLは伏せる（サブタスクの内容にURLを含める）
+                "question": re.sub(URL_PATTERN, "<URL>", question),
+                "context": {d: results[d] for d in subtask["depends_on"]},
+            })
+            for subtask in ready
+        ]
+
+    async def execute(task, config):
+        subtask = task["subtask"]
+        context = "\n".join(f"前のサブタスク{d}の結果: {result}" for d, result in task["context"].items())
+        messages = [HumanMessage(content=WORKER_PROMPT.format(question=task["question"], task=subtask["task"],
+                                                              context=context))]
+        # サブタスクごとに別の会話としてブラウザを借りる（同じページを他のサブタスクが操作しないようにする）
+        thread_id = f"{config['configurable'].get('thread_id')}/{subtask['id']}"
+        tool_config = {"configurable": {"thread_id": thread_id}}
+
+        async with tool_executor.lease(thread_id):
+            for _ in range(max_worker_steps):
+                chain = await tool_router.route(messages) if tool_router is not None else model_chain
+                response = await chain.ainvoke(messages)
+                messages.append(response)
+                if not response.tool_calls:
+                    return {"results": {subtask["id"]: message_text(response)}}
+                result = await tool_executor.ainvoke({"messages": messages}, tool_config)
+                outputs = result["messages"]
+                if tool_output_processor is not None:
+                    outputs = tool_output_processor(outputs, thread_id)
+                messages.extend(outputs)
+
+        final_chain = final_model_chain if final_model_chain is not None else model_chain
+        response = await final_chain.ainvoke([*messages, HumanMessage(content=FORCE_FINAL_WORKER_PROMPT)])
+        return {"results": {subtask["id"]: message_text(response) or "（結果を報告できませんでした）"}}
+
+    def collect(state: state):
+        # 同時に実行したexecuteが全て終わってから、次に実行できるサブタスクを確認する
+        return {}
+
+    async def synthesize(state: state):
+        results = state.get("results") or {}
+        rendered = "\n\n".join(
+            f"## サブタスク{subtask['id']}: {subtask['task']}\n{results.get(subtask['id'], '（実行できませんでした）')}"
+            for subtask in state["plan"]
+        )
+        history = history_of(state["messages"])
+        response = await synthesizer.ainvoke([*history, HumanMessage(content=SYNTHESIZE_PROMPT.format(results=rendered))])
+        return {"messages": [AIMessage(content=response.content, id=response.id)]}
+
+    workflow = StateGraph(state)
+    workflow.add_node("planner", make_plan)
+    workflow.add_node("execute", execute)
+    workflow.add_node("collect", collect)
+    workflow.add_node("agent", synthesize)
+
+    workflow.add_edge(START, "planner")
+    workflow.add_conditional_edges("planner", dispatch, ["execute", "agent"])
+    workflow.add_edge("execute", "collect")
+    workflow.add_conditional_edges("collect", dispatch, ["execute", "agent"])
+    workflow.add_edge("agent", END)
+    if checkpointer is None:
+        checkpointer = MemorySaver()
+    return workflow.compile(checkpointer=checkpointer)
@@ -2,6 +2,9 @@ import json
 import re
 import os
 import sys
+import time
+import uuid
+import asyncio
 import operator
 from dotenv import load_dotenv, find_dotenv
 from typing_extensions import TypedDict
@@ -9,13 +12,25 @@ from typing import Any, Callable, Dict, Iterable, List, Optional, TypedDict, Ann
 
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.messages import HumanMessage, SystemMessage, AnyMessage, ToolMessage
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, AnyMessage, ToolMessage
 
 from langgraph.prebuilt import ToolNode
 from langgraph.graph import StateGraph, START, END
 from langgraph.checkpoint.memory import MemorySaver
 
-from langchain_mcp_adapters.client import MultiServerMCPClient
+from mcp_pool import MCPServerPool
+from agent_stream import astream_turn
+from history_manager import HistoryManager
+from tool_output_processor import ToolOutputProcessor
+from parallel_tools import ParallelToolExecutor, expand_replicas
+from tool_cache import ToolResultCache
+from turn_budget import TurnBudget
+from tool_router import ToolRouter
+from prompt_cache import GeminiContextCacheBackend, PrefixCacheManager
+from planner_graph import PlannerState, create_planner_graph, make_llm_planner
+from tracing import TraceRecorder
+from page_extractor import PageExtractor
+from sqlite_checkpointer import SQLiteDeltaSaver
 
 _ = load_dotenv(find_dotenv())
 google_api_key = os.getenv("GOOGLE_APIKEY")
@@ -24,7 +39,8 @@ class GraphState(TypedDict):
     messages: Annotated[list[AnyMessage], operator.add]
 
 
-def create_graph(state: GraphState, tools, model_chain):
+def create_graph(state: GraphState, tools, model_chain, history_manager=None, tool_output_processor=None,
+                 tool_executor=None, checkpointer=None, turn_budget=None, final_model_chain=None, tool_router=None):
     def should_continue(state: state):
         messages = state["messages"]
         last_message = messages[-1]
@@ -33,75 +49,276 @@ def create_graph(state: GraphState, tools, model_chain):
         return END
 
 
-    def call_model(state: state):
+    async def call_model(state: state, config):
         messages = state["messages"]
-        response = model_chain.invoke(messages)
-        return {"messages": [response]}
+        # 履歴が長くなりすぎないように、モデルに入力する前にトークン予算内に収める
+        if history_manager is not None:
+            messages = history_manager(messages)
+        # tool_routerを指定した場合は、このターンの質問に関係のあるツールだけをbindしたチェーンを利用する
+        chain = await tool_router.route(state["messages"]) if tool_router is not None else model_chain
+        if turn_budget is None:
+            # ainvokeで呼び出すと、graph.astream(stream_mode="messages")でトークンごとに出力を受け取れる
+            response = await chain.ainvoke(messages)
+            if tool_router is not None:
+                tool_router.record(response)
+            return {"messages": [response]}
+
+        # ターンごとの上限（呼び出し回数・時間・トークン数）と、同じツールの繰り返しを確認する
+        thread_id = config["configurable"].get("thread_id")
+        reason = turn_budget.check(thread_id, state["messages"])
+        if reason is None:
+            response = await chain.ainvoke(messages)
+            if tool_router is not None:
+                tool_router.record(response)
+            reason = turn_budget.record(thread_id, state["messages"], messages, response)
+            if reason is None:
+                return {"messages": [response]}
+
+        # 上限に達した場合は、ツールを利用できないモデルで最終的な回答を作成させる
+        final_chain = final_model_chain if final_model_chain is not None else model_chain
+        response = await final_chain.ainvoke(turn_budget.force_final_messages(messages, reason))
+        return {"messages": [turn_budget.strip_tool_calls(response, reason)]}
+
+
+    # tool_executorを指定した場合は、ToolNodeの代わりに複数のtool_callsをサーバをまたいで並列に実行する
+    tool_node = tool_executor if tool_executor is not None else ToolNode(tools)
+
+    async def call_tools(state: state, config):
+        result = await tool_node.ainvoke(state, config)
+        messages = result["messages"]
+        # ツールの出力を履歴に追加する前に縮める（全文はtool_output_processorのストアに保存される）
+        if tool_output_processor is not None:
+            messages = tool_output_processor(messages, (config.get("configurable") or {}).get("thread_id"))
+        return {"messages": messages}
 
-
-    tool_node = ToolNode(tools)
-    
     workflow = StateGraph(state)
     workflow.add_node("agent", call_model)
-    workflow.add_node("tools", tool_node)
+    workflow.add_node("tools", call_tools if (tool_output_processor is not None or tool_executor is not None) else tool_node)
 
     workflow.add_edge(START, "agent")
     workflow.add_conditional_edges("agent", should_continue, ["tools", END])
     workflow.add_edge("tools", "agent")
-    memory = MemorySaver()
-    app = workflow.compile(checkpointer=memory)
+    # checkpointerを指定しない場合は、プロセス内のメモリに保存する（再起動すると会話は失われる）
+    if checkpointer is None:
+        checkpointer = MemorySaver()
+    app = workflow.compile(checkpointer=checkpointer)
     
     return app
 
 
 
-async def main(graph_config = {"configurable": {"thread_id": "12345"}}):
-    # モデルの定義。APIキーは環境変数から取得
-    model = ChatGoogleGenerativeAI(
-        model="gemini-2.0-flash",
-        google_api_key=google_api_key,
-        temperature=0.001,
-        )
-
-    with open("mcp_config.json", "r") as f:
-        mcp_config = json.load(f)
-
-    # messageを作成する
-    message = [
-        SystemMessage(content= """
+SYSTEM_PROMPT = """
 あなたは役にたつAIアシスタントです。日本語で回答し、考えた過程を結論より前に出力してください。
 あなたは、「PlayWrite」というブラウザを操作するtoolを利用することができます。適切に利用してユーザからの質問に回答してください。
 ツールを利用する場合は、必ずツールから得られた情報のみを利用して回答してください。
 
 まず、ユーザの質問からツールをどういう意図で何回利用しないといけないのかを判断し、必要なら複数回toolを利用して情報収集をしたのち、すべての情報が取得できたら、その情報を元に返答してください。
+互いに依存しない複数のページを取得する場合は、1回の応答でまとめてtoolを呼び出してください（並列に実行されます）。
+ページの内容（記事のタイトル・いいねの数・本文など）を読むだけの場合は、read_pageを利用してください。クリックなどの操作が必要な場合だけ、ブラウザのtoolを利用してください。
 
 なお、サイトのアクセスでエラーが出た場合は、もう一度再施行してください。ネットワーク関連のエラーの場合があります。
-    """),
+"""
+
+
+def build_agent(model, mcp_client, replica_groups, checkpointer=None, prompt_cache=None, planner=None):
+    """
+    MCPクライアントのツールを利用するエージェントのグラフを作成する関数
+    対話モード（main）とサーバモード（agent_server.py）で共通して利用する
+    prompt_cache（PrefixCacheManager）を指定した場合は、システムプロンプトとツールの定義をプロバイダのキャッシュから参照する
+    planner_graphは、計画 → サブタスクの並列実行 → まとめのグラフ（planner_graph.py）。graphと同じ会話の履歴を利用する
+    plannerを省略した場合は、modelに計画を作成させる
+    最終的な出力は、graph, planner_graph, tool_router, turn_budget, history_manager, tool_output_processor, tool_executor,
+    page_extractorの辞書
+    """
+    # messageを作成する
+    message = [
+        SystemMessage(content=SYSTEM_PROMPT),
         MessagesPlaceholder("messages"),
     ]
 
     # messageからプロンプトを作成
     prompt = ChatPromptTemplate.from_messages(message)
 
-    async with MultiServerMCPClient(mcp_config["mcpServers"]) as mcp_client:
-        tools = mcp_client.get_tools()
+    # 会話履歴の管理方法
+    # "trim": 古いメッセージから削除 / "elide_tools": 古いツールの出力を省略 / "summarize": 古い会話を要約
+    history_manager = HistoryManager(
+        max_tokens=30000,
+        policy="elide_tools",
+        keep_last_tool_messages=2,
+        summarizer=model,
+    )
+
+    # ツールの出力の後処理（不要な行の削除・重複の省略・文字数の上限）
+    tool_output_processor = ToolOutputProcessor(
+        max_chars=8000,
+        max_chars_per_tool={"browser_snapshot": 12000, "browser_navigate": 12000},
+    )
+
+    # 同じページの取得結果を再利用する（{ツール名: 有効期限の秒数}。指定したツールだけをキャッシュする）
+    tool_cache = ToolResultCache(ttl_per_tool={"browser_navigate": 600, "read_page": 600}, max_entries=256)
+
+    # ページのメタデータと本文だけを返すツール（read_page）。静的なページはブラウザを使わずにHTTPで取得し、
+    # 本文を取り出せない場合は、その会話のブラウザでbrowser_navigateを実行して取得する
+    # 同じターンに同じブラウザの呼び出し（browser_clickなど）がある場合は、それらが終わってからページを移動する
+    async def browser_fetch(url, thread_id):
+        await tool_executor.wait_for_batch(thread_id, "browser_navigate")
+        tool_call = {"name": "browser_navigate", "args": {"url": url}, "id": f"read_page_{uuid.uuid4().hex[:12]}"}
+        result = await tool_executor.ainvoke(
+            {"messages": [AIMessage(content="", tool_calls=[tool_call])]}, {"configurable": {"thread_id": thread_id}})
+        output = result["messages"][0]
+        if output.status == "error":
+            raise RuntimeError(output.content)
+        return str(output.content)
+
+    page_extractor = PageExtractor(browser_fetch=browser_fetch, max_chars=6000)
+
+    # サーバごとの同時実行数。Playwrightは1つのブラウザで1件ずつ処理する
+    # 省略されたツールの出力の全文を取得し直すためのツールも追加する
+    tool_executor = ParallelToolExecutor(
+        mcp_client.server_name_to_tools,
+        replica_groups=replica_groups,
+        max_concurrency={"playwright": 1, "notionApi": 4},
+        extra_tools=[tool_output_processor.fetch_tool, page_extractor.tool],
+        tool_cache=tool_cache,
+    )
+    tools = tool_executor.tools
+
+    def bind_chain(selected):
+        chain = prompt | model.bind_tools(selected)
+        if prompt_cache is None:
+            return chain
+        # 毎回同じ先頭（システムプロンプトとツールの定義）はキャッシュを参照し、キャッシュできない場合はchainで実行する
+        # キャッシュには選んだツールではなく全てのツールを登録し、ツールの選び方ごとに別のキャッシュを作らないようにする
+        # （キャッシュしたツールの定義は割引された単価と保存期間の料金で課金されるため、選び方ごとに作るより1つを使い回す方が安い）
+        return prompt_cache.wrap(model, SYSTEM_PROMPT, tools, fallback=chain)
+
+    model_with_tools = bind_chain(tools)
+    # 質問に関係のあるツールだけをbindする（ページの取得・表示・本文の取得と、省略された出力の取得は常に含める）
+    tool_router = ToolRouter(tools, bind_chain, max_tools=10)
+    # 上限に達した場合に最終的な回答を作成させるモデル（ツールの定義は渡すが、呼び出しはさせない）
+    final_model = prompt | model.bind_tools(tools, tool_choice="none")
+
+    # 1ターンあたりの上限。ツールの呼び出しがループした場合も、この範囲で回答を打ち切る
+    turn_budget = TurnBudget(max_steps=10, max_seconds=180, max_tokens=300_000, max_repeated_calls=2)
+
+    # ReActのグラフと計画のグラフで、同じ会話の履歴を利用する
+    if checkpointer is None:
+        checkpointer = MemorySaver()
+
+    graph = create_graph(
+        GraphState,
+        tools,
+        model_with_tools,
+        history_manager=history_manager,
+        tool_output_processor=tool_output_processor,
+        tool_executor=tool_executor,
+        checkpointer=checkpointer,
+        turn_budget=turn_budget,
+        final_model_chain=final_model,
+        tool_router=tool_router,
+    )
+    planner_graph = create_planner_graph(
+        PlannerState,
+        planner if planner is not None else make_llm_planner(model),
+        model_with_tools,
+        prompt | model,
+        tool_executor,
+        tool_output_processor=tool_output_processor,
+        history_manager=history_manager,
+        tool_router=tool_router,
+        final_model_chain=final_model,
+        checkpointer=checkpointer,
+    )
+    return {
+        "graph": graph,
+        "planner_graph": planner_graph,
+        "tool_router": tool_router,
+        "turn_budget": turn_budget,
+        "history_manager": history_manager,
+        "tool_output_processor": tool_output_processor,
+        "tool_executor": tool_executor,
+        "page_extractor": page_extractor,
+    }
+
+
+def dump_state(path, values):
+    """
+    デバッグ用に、会話の状態（全てのメッセージ）をファイルに追記する関数
+    """
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(f"{values}\n")
 
-        model_with_tools = prompt | model.bind_tools(tools)
 
-        graph = create_graph(
-            GraphState,
-            tools,
-            model_with_tools
+async def main(graph_config = {"configurable": {"thread_id": "12345"}}):
+    boot_start = time.perf_counter()
+
+    # ========== 設定 ==========
+    # Trueの場合は、モデルの出力をトークンごとに表示し、ツールの進捗も表示する
+    stream = True
+    # デバッグ用に、各ターンの終了後に会話の状態を出力するファイル（Noneの場合は出力しない）
+    debug_dump_path = None
+    # グラフのノード・モデル・ツール・MCPサーバごとの処理時間を記録するファイル（Noneの場合は記録しない）
+    # 集計は python trace_summary.py traces/agent_trace.jsonl で行う
+    trace_path = "traces/agent_trace.jsonl"
+    # Trueの場合は、システムプロンプトとツールの定義をGeminiのContext Cachingに登録して使い回す
+    use_context_cache = True
+    # この文字列で始まる入力は、質問をサブタスクに分割して並列に実行するグラフ（planner_graph.py）で回答する
+    # 例: "/plan 次の3つの記事を比較して https://... https://... https://..."
+    planner_prefix = "/plan "
+    # =========================
+
+    tracer = None
+    if trace_path:
+        tracer = TraceRecorder(trace_path)
+        graph_config = {**graph_config, "callbacks": [tracer]}
+
+    # モデルの定義。APIキーは環境変数から取得
+    model = ChatGoogleGenerativeAI(
+        model="gemini-2.0-flash",
+        google_api_key=google_api_key,
+        temperature=0.001,
         )
 
+    with open("mcp_config.json", "r") as f:
+        mcp_config = json.load(f)
+
+    # 会話のチェックポイントをSQLiteに保存する（再起動後も同じthread_idで会話を再開できる）
+    checkpointer = SQLiteDeltaSaver("checkpoints/agent.sqlite")
+    # 30日以上更新のない会話と、各会話の古いチェックポイントを削除する
+    print(f"チェックポイントの削除: {checkpointer.gc(max_age_seconds=30 * 24 * 3600, keep_last=50)}")
+
+    # 1ターンに複数のページを取得する場合に並列に実行できるように、Playwright MCPを複数起動する（それぞれ別のブラウザになる）
+    mcp_servers, replica_groups = expand_replicas(mcp_config["mcpServers"], {"playwright": 3})
+
+    # MCPサーバを並行して起動する。ツールのスキーマのキャッシュがある場合は、サーバの起動を待たずに入力を受け付ける
+    prompt_cache = None
+    if use_context_cache:
+        prompt_cache = PrefixCacheManager(GeminiContextCacheBackend(google_api_key, model.model), ttl_seconds=600)
+
+    async with MCPServerPool(mcp_servers) as mcp_pool:
+        agent = build_agent(model, mcp_pool, replica_groups, checkpointer, prompt_cache)
+        graph = agent["graph"]
+        history_manager = agent["history_manager"]
+        tool_output_processor = agent["tool_output_processor"]
+        print(f"（起動から入力を受け付けるまで: {time.perf_counter() - boot_start:.2f}秒）")
+        first_answer = True
 
         while True:
-            query = input("入力してください: ") 
+            # input()はイベントループを止めるため、別スレッドで待つ（待っている間もMCPサーバの起動やpingを続ける）
+            query = await asyncio.to_thread(input, "入力してください: ")
 
             if query.lower() in ["exit", "quit"]:
                 print("終了します。")
+                if prompt_cache is not None:
+                    await prompt_cache.close()
+                await agent["page_extractor"].close()
                 break
 
+            turn_graph = graph
+            if planner_prefix and query.startswith(planner_prefix):
+                turn_graph = agent["planner_graph"]
+                query = query[len(planner_prefix):]
+
             input_query = [HumanMessage(
                     [
                         {
@@ -111,18 +328,48 @@ async def main(graph_config = {"configurable": {"thread_id": "12345"}}):
                     ]
                 )]
 
-            response = await graph.ainvoke({"messages":input_query}, graph_config)
-
-            #デバック用
-            print("response: ", response)
-
-            # 最終的な回答
+            query_start = time.perf_counter()
             print("=================================")
-            print(response["messages"][-1].content)
-
+            if stream:
+                async for event in astream_turn(turn_graph, {"messages": input_query}, graph_config):
+                    if event["type"] == "token":
+                        print(event["text"], end="", flush=True)
+                    elif event["type"] == "tool_start":
+                        print(f"\n[ツール実行中] {event['name']} {event['args']}", flush=True)
+                    elif event["type"] == "tool_end":
+                        print(f"[ツール完了] {event['name']} ({event['status']}, {event['chars']}文字, {event['seconds']:.2f}秒)", flush=True)
+                    elif event["type"] == "final":
+                        ttft = event["ttft"]
+                print()
+                if ttft is not None:
+                    print(f"（最初の出力までの時間: {ttft:.2f}秒）")
+            else:
+                response = await turn_graph.ainvoke({"messages":input_query}, graph_config)
+                # 最終的な回答
+                print(response["messages"][-1].content)
+
+            print(f"（履歴のトークン数(推定): {history_manager.last_stats.get('before_tokens')} -> {history_manager.last_stats.get('after_tokens')}）")
+            print(f"（ツール出力の文字数: {tool_output_processor.stats['before_chars']} -> {tool_output_processor.stats['after_chars']}）")
+            print(f"（ツールのキャッシュ: {agent['tool_executor'].tool_cache.summary()}）")
+            print(f"（bindしたツールのスキーマのトークン数(推定): {agent['tool_router'].summary()}）")
+            print(f"（read_pageの取得: {agent['page_extractor'].summary()}）")
+            if prompt_cache is not None:
+                print(f"（プロンプトのキャッシュ: {prompt_cache.summary()}）")
+            print(f"（このターン: {agent['turn_budget'].turn_stats(graph_config['configurable']['thread_id'])}、"
+                  f"終了理由の累計: {dict(agent['turn_budget'].stop_reasons)}）")
+            if tracer is not None:
+                tracer.flush()
+            if first_answer:
+                first_answer = False
+                startup = {name: s["startup_seconds"] for name, s in mcp_pool.stats()["servers"].items()}
+                print(f"（最初の回答までの時間: {time.perf_counter() - query_start:.2f}秒、MCPサーバの起動時間: {startup}）")
+
+            # デバック用（回答の表示が終わってから、別スレッドでファイルに出力する）
+            if debug_dump_path:
+                state = await graph.aget_state(graph_config)
+                await asyncio.to_thread(dump_state, debug_dump_path, state.values)
 
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())
 
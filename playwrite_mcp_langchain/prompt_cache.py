@@ -0,0 +1,283 @@
+import re
+import time
+import json
+import asyncio
+import hashlib
+import datetime
+from collections import OrderedDict
+
+from langchain_core.messages import SystemMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from tool_router import schema_tokens
+
+
+# キャッシュ（cachedContents）を指すエラーメッセージ。例: "CachedContent not found (or permission denied)"
+CACHED_CONTENT_PATTERN = re.compile(r"(?i)cached[_ ]?contents?")
+
+
+def prefix_key(model_name, system_prompt, tools):
+    """
+    モデル名・システムプロンプト・ツールのスキーマから、キャッシュのキーを作成する関数
+    """
+    schemas = [convert_to_openai_tool(tool) for tool in tools]
+    data = json.dumps([model_name, system_prompt, schemas], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class GeminiContextCacheBackend:
+    """
+    GeminiのContext Caching（cachedContents）を利用するバックエンド
+    システムプロンプト（system_instruction）とツールの定義（tools）を保存し、名前（"cachedContents/..."）を返す
+    """
+
+    def __init__(self, api_key, model="gemini-2.0-flash"):
+        from google.ai.generativelanguage_v1beta import CacheServiceAsyncClient
+
+        self.model = model if model.startswith("models/") else f"models/{model}"
+        self.client = CacheServiceAsyncClient(client_options={"api_key": api_key})
+
+    async def create(self, system_prompt, tools, ttl_seconds):
+        """
+        キャッシュを作成し、(名前, 有効期限のUNIX時刻) を返す
+        """
+        from google.ai.generativelanguage_v1beta import CachedContent, Content, Part
+        from langchain_google_genai._function_utils import convert_to_genai_function_declarations
+
+        content = CachedContent(
+            model=self.model,
+            system_instruction=Content(parts=[Part(text=system_prompt)]),
+            tools=[convert_to_genai_function_declarations(tools)] if tools else [],
+            ttl=datetime.timedelta(seconds=ttl_seconds),
+        )
+        result = await self.client.create_cached_content(cached_content=content)
+        return result.name, result.expire_time.timestamp()
+
+    async def refresh(self, name, ttl_seconds):
+        """
+        キャッシュの有効期限を延長し、新しい有効期限のUNIX時刻を返す
+        """
+        from google.ai.generativelanguage_v1beta import CachedContent
+        from google.protobuf.field_mask_pb2 import FieldMask
+
+        result = await self.client.update_cached_content(
+            cached_content=CachedContent(name=name, ttl=datetime.timedelta(seconds=ttl_seconds)),
+            update_mask=FieldMask(paths=["ttl"]),
+        )
+        return result.expire_time.timestamp()
+
+    async def delete(self, name):
+        await self.client.delete_cached_content(name=name)
+
+    @staticmethod
+    def is_cache_error(error):
+        """
+        モデルの呼び出しのエラーが、キャッシュを参照できないこと（削除済み・有効期限切れ）によるものか判定する
+        NotFound・PermissionDenied・InvalidArgumentのうち、メッセージがcachedContentを指しているものだけをキャッシュのエラーとする
+        （履歴の誤りやトークン数の超過などのInvalidArgumentは、キャッシュなしで実行し直しても解決しないため）
+        langchain_google_genaiはInvalidArgumentをChatGoogleGenerativeAIErrorで包むため、原因のエラーもたどる
+        """
+        from google.api_core.exceptions import InvalidArgument, NotFound, PermissionDenied
+
+        while error is not None:
+            if isinstance(error, (NotFound, PermissionDenied, InvalidArgument)):
+                return CACHED_CONTENT_PATTERN.search(str(error)) is not None
+            error = error.__cause__
+        return False
+
+
+class LocalContextCacheBackend:
+    """
+    APIを呼び出さずにキャッシュの作成・延長・削除を再現するバックエンド（モックやベンチマーク用）
+    min_tokensより短いプレフィックスは、Geminiと同様に作成を失敗させる
+    """
+
+    def __init__(self, min_tokens=0, latency=0.0):
+        self.min_tokens = min_tokens
+        self.latency = latency
+        # 名前 -> 有効期限のUNIX時刻
+        self.entries = {}
+        self.calls = {"create": 0, "refresh": 0, "delete": 0}
+
+    async def create(self, system_prompt, tools, ttl_seconds):
+        self.calls["create"] += 1
+        await asyncio.sleep(self.latency)
+        tokens = count_tokens_approximately([SystemMessage(content=system_prompt)]) + sum(schema_tokens(t) for t in tools)
+        if tokens < self.min_tokens:
+            raise ValueError(f"キャッシュするトークン数が少なすぎます: {tokens} < {self.min_tokens}")
+        name = f"cachedContents/local-{self.calls['create']}"
+        self.entries[name] = time.time() + ttl_seconds
+        return name, self.entries[name]
+
+    async def refresh(self, name, ttl_seconds):
+        self.calls["refresh"] += 1
+        await asyncio.sleep(self.latency)
+        if self.entries.get(name, 0) < time.time():
+            self.entries.pop(name, None)
+            raise LookupError(f"{name}は存在しないか、有効期限が切れています。")
+        self.entries[name] = time.time() + ttl_seconds
+        return self.entries[name]
+
+    async def delete(self, name):
+        self.calls["delete"] += 1
+        self.entries.pop(name, None)
+
+    @staticmethod
+    def is_cache_error(error):
+        return isinstance(error, LookupError)
+
+
+class PrefixCacheManager:
+    """
+    毎回同じ内容になる入力の先頭（システムプロンプトとツールの定義）を、プロバイダのキャッシュに登録して使い回すクラス
+    - 同じモデル・システムプロンプト・ツールの組み合わせは、全ての会話で1つのキャッシュを共有する
+    - max_entriesを超えて追い出したキャッシュは、プロバイダ側からも削除する（有効期限まで課金されないように）
+    - 有効期限（ttl_seconds）の残りがrefresh_margin秒を切ったキャッシュは、利用する時に延長する
+      利用されなくなったキャッシュは延長しないため、有効期限が来るとプロバイダ側で削除される
+    - 作成に失敗した組み合わせ（トークン数が最小値に満たない場合など）と、作成してretry_after秒以内に参照できなくなった組み合わせは、
+      retry_after秒の間キャッシュせずに実行する
+
+    statsのcache_read_tokensは、usage_metadataのinput_token_details["cache_read"]の累計
+    """
+
+    def __init__(self, backend, ttl_seconds=600, refresh_margin=120, retry_after=300, max_entries=64):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin = refresh_margin
+        self.retry_after = retry_after
+        self.max_entries = max_entries
+        # キー -> {"name": キャッシュの名前, "expire": 有効期限のUNIX時刻, "created": 作成した時刻}
+        self.entries = OrderedDict()
+        # キー -> 作成に失敗した（または作成した直後に参照できなくなった）時刻
+        self.failures = {}
+        self.locks = {}
+        self.deleting = set()
+        self.stats = {"hits": 0, "creates": 0, "refreshes": 0, "deletes": 0, "fallbacks": 0, "errors": 0,
+                      "cache_read_tokens": 0}
+
+    async def get(self, key, system_prompt, tools):
+        """
+        キャッシュの名前を返す。キャッシュできない場合はNoneを返す
+        """
+        failed = self.failures.get(key)
+        if failed is not None and time.time() - failed < self.retry_after:
+            return None
+
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self.entries.get(key)
+            now = time.time()
+            if entry is not None and entry["expire"] - now < self.refresh_margin:
+                try:
+                    entry["expire"] = await self.backend.refresh(entry["name"], self.ttl_seconds)
+                    self.stats["refreshes"] += 1
+                except Exception:
+                    # 有効期限が切れて削除されていた場合は作成し直す
+                    self.entries.pop(key, None)
+                    entry = None
+            if entry is None:
+                try:
+                    name, expire = await self.backend.create(system_prompt, tools, self.ttl_seconds)
+                except Exception:
+                    self.failures[key] = now
+                    self.stats["errors"] += 1
+                    return None
+                self.failures.pop(key, None)
+                self.stats["creates"] += 1
+                entry = {"name": name, "expire": expire, "created": now}
+                self.entries[key] = entry
+                while len(self.entries) > self.max_entries:
+                    _, evicted = self.entries.popitem(last=False)
+                    self._delete_later(evicted["name"])
+            else:
+                self.stats["hits"] += 1
+            self.entries.move_to_end(key)
+            return entry["name"]
+
+    def _delete_later(self, name):
+        # 呼び出し中のターンを待たせないように、削除はバックグラウンドで行う
+        task = asyncio.get_running_loop().create_task(self._delete(name))
+        self.deleting.add(task)
+        task.add_done_callback(self.deleting.discard)
+
+    async def _delete(self, name):
+        try:
+            await self.backend.delete(name)
+            self.stats["deletes"] += 1
+        except Exception:
+            # 削除できなくても、有効期限が来るとプロバイダ側で削除される
+            pass
+
+    def invalidate(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            # 参照できなかったキャッシュがプロバイダ側に残っている場合に備えて、削除する
+            self._delete_later(entry["name"])
+            if time.time() - entry["created"] < self.retry_after:
+                # 作成した直後のキャッシュも参照できない場合は、呼び出しのたびに作成し直さないようにしばらくキャッシュしない
+                self.failures[key] = time.time()
+
+    def is_cache_error(self, error):
+        return self.backend.is_cache_error(error)
+
+    def record(self, response):
+        usage = getattr(response, "usage_metadata", None) or {}
+        self.stats["cache_read_tokens"] += (usage.get("input_token_details") or {}).get("cache_read", 0)
+
+    def wrap(self, model, system_prompt, tools, fallback):
+        """
+        キャッシュを利用してモデルを呼び出すチェーンを作成する
+        fallbackは、キャッシュを利用できない場合に実行するチェーン（prompt | model.bind_tools(tools)）
+        """
+        return CachedPrefixChain(self, model, system_prompt, tools, fallback)
+
+    async def close(self):
+        """
+        登録したキャッシュを削除する（削除しなくても有効期限が来るとプロバイダ側で削除される）
+        """
+        if self.deleting:
+            await asyncio.gather(*self.deleting)
+        for entry in list(self.entries.values()):
+            try:
+                await self.backend.delete(entry["name"])
+            except Exception:
+                pass
+        self.entries.clear()
+
+    def summary(self):
+        return {**self.stats, "entries": len(self.entries)}
+
+
+class CachedPrefixChain:
+    """
+    システムプロンプトとツールの定義をキャッシュから参照してモデルを呼び出すチェーン
+    キャッシュを参照する場合は、入力にシステムプロンプトを含めず、ツールもbindしない（キャッシュ側に含まれるため）
+    """
+
+    def __init__(self, manager, model, system_prompt, tools, fallback):
+        self.manager = manager
+        self.model = model
+        self.system_prompt = system_prompt
+        self.tools = list(tools)
+        self.fallback = fallback
+        self.key = prefix_key(getattr(model, "model", type(model).__name__), system_prompt, self.tools)
+        self.schema_tokens = sum(schema_tokens(tool) for tool in self.tools)
+
+    async def ainvoke(self, messages, config=None):
+        name = await self.manager.get(self.key, self.system_prompt, self.tools)
+        if name is not None:
+            try:
+                response = await self.model.ainvoke(messages, config, cached_content=name)
+                self.manager.record(response)
+                # キャッシュを参照したことを記録する（ToolRouterは、選んだツールのスキーマを送っていない呼び出しとして集計する）
+                response.response_metadata["prompt_cache"] = {"name": name, "schema_tokens": self.schema_tokens}
+                return response
+            except Exception as e:
+                # 有効期限が切れた直後などでキャッシュを参照できない場合は、キャッシュなしで実行し直す
+                if not self.manager.is_cache_error(e):
+                    raise
+                self.manager.invalidate(self.key)
+                self.manager.stats["errors"] += 1
+        self.manager.stats["fallbacks"] += 1
+        return await self.fallback.ainvoke(messages, config)
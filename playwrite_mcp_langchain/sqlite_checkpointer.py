@@ -0,0 +1,418 @@
+import os
+import time
+import zlib
+import random
+import sqlite3
+import asyncio
+import threading
+from collections import OrderedDict
+
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+from langgraph.checkpoint.serde.types import TASKS
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    checkpoint_id TEXT NOT NULL,
+    parent_checkpoint_id TEXT,
+    type TEXT,
+    checkpoint BLOB,
+    metadata_type TEXT,
+    metadata BLOB,
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    channel TEXT NOT NULL,
+    version TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    base_version TEXT,
+    type TEXT,
+    data BLOB,
+    PRIMARY KEY (thread_id, checkpoint_ns, channel, version)
+);
+CREATE TABLE IF NOT EXISTS writes (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    checkpoint_id TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    channel TEXT NOT NULL,
+    type TEXT,
+    data BLOB,
+    task_path TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+);
+CREATE TABLE IF NOT EXISTS threads (
+    thread_id TEXT PRIMARY KEY,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS threads_updated_at ON threads (updated_at);
+"""
+
+
+class SQLiteDeltaSaver(BaseCheckpointSaver):
+    """
+    MemorySaverの代わりに、会話のチェックポイントをSQLite（WALモード）に保存するクラス
+    - プロセスを再起動しても、同じthread_idで会話を再開できる
+    - messagesのように追記されるだけのリストは、前のバージョンとの差分（追加されたメッセージ）だけを保存する
+      （読み込み時は、差分をたどって元のリストに戻す。full_every回ごとに全体を保存し、たどる回数を抑える）
+    - compress_thresholdバイトを超えるデータはzlibで圧縮する
+    - gcで、一定期間更新のないスレッドや古いチェックポイントを削除する
+    差分を求めるために覚えておくリストは、最近保存・読み込みしたmax_cached_lists件（チャネルごと）だけにする
+    （覚えていない会話の次の保存は、全体を保存する）
+    """
+
+    def __init__(self, path="checkpoints/agent.sqlite", full_every=20, compress_threshold=1024, serde=None,
+                 max_cached_lists=64):
+        super().__init__(serde=serde)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.full_every = full_every
+        self.compress_threshold = compress_threshold
+        self.max_cached_lists = max_cached_lists
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        # (thread_id, checkpoint_ns, channel) -> (バージョン, リストのコピー, 全体を保存してからの差分の数)
+        # 直前に保存・読み込みしたリストを覚えておき、次の保存で差分を求めるために利用する
+        # 会話の数だけメモリが増えないように、最後に利用した順にmax_cached_lists件だけ残す
+        self.last_lists = OrderedDict()
+        self.stats = {"full_writes": 0, "delta_writes": 0, "bytes_written": 0}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    # ========== シリアライズ ==========
+
+    def _dumps(self, value):
+        type_, data = self.serde.dumps_typed(value)
+        if len(data) > self.compress_threshold:
+            type_, data = f"{type_}+zlib", zlib.compress(data)
+        self.stats["bytes_written"] += len(data)
+        return type_, data
+
+    def _loads(self, type_, data):
+        if type_.endswith("+zlib"):
+            type_, data = type_[:-len("+zlib")], zlib.decompress(data)
+        return self.serde.loads_typed((type_, data))
+
+    def _remember_list(self, key, entry):
+        self.last_lists[key] = entry
+        self.last_lists.move_to_end(key)
+        while len(self.last_lists) > self.max_cached_lists:
+            self.last_lists.popitem(last=False)
+
+    def _dump_channel(self, thread_id, checkpoint_ns, channel, version, value):
+        """
+        チャネルの値を保存する行（kind, base_version, type, data）を作成する
+        前回保存したリストの後ろに追記されただけの場合は、追記された部分だけを保存する
+        """
+        key = (thread_id, checkpoint_ns, channel)
+        last = self.last_lists.get(key)
+        if isinstance(value, list):
+            self._remember_list(key, (version, list(value), 0))
+            if (last is not None and last[2] + 1 < self.full_every and len(value) >= len(last[1])
+                    and all(a is b or a == b for a, b in zip(last[1], value))):
+                self._remember_list(key, (version, list(value), last[2] + 1))
+                self.stats["delta_writes"] += 1
+                return ("delta", last[0], *self._dumps(value[len(last[1]):]))
+        else:
+            self.last_lists.pop(key, None)
+        self.stats["full_writes"] += 1
+        return ("full", None, *self._dumps(value))
+
+    def _load_channel(self, thread_id, checkpoint_ns, channel, version):
+        """
+        チャネルの値を読み込む。差分の場合は、全体を保存したバージョンまでたどって結合する
+        値が存在しない場合は、(False, None)を返す
+        差分の元のバージョンが欠けている場合は、途中までの値を返さずにRuntimeErrorを送出する
+        """
+        deltas = []
+        current = version
+        while True:
+            row = self.conn.execute(
+                "SELECT kind, base_version, type, data FROM blobs "
+                "WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND version = ?",
+                (thread_id, checkpoint_ns, channel, current),
+            ).fetchone()
+            if not deltas and (row is None or row[0] == "empty"):
+                return False, None
+            if row is None or row[0] == "empty":
+                # 差分だけでは元のリストに戻せないため、チャネルが存在しないものとして扱わない
+                self.last_lists.pop((thread_id, checkpoint_ns, channel), None)
+                raise RuntimeError(
+                    f"チェックポイントの差分の元が見つかりません: thread_id={thread_id}, channel={channel}, "
+                    f"version={version}, 欠けているバージョン={current}")
+            kind, base_version, type_, data = row
+            if kind == "full":
+                value = self._loads(type_, data)
+                break
+            deltas.append(self._loads(type_, data))
+            current = base_version
+
+        if deltas:
+            value = list(value)
+            for delta in reversed(deltas):
+                value.extend(delta)
+        if isinstance(value, list):
+            self._remember_list((thread_id, checkpoint_ns, channel), (version, list(value), len(deltas)))
+        return True, value
+
+    # ========== 読み込み ==========
+
+    def _build_tuple(self, row):
+        thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type_, checkpoint, metadata_type, metadata = row
+        checkpoint = self._loads(type_, checkpoint)
+
+        channel_values = {}
+        for channel, version in checkpoint["channel_versions"].items():
+            found, value = self._load_channel(thread_id, checkpoint_ns, channel, version)
+            if found:
+                channel_values[channel] = value
+
+        writes = self.conn.execute(
+            "SELECT task_id, channel, type, data FROM writes "
+            "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? ORDER BY task_id, idx",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        ).fetchall()
+        pending_sends = []
+        if parent_checkpoint_id:
+            sends = self.conn.execute(
+                "SELECT type, data FROM writes "
+                "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? AND channel = ? "
+                "ORDER BY task_path, task_id, idx",
+                (thread_id, checkpoint_ns, parent_checkpoint_id, TASKS),
+            ).fetchall()
+            pending_sends = [self._loads(t, d) for t, d in sends]
+
+        def make_config(checkpoint_id):
+            return {"configurable": {
+                "thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id,
+            }}
+
+        return CheckpointTuple(
+            config=make_config(checkpoint_id),
+            checkpoint={**checkpoint, "channel_values": channel_values, "pending_sends": pending_sends},
+            metadata=self._loads(metadata_type, metadata),
+            parent_config=make_config(parent_checkpoint_id) if parent_checkpoint_id else None,
+            pending_writes=[(task_id, channel, self._loads(t, d)) for task_id, channel, t, d in writes],
+        )
+
+    def get_tuple(self, config):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        query = ("SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint, "
+                 "metadata_type, metadata FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?")
+        params = [thread_id, checkpoint_ns]
+        if checkpoint_id := get_checkpoint_id(config):
+            query += " AND checkpoint_id = ?"
+            params.append(checkpoint_id)
+        else:
+            query += " ORDER BY checkpoint_id DESC LIMIT 1"
+        with self.lock:
+            row = self.conn.execute(query, params).fetchone()
+            return self._build_tuple(row) if row else None
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        query = ("SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint, "
+                 "metadata_type, metadata FROM checkpoints WHERE 1 = 1")
+        params = []
+        if config:
+            query += " AND thread_id = ?"
+            params.append(config["configurable"]["thread_id"])
+            if (checkpoint_ns := config["configurable"].get("checkpoint_ns")) is not None:
+                query += " AND checkpoint_ns = ?"
+                params.append(checkpoint_ns)
+            if checkpoint_id := get_checkpoint_id(config):
+                query += " AND checkpoint_id = ?"
+                params.append(checkpoint_id)
+        if before and (before_id := get_checkpoint_id(before)):
+            query += " AND checkpoint_id < ?"
+            params.append(before_id)
+        query += " ORDER BY checkpoint_id DESC"
+
+        # メタデータでの絞り込みはPython側で行うため、結果を1件ずつ読み込む
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        for row in rows:
+            if limit is not None and limit <= 0:
+                break
+            metadata = self._loads(row[6], row[7])
+            if filter and not all(metadata.get(k) == v for k, v in filter.items()):
+                continue
+            if limit is not None:
+                limit -= 1
+            with self.lock:
+                item = self._build_tuple(row)
+            yield item
+
+    # ========== 書き込み ==========
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        c = checkpoint.copy()
+        c.pop("pending_sends", None)
+        values = c.pop("channel_values")
+
+        with self.lock:
+            try:
+                blob_rows = []
+                for channel, version in new_versions.items():
+                    if channel in values:
+                        row = self._dump_channel(thread_id, checkpoint_ns, channel, version, values[channel])
+                    else:
+                        row = ("empty", None, None, None)
+                    blob_rows.append((thread_id, checkpoint_ns, channel, str(version), *row))
+                type_, data = self._dumps(c)
+                metadata_type, metadata_data = self._dumps(get_checkpoint_metadata(config, metadata))
+
+                # 1回のトランザクションで書き込み、途中で失敗した場合に差分の元が欠けないようにする
+                with self.conn:
+                    self.conn.execute("BEGIN")
+                    self.conn.executemany("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", blob_rows)
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (thread_id, checkpoint_ns, checkpoint["id"], config["configurable"].get("checkpoint_id"),
+                         type_, data, metadata_type, metadata_data),
+                    )
+                    self.conn.execute("INSERT OR REPLACE INTO threads VALUES (?, ?)", (thread_id, time.time()))
+            except Exception:
+                # 保存できなかったバージョンを差分の元にしないように、覚えているリストを破棄する
+                self.last_lists.clear()
+                raise
+
+        return {"configurable": {
+            "thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"],
+        }}
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        rows = []
+        with self.lock:
+            for idx, (channel, value) in enumerate(writes):
+                rows.append((thread_id, checkpoint_ns, checkpoint_id, task_id, WRITES_IDX_MAP.get(channel, idx),
+                             channel, *self._dumps(value), task_path))
+            # 特殊な書き込み（エラー等、idxが負のもの）は上書きし、通常の書き込みは最初の1回だけを保存する
+            verb = "INSERT OR REPLACE" if all(w[0] in WRITES_IDX_MAP for w in writes) else "INSERT OR IGNORE"
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.conn.executemany(f"{verb} INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def get_next_version(self, current, channel):
+        if current is None:
+            current_v = 0
+        elif isinstance(current, int):
+            current_v = current
+        else:
+            current_v = int(current.split(".")[0])
+        return f"{current_v + 1:032}.{random.random():016}"
+
+    # ========== 非同期版（SQLiteの読み書きでイベントループを止めないように、別スレッドで実行する） ==========
+
+    async def aget_tuple(self, config):
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        items = await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for item in items:
+            yield item
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path=""):
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    # ========== 削除 ==========
+
+    def delete_thread(self, thread_id):
+        with self.lock:
+            with self.conn:
+                self.conn.execute("BEGIN")
+                for table in ("checkpoints", "blobs", "writes", "threads"):
+                    self.conn.execute(f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+            for key in [k for k in self.last_lists if k[0] == thread_id]:
+                del self.last_lists[key]
+
+    def gc(self, max_age_seconds=None, keep_last=None):
+        """
+        不要になったチェックポイントを削除する関数
+        max_age_secondsは、最後の更新からこの秒数が経過したスレッドをすべて削除する
+        keep_lastは、スレッドごとに最新のkeep_last件より古いチェックポイントを削除する（最新の会話は残る）
+        最終的な出力は、削除したスレッド数とチェックポイント数の辞書
+        """
+        result = {"threads": 0, "checkpoints": 0}
+        if max_age_seconds is not None:
+            cutoff = time.time() - max_age_seconds
+            with self.lock:
+                old = [r[0] for r in self.conn.execute("SELECT thread_id FROM threads WHERE updated_at < ?", (cutoff,))]
+            for thread_id in old:
+                self.delete_thread(thread_id)
+            result["threads"] = len(old)
+
+        if keep_last is not None:
+            with self.lock:
+                result["checkpoints"] = self._prune_checkpoints(keep_last)
+                # 差分の元になるバージョンが削除されている可能性があるため、次の保存は全体を保存する
+                self.last_lists.clear()
+
+        with self.lock:
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return result
+
+    def _prune_checkpoints(self, keep_last):
+        deleted = 0
+        groups = self.conn.execute("SELECT DISTINCT thread_id, checkpoint_ns FROM checkpoints").fetchall()
+        for thread_id, checkpoint_ns in groups:
+            rows = self.conn.execute(
+                "SELECT checkpoint_id, type, checkpoint FROM checkpoints "
+                "WHERE thread_id = ? AND checkpoint_ns = ? ORDER BY checkpoint_id DESC",
+                (thread_id, checkpoint_ns),
+            ).fetchall()
+            if len(rows) <= keep_last:
+                continue
+            kept, removed = rows[:keep_last], rows[keep_last:]
+
+            # 残すチェックポイントが参照するバージョンと、その差分の元になるバージョンを残す
+            bases = dict(((channel, version), base) for channel, version, base in self.conn.execute(
+                "SELECT channel, version, base_version FROM blobs WHERE thread_id = ? AND checkpoint_ns = ?",
+                (thread_id, checkpoint_ns),
+            ))
+            referenced = set()
+            for _, type_, data in kept:
+                for channel, version in self._loads(type_, data)["channel_versions"].items():
+                    key = (channel, str(version))
+                    while key in bases and key not in referenced:
+                        referenced.add(key)
+                        key = (channel, bases[key]) if bases[key] else None
+            unreferenced = [(thread_id, checkpoint_ns, *key) for key in bases if key not in referenced]
+            removed_ids = [(thread_id, checkpoint_ns, r[0]) for r in removed]
+
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.conn.executemany(
+                    "DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?", removed_ids)
+                self.conn.executemany(
+                    "DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?", removed_ids)
+                self.conn.executemany(
+                    "DELETE FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND version = ?",
+                    unreferenced)
+            deleted += len(removed)
+        return deleted
@@ -0,0 +1,74 @@
+"""
+ベンチマーク用のスタブMCPサーバ（stdio）
+Playwright MCPと同じ名前のツールを持ち、指定した時間だけ待ってから指定した長さのテキストを返す
+環境変数:
+    STUB_LATENCY: ツール1回あたりの待ち時間（秒）
+    STUB_PAYLOAD_CHARS: ツールの出力の文字数
+    STUB_SERVER_NAME: サーバ名（出力に含める）
+"""
+import os
+import sys
+import asyncio
+
+from mcp.server.fastmcp import FastMCP
+
+
+LATENCY = float(os.getenv("STUB_LATENCY", "0.5"))
+PAYLOAD_CHARS = int(os.getenv("STUB_PAYLOAD_CHARS", "2000"))
+SERVER_NAME = os.getenv("STUB_SERVER_NAME", "stub")
+
+mcp = FastMCP(SERVER_NAME)
+
+
+def server_config(name, latency=0.5, payload_chars=2000):
+    """
+    MultiServerMCPClientに渡す、このスタブサーバの設定を作成する関数
+    """
+    return {
+        "command": sys.executable,
+        "args": [os.path.abspath(__file__)],
+        "transport": "stdio",
+        "env": {
+            "STUB_LATENCY": str(latency),
+            "STUB_PAYLOAD_CHARS": str(payload_chars),
+            "STUB_SERVER_NAME": name,
+        },
+    }
+
+
+# 1つのブラウザを共有している状態を再現するため、同じサーバ内では1件ずつ処理する
+browser_lock = asyncio.Lock()
+
+
+def make_payload(url):
+    header = f"- Page URL: {url}\n- Server: {SERVER_NAME}\n"
+    line = "- text \"スタブのページ本文です。\" [ref=e1]\n"
+    body = line * (max(PAYLOAD_CHARS - len(header), 0) // len(line) + 1)
+    return (header + body)[:max(PAYLOAD_CHARS, len(header))]
+
+
+@mcp.tool()
+async def browser_navigate(url: str) -> str:
+    """Navigate to a URL"""
+    async with browser_lock:
+        await asyncio.sleep(LATENCY)
+        return make_payload(url)
+
+
+@mcp.tool()
+async def browser_snapshot() -> str:
+    """Capture accessibility snapshot of the current page"""
+    async with browser_lock:
+        await asyncio.sleep(LATENCY)
+        return make_payload("about:current")
+
+
+@mcp.tool()
+async def search_pages(query: str) -> str:
+    """Search pages (stands in for a non-browser server such as notionApi)"""
+    await asyncio.sleep(LATENCY)
+    return make_payload(f"search:{query}")
+
+
+if __name__ == "__main__":
+    mcp.run()
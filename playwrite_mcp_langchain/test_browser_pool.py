@@ -0,0 +1,200 @@
+"""
+browser_pool_mcp_server.py のコンテキストの貸し出しのテスト
+Chromiumを起動せずに、ページ・コンテキストを置き換えた偽物のブラウザで確認する
+
+    python -m pytest test_browser_pool.py
+"""
+import asyncio
+
+from browser_pool_mcp_server import BrowserContextPool
+
+
+class FakePage:
+    def __init__(self, context):
+        self.context = context
+        self.url = "about:blank"
+        self.history = []
+
+    async def goto(self, url, wait_until=None):
+        await asyncio.sleep(0.01)
+        self.history.append(self.url)
+        self.url = url
+
+    async def go_back(self, wait_until=None):
+        self.url = self.history.pop()
+
+    def locator(self, selector):
+        return FakeLocator(self)
+
+    async def title(self):
+        return self.url
+
+
+class FakeLocator:
+    def __init__(self, page):
+        self.page = page
+
+    async def aria_snapshot(self):
+        # Cookieを持つコンテキストかどうかをスナップショットに含める
+        return f"- heading {self.page.url} cookies={sorted(self.page.context.cookies)}"
+
+
+class FakeContext:
+    def __init__(self, browser):
+        self.browser = browser
+        self.cookies = set()
+        self.closed = False
+
+    def set_default_timeout(self, timeout):
+        pass
+
+    async def route(self, pattern, handler):
+        pass
+
+    async def new_page(self):
+        return FakePage(self)
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeBrowser:
+    def __init__(self):
+        self.contexts = []
+
+    async def new_context(self):
+        context = FakeContext(self)
+        self.contexts.append(context)
+        return context
+
+
+def make_pool(**kwargs):
+    pool = BrowserContextPool(**kwargs)
+
+    async def start():
+        async with pool.start_lock:
+            if pool.browser is None:
+                pool.condition = asyncio.Condition()
+                pool.browser = FakeBrowser()
+                await asyncio.gather(*(pool._open(slot) for slot in pool.slots))
+
+    pool.start = start
+    return pool
+
+
+def test_concurrent_navigations_use_all_contexts():
+    async def main():
+        # 接続の数がコンテキストより多いため、使われていない他の接続のコンテキストはすぐに貸し出す
+        pool = make_pool(size=4, max_uses=100, idle_seconds=0.0)
+        await asyncio.gather(*(pool.navigate(f"owner-{i}", f"http://example.com/{i}") for i in range(8)))
+        assert pool.stats["navigations"] == 8
+        assert pool.stats["max_busy"] == 4
+        assert all(not slot.busy for slot in pool.slots)
+
+    asyncio.run(main())
+
+
+def test_stateful_call_uses_the_context_that_opened_the_page():
+    async def main():
+        pool = make_pool(size=2)
+        await pool.navigate("a", "http://example.com/a")
+        await pool.navigate("b", "http://example.com/b")
+        snapshot = await pool.run("a", None)
+        assert "http://example.com/a" in snapshot
+        assert pool.stats["restores"] == 0
+
+    asyncio.run(main())
+
+
+def test_context_is_recycled_when_it_changes_owner():
+    async def main():
+        pool = make_pool(size=1, idle_seconds=0.0)
+        await pool.navigate("a", "http://example.com/login")
+        # aのコンテキストにログイン状態（Cookie）が残っている
+        pool.slots[0].context.cookies.add("session-a")
+        pool.release("a")
+        await asyncio.sleep(0)
+
+        snapshot = await pool.navigate("b", "http://example.com/")
+        assert "session-a" not in snapshot
+        assert pool.stats["owner_changes"] == 1
+        assert pool.browser.contexts[0].closed
+
+        # 同じ接続の続けての取得では作り直さない
+        await pool.navigate("b", "http://example.com/2")
+        assert pool.stats["owner_changes"] == 1
+
+    asyncio.run(main())
+
+
+def test_stolen_context_is_restored_without_the_other_owners_cookies():
+    async def main():
+        pool = make_pool(size=1, idle_seconds=0.0)
+        await pool.navigate("a", "http://example.com/a")
+        pool.slots[0].context.cookies.add("session-a")
+        # aのコンテキストは使われていないため、bに貸し出される
+        await pool.navigate("b", "http://example.com/b")
+        pool.slots[0].context.cookies.add("session-b")
+        assert pool.stats["steals"] == 1
+
+        snapshot = await pool.run("a", None)
+        assert "http://example.com/a" in snapshot
+        assert "session-b" not in snapshot
+        assert pool.stats["restores"] == 1
+
+    asyncio.run(main())
+
+
+def test_browser_close_clears_the_owners_context():
+    async def main():
+        pool = make_pool(size=2)
+        await pool.navigate("a", "http://example.com/a")
+        slot = pool.current["a"]
+        slot.context.cookies.add("session-a")
+        await pool.close_owner("a")
+        assert "a" not in pool.current and "a" not in pool.last_url
+        assert slot.owner is None and not slot.context.cookies
+
+        try:
+            await pool.run("a", None)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("閉じた後のbrowser_snapshotはエラーになる")
+
+    asyncio.run(main())
+
+
+def test_stateful_call_waits_without_polling():
+    async def main():
+        pool = make_pool(size=3)
+        await pool.navigate("a", "http://example.com/a")
+        wakeups = 0
+        wait = pool.condition.wait
+
+        async def counting_wait():
+            nonlocal wakeups
+            wakeups += 1
+            return await wait()
+
+        pool.condition.wait = counting_wait
+
+        async def hold():
+            async with pool.lease("a"):
+                await asyncio.sleep(0.3)
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0.01)
+        async with pool.lease("a", stateful=True) as slot:
+            assert slot is pool.current["a"]
+        await holder
+        assert wakeups == 1
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: OK")
@@ -0,0 +1,96 @@
+import json
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+# ページの状態を変えるツール。キャッシュから返した場合は、次に同じブラウザを操作する前に実際に実行し直す
+DEFAULT_STATEFUL_TOOLS = ("browser_navigate",)
+
+
+def normalize_url(url):
+    """
+    同じページを指すURLが同じキーになるように正規化する関数
+    スキームとホストの小文字化、フラグメントとutm_*パラメータの削除、クエリの並び替え、末尾の/の削除を行う
+    """
+    parts = urlsplit(url.strip())
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not k.startswith("utm_"))
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, urlencode(query), ""))
+
+
+def normalize_args(args):
+    """
+    ツールの引数を正規化する関数（文字列の前後の空白を削除し、urlという名前の引数はnormalize_urlで正規化する）
+    """
+    result = {}
+    for key, value in args.items():
+        if isinstance(value, str):
+            value = normalize_url(value) if key == "url" else value.strip()
+        result[key] = value
+    return result
+
+
+class ToolResultCache:
+    """
+    読み取りだけのツール（ページの取得など）の結果を、ツール名と正規化した引数をキーに保存するクラス
+    ttl_per_toolに指定したツールだけをキャッシュし（{ツール名: 有効期限の秒数}）、エラーの結果は保存しない
+    max_entries件もしくはmax_chars文字を超えた場合は、最後に利用された時刻が古いものから削除する
+    サーバモードでは全ての会話で共有するため、ユーザごとに結果が異なるツール（notionApiなど）は指定しないこと
+    """
+
+    def __init__(self, ttl_per_tool, max_entries=512, max_chars=20_000_000, stateful_tools=DEFAULT_STATEFUL_TOOLS):
+        self.ttl_per_tool = dict(ttl_per_tool)
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.stateful_tools = set(stateful_tools)
+        # キー -> (保存した時刻, 内容, 文字数)
+        self.entries = OrderedDict()
+        self.total_chars = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def enabled(self, name):
+        return name in self.ttl_per_tool
+
+    def key(self, name, args):
+        return f"{name}:{json.dumps(normalize_args(args), sort_keys=True, ensure_ascii=False)}"
+
+    def get(self, name, args):
+        """
+        キャッシュされた内容を返す。ないもしくは有効期限が切れている場合はNoneを返す
+        """
+        if not self.enabled(name):
+            return None
+        key = self.key(name, args)
+        entry = self.entries.get(key)
+        if entry is not None and time.time() - entry[0] > self.ttl_per_tool[name]:
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry[1]
+
+    def put(self, name, args, content):
+        if not self.enabled(name):
+            return
+        size = len(content) if isinstance(content, str) else len(json.dumps(content, ensure_ascii=False))
+        if size > self.max_chars:
+            return
+        key = self.key(name, args)
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.time(), content, size)
+        self.total_chars += size
+        while len(self.entries) > self.max_entries or self.total_chars > self.max_chars:
+            self._remove(next(iter(self.entries)))
+            self.stats["evictions"] += 1
+
+    def _remove(self, key):
+        _, _, size = self.entries.pop(key)
+        self.total_chars -= size
+
+    def summary(self):
+        return {**self.stats, "entries": len(self.entries), "chars": self.total_chars}
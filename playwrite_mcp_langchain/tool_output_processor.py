@@ -0,0 +1,174 @@
+import os
+import re
+import json
+import uuid
+import hashlib
+from collections import OrderedDict
+
+from langchain_core.messages import ToolMessage
+from langchain_core.tools import StructuredTool
+
+
+# Playwrightのスナップショット（アクセシビリティツリー）のうち、回答にほとんど役立たない行
+DEFAULT_DROP_PATTERNS = [
+    r"^\s*- img \[ref=[^\]]+\]\s*$",            # 説明のない画像
+    r"^\s*- generic \[ref=[^\]]+\]:?\s*$",      # テキストのないコンテナ
+    r"^\s*- separator \[ref=[^\]]+\]\s*$",      # 区切り線
+    r"^\s*- (banner|contentinfo|navigation) \[ref=[^\]]+\]:?\s*$",  # ヘッダー・フッター等の見出し行
+    r"^\s*- (button|link) \"(閉じる|Log in|ログイン|検索)\" \[ref=[^\]]+\]:?\s*$",
+]
+
+# ツールごとの出力の最大文字数の既定値
+DEFAULT_MAX_CHARS = 8000
+
+
+class ToolOutputStore:
+    """
+    ツールの出力の全文を、モデルに入力する履歴とは別に保存するクラス
+    参照ID（ref_id）を発行し、エージェントが必要なときに全文を取得し直せるようにする
+    メモリ上に最大max_entries件を保持し、store_dirを指定した場合はファイルにも保存する
+    """
+
+    def __init__(self, max_entries=200, store_dir=None):
+        self.max_entries = max_entries
+        self.store_dir = store_dir
+        self.entries = OrderedDict()
+        if store_dir:
+            os.makedirs(store_dir, exist_ok=True)
+
+    def put(self, tool_name, content):
+        ref_id = f"{tool_name}-{uuid.uuid4().hex[:12]}"
+        self.entries[ref_id] = content
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        if self.store_dir:
+            with open(os.path.join(self.store_dir, f"{ref_id}.txt"), "w", encoding="utf-8") as f:
+                f.write(content)
+        return ref_id
+
+    def get(self, ref_id):
+        if ref_id in self.entries:
+            self.entries.move_to_end(ref_id)
+            return self.entries[ref_id]
+        if self.store_dir:
+            # ref_idはファイル名に利用するため、想定外の文字を含む場合は読み込まない
+            if not re.fullmatch(r"[\w.-]+", ref_id):
+                return None
+            path = os.path.join(self.store_dir, f"{ref_id}.txt")
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    return f.read()
+        return None
+
+
+def _content_to_text(content):
+    """
+    ToolMessageのcontent（文字列もしくはcontent blockのリスト）をテキストにする
+    """
+    if isinstance(content, str):
+        return content
+    parts = []
+    for part in content:
+        if isinstance(part, str):
+            parts.append(part)
+        elif isinstance(part, dict) and part.get("type") == "text":
+            parts.append(part.get("text", ""))
+        else:
+            parts.append(json.dumps(part, ensure_ascii=False))
+    return "\n".join(parts)
+
+
+class ToolOutputProcessor:
+    """
+    ToolNodeの出力をモデルに入力する前に縮めるクラス
+    1. 不要な行（説明のない画像やヘッダー等）を削除する
+    2. 同じ会話（thread_id）で以前と全く同じ内容の出力は、以前の参照IDを示す短いメッセージに置き換える
+       （他の会話のモデルはその出力を見ていないため、会話をまたいでは置き換えない）
+    3. ツールごとの最大文字数を超える部分を切り詰める
+    縮めた場合は全文をToolOutputStoreに保存し、参照IDをメッセージに付与する
+    エージェントはfetch_toolで全文の一部を取得し直せる
+    """
+
+    def __init__(self, store=None, max_chars=DEFAULT_MAX_CHARS, max_chars_per_tool=None,
+                 drop_patterns=DEFAULT_DROP_PATTERNS, dedupe=True, passthrough_tools=("fetch_tool_output",)):
+        self.store = store or ToolOutputStore()
+        self.max_chars = max_chars
+        self.max_chars_per_tool = max_chars_per_tool or {}
+        self.drop_patterns = [re.compile(p) for p in drop_patterns]
+        self.dedupe = dedupe
+        self.passthrough_tools = set(passthrough_tools)
+        # (thread_id, 出力内容のハッシュ) -> 参照ID
+        self.seen = OrderedDict()
+        self.stats = {"messages": 0, "before_chars": 0, "after_chars": 0, "deduped": 0}
+        self.fetch_tool = self._build_fetch_tool()
+
+    def strip_lines(self, text):
+        """
+        drop_patternsに一致する行を削除する
+        """
+        lines = text.split("\n")
+        return "\n".join(line for line in lines if not any(p.match(line) for p in self.drop_patterns))
+
+    def process_message(self, message, thread_id=None):
+        """
+        1件のToolMessageを縮めたものを返す
+        thread_idは、出力を見るモデルの会話のID
+        """
+        if not isinstance(message, ToolMessage) or message.name in self.passthrough_tools:
+            return message
+
+        original = _content_to_text(message.content)
+        self.stats["messages"] += 1
+        self.stats["before_chars"] += len(original)
+
+        digest = (thread_id, hashlib.sha256(original.encode("utf-8")).hexdigest())
+        if self.dedupe and digest in self.seen and self.store.get(self.seen[digest]) is not None:
+            self.stats["deduped"] += 1
+            self.seen.move_to_end(digest)
+            text = (f"（以前のツール出力と同じ内容のため省略しました。"
+                    f"必要な場合はfetch_tool_outputでref_id=\"{self.seen[digest]}\"を取得してください）")
+            self.stats["after_chars"] += len(text)
+            return message.model_copy(update={"content": text})
+
+        text = self.strip_lines(original)
+        limit = self.max_chars_per_tool.get(message.name, self.max_chars)
+        truncated = len(text) > limit
+        if truncated:
+            text = text[:limit]
+
+        if text != original:
+            ref_id = self.store.put(message.name or "tool", original)
+            self.seen[digest] = ref_id
+            if len(self.seen) > self.store.max_entries:
+                self.seen.popitem(last=False)
+            note = f"\n\n（ツール出力を{len(original)}文字から{len(text)}文字に縮めました。"
+            if truncated:
+                note += "続きが必要な場合は"
+            else:
+                note += "全文が必要な場合は"
+            note += f"fetch_tool_outputでref_id=\"{ref_id}\"を取得してください）"
+            text += note
+
+        self.stats["after_chars"] += len(text)
+        return message.model_copy(update={"content": text})
+
+    def __call__(self, messages, thread_id=None):
+        return [self.process_message(message, thread_id) for message in messages]
+
+    def _build_fetch_tool(self):
+        store = self.store
+        max_chars = self.max_chars
+
+        def fetch_tool_output(ref_id: str, offset: int = 0, length: int = 4000) -> str:
+            """以前に省略されたツール出力の全文を、offset文字目からlength文字分取得します（lengthの上限はツール出力の上限の文字数です）。"""
+            content = store.get(ref_id)
+            if content is None:
+                return f"ref_id=\"{ref_id}\"のツール出力は見つかりませんでした。"
+            # 負のoffsetで末尾から取得したり、大きなlengthで省略した出力を丸ごと取得し直したりしないようにする
+            offset = max(offset, 0)
+            length = min(max(length, 0), max_chars)
+            chunk = content[offset:offset + length]
+            rest = max(len(content) - offset - length, 0)
+            return f"{chunk}\n\n（全{len(content)}文字中 {offset}〜{offset + len(chunk)}文字目。残り{rest}文字）"
+
+        return StructuredTool.from_function(fetch_tool_output)
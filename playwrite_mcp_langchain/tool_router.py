@@ -0,0 +1,273 @@
+import re
+import json
+import math
+from collections import Counter, OrderedDict
+
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+
+# 日本語の質問からツールの説明（英語）の単語を引くための対応表。質問に左の語が含まれる場合は、右の単語でも検索する
+DEFAULT_QUERY_SYNONYMS = {
+    "http": "navigate url page",
+    "url": "navigate url page",
+    "サイト": "navigate page snapshot",
+    "ページ": "navigate page snapshot",
+    "記事": "navigate page snapshot",
+    "開": "navigate open",
+    "アクセス": "navigate",
+    "見": "snapshot",
+    "内容": "snapshot",
+    "クリック": "click",
+    "押": "click button",
+    "ボタン": "click button",
+    "入力": "type fill text",
+    "フォーム": "fill form type",
+    "選択": "select option",
+    "スクリーンショット": "screenshot",
+    "画像": "screenshot image",
+    "タブ": "tab",
+    "戻": "back",
+    "進": "forward",
+    "待": "wait",
+    "スクロール": "scroll press key",
+    "pdf": "pdf",
+    "ダウンロード": "download file",
+    "アップロード": "upload file",
+    "notion": "notion",
+    "ノーション": "notion",
+    "データベース": "notion database query",
+    "ブロック": "notion block children",
+    "コメント": "notion comment",
+    "ユーザ": "notion user",
+    "検索": "search",
+    "作成": "create post",
+    "追加": "create post append",
+    "更新": "update patch",
+    "削除": "delete",
+}
+
+_WORD_RE = re.compile(r"[A-Z]+(?![a-z])|[A-Za-z][a-z]*|\d+")
+_CJK_RE = re.compile(r"[぀-ヿ㐀-鿿]+")
+
+
+def tokenize(text):
+    """
+    英単語（snake_case, camelCase, kebab-caseは分割する）を小文字にしたものと、日本語の2文字ずつの組を返す関数
+    """
+    terms = [word.lower() for word in _WORD_RE.findall(text)]
+    for run in _CJK_RE.findall(text):
+        terms.extend(run[i:i + 2] for i in range(max(len(run) - 1, 1)))
+    return terms
+
+
+def message_text(message):
+    content = message.content
+    if isinstance(content, str):
+        return content
+    return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+
+
+def schema_tokens(tool):
+    """
+    モデルに渡すツールのJSONスキーマのトークン数を推定する関数（1トークンを4文字とする）
+    """
+    return len(json.dumps(convert_to_openai_tool(tool), ensure_ascii=False)) // 4
+
+
+class ToolRouter:
+    """
+    ターンごとに質問に関係のあるツールだけを選び、そのツールだけをbindしたモデルのチェーンを返すクラス
+    全てのMCPサーバのツール（Playwright全体とNotion APIの全体）をbindすると、毎回の入力に数十個のJSONスキーマが含まれるため
+    - ツールの名前・説明・引数名から、起動時に単語の索引（IDF）を作成する
+    - 最後のHumanMessageの本文（とDEFAULT_QUERY_SYNONYMSで展開した単語）で各ツールを採点し、上位max_tools件を選ぶ
+    - always_includeのツール（ページの取得・表示・本文の取得と、省略された出力の取得）と、会話の中ですでに呼び出したツールは必ず含める（続けて同じツールを使えるように）
+    - embeddingsを指定した場合は、ツールの説明の埋め込みとの類似度（embedding_weight倍）も加える
+    選んだツールの組み合わせごとに、bind_chain(ツールのリスト)で作成したチェーンを最大max_cached_chains件保存して使い回す
+
+    statsのschema_tokens_all / schema_tokens_selectedは、全てのツールと選んだツールのスキーマのトークン数（推定）の累計
+    プロンプトのキャッシュ（prompt_cache.CachedPrefixChain）を参照した呼び出しは、選んだツールではなくキャッシュしたツールを
+    参照するため、schema_tokens_selectedには含めず、cached_calls / schema_tokens_cachedに記録する
+    """
+
+    def __init__(self, tools, bind_chain,
+                 always_include=("browser_navigate", "browser_snapshot", "fetch_tool_output", "read_page"),
+                 max_tools=10, query_synonyms=None, embeddings=None, embedding_weight=2.0,
+                 max_cached_chains=32, max_cached_selections=1024):
+        self.tools = list(tools)
+        self.tools_by_name = {tool.name: tool for tool in self.tools}
+        self.bind_chain = bind_chain
+        self.always_include = [name for name in always_include if name in self.tools_by_name]
+        self.max_tools = max_tools
+        self.query_synonyms = DEFAULT_QUERY_SYNONYMS if query_synonyms is None else query_synonyms
+        self.embeddings = embeddings
+        self.embedding_weight = embedding_weight
+        self.max_cached_chains = max_cached_chains
+        self.max_cached_selections = max_cached_selections
+        # 選んだツールの名前の組 -> bindしたチェーン
+        self.chains = OrderedDict()
+        # (質問, 呼び出し済みのツール) -> 選んだツールの名前のタプル
+        self.selections = OrderedDict()
+        self.tool_vectors = None
+
+        # ツールの名前・説明・引数名の単語の索引
+        self.tool_terms = {}
+        document_frequency = Counter()
+        for tool in self.tools:
+            args = " ".join((tool.args or {}).keys())
+            terms = Counter(tokenize(f"{tool.name} {tool.name} {tool.description} {args}"))
+            self.tool_terms[tool.name] = terms
+            document_frequency.update(terms.keys())
+        self.idf = {
+            term: math.log((len(self.tools) + 1) / (count + 0.5)) for term, count in document_frequency.items()
+        }
+        self.tool_schema_tokens = {tool.name: schema_tokens(tool) for tool in self.tools}
+        self.all_schema_tokens = sum(self.tool_schema_tokens.values())
+        self.stats = {"calls": 0, "schema_tokens_all": 0, "schema_tokens_selected": 0, "bound_chains": 0,
+                      "cached_calls": 0, "schema_tokens_cached": 0, "input_tokens": 0}
+
+    # ========== ツールの選択 ==========
+
+    def _query_terms(self, text):
+        lowered = text.lower()
+        expanded = " ".join(words for key, words in self.query_synonyms.items() if key in lowered)
+        return tokenize(f"{text} {expanded}")
+
+    def score(self, text):
+        """
+        質問の本文に対する各ツールの点数を返す（{ツール名: 点数}）
+        """
+        query = Counter(self._query_terms(text))
+        scores = {}
+        for name, terms in self.tool_terms.items():
+            scores[name] = sum(
+                self.idf.get(term, 0.0) * min(count, 3) * (1 + math.log(terms[term]))
+                for term, count in query.items() if term in terms
+            )
+        return scores
+
+    async def _embedding_scores(self, text):
+        if self.tool_vectors is None:
+            self.tool_vectors = await self.embeddings.aembed_documents(
+                [f"{tool.name}: {tool.description}" for tool in self.tools])
+        query = await self.embeddings.aembed_query(text)
+
+        def cosine(a, b):
+            norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+            return sum(x * y for x, y in zip(a, b)) / norm if norm else 0.0
+
+        return {tool.name: cosine(query, vector) for tool, vector in zip(self.tools, self.tool_vectors)}
+
+    @staticmethod
+    def _turn(messages):
+        """
+        最後のHumanMessageの本文と、会話の中で呼び出したツールの名前を返す
+        （履歴のtool_callsにあるツールがbindされていないと、モデルによってはエラーになるため）
+        """
+        turn_start = max((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), default=None)
+        used = sorted({
+            tool_call["name"]
+            for message in messages if isinstance(message, AIMessage)
+            for tool_call in message.tool_calls
+        })
+        text = message_text(messages[turn_start]) if turn_start is not None else ""
+        return text, tuple(used)
+
+    async def select(self, messages):
+        """
+        会話の状態からbindするツールの名前のタプルを選ぶ（ツールの順番は元のリストの順番）
+        """
+        text, used = self._turn(messages)
+        key = (text, used)
+        if key in self.selections:
+            self.selections.move_to_end(key)
+            return self.selections[key]
+
+        scores = self.score(text)
+        if self.embeddings is not None and text:
+            for name, similarity in (await self._embedding_scores(text)).items():
+                scores[name] += self.embedding_weight * similarity
+        ranked = [name for name, value in sorted(scores.items(), key=lambda item: -item[1]) if value > 0]
+
+        selected = set(self.always_include) | {name for name in used if name in self.tools_by_name}
+        for name in ranked:
+            if len(selected) >= max(self.max_tools, len(self.always_include) + len(used)):
+                break
+            selected.add(name)
+        selection = tuple(tool.name for tool in self.tools if tool.name in selected)
+
+        self.selections[key] = selection
+        while len(self.selections) > self.max_cached_selections:
+            self.selections.popitem(last=False)
+        return selection
+
+    # ========== bindしたチェーン ==========
+
+    def chain_for(self, selection):
+        """
+        選んだツールだけをbindしたチェーンを返す。同じ組み合わせは作成済みのものを使い回す
+        """
+        chain = self.chains.get(selection)
+        if chain is None:
+            chain = self.bind_chain([self.tools_by_name[name] for name in selection])
+            self.chains[selection] = chain
+            self.stats["bound_chains"] += 1
+            while len(self.chains) > self.max_cached_chains:
+                self.chains.popitem(last=False)
+        self.chains.move_to_end(selection)
+        return chain
+
+    async def route(self, messages):
+        """
+        会話の状態に合わせたチェーンを返す関数（create_graphのcall_modelから利用する）
+        """
+        selection = await self.select(messages)
+        self.stats["calls"] += 1
+        self.stats["schema_tokens_all"] += self.all_schema_tokens
+        tokens = sum(self.tool_schema_tokens[name] for name in selection)
+        return _RoutedChain(self, self.chain_for(selection), tokens)
+
+    def record(self, response):
+        """
+        モデルの応答のusage_metadataから、実際の入力トークン数を記録する
+        """
+        usage = getattr(response, "usage_metadata", None)
+        if usage:
+            self.stats["input_tokens"] += usage.get("input_tokens", 0)
+
+    def summary(self):
+        calls = self.stats["calls"] or 1
+        uncached = (self.stats["calls"] - self.stats["cached_calls"]) or 1
+        return {
+            "calls": self.stats["calls"],
+            "tools": len(self.tools),
+            "bound_chains": self.stats["bound_chains"],
+            "schema_tokens_per_call_before": self.stats["schema_tokens_all"] / calls,
+            # キャッシュを参照せずに、選んだツールのスキーマを送った呼び出しの平均
+            "schema_tokens_per_call_after": self.stats["schema_tokens_selected"] / uncached,
+            "cached_calls": self.stats["cached_calls"],
+            "cached_schema_tokens_per_call": self.stats["schema_tokens_cached"] / (self.stats["cached_calls"] or 1),
+            "input_tokens_per_call": self.stats["input_tokens"] / calls,
+        }
+
+
+class _RoutedChain:
+    """
+    route()が返すチェーン。呼び出した後に、選んだツールとキャッシュしたツールのどちらを送ったかを記録する
+    """
+
+    def __init__(self, router, chain, selected_tokens):
+        self.router = router
+        self.chain = chain
+        self.selected_tokens = selected_tokens
+
+    async def ainvoke(self, messages, config=None):
+        response = await self.chain.ainvoke(messages, config)
+        stats = self.router.stats
+        cached = (getattr(response, "response_metadata", None) or {}).get("prompt_cache")
+        if cached:
+            stats["cached_calls"] += 1
+            stats["schema_tokens_cached"] += cached["schema_tokens"]
+        else:
+            stats["schema_tokens_selected"] += self.selected_tokens
+        return response
@@ -0,0 +1,191 @@
+"""
+tracing.TraceRecorderが記録したトレース（JSONL）を集計し、ターンごとのクリティカルパスと処理時間の内訳を表示する
+
+    python trace_summary.py traces/agent_trace.jsonl --last 5
+    python trace_summary.py traces/agent_trace.jsonl --otlp traces/agent_trace.otlp.json
+"""
+import json
+import argparse
+from collections import defaultdict
+
+from tracing import GRAPH, NODE, LLM, TOOL, MCP, decode_attributes
+
+
+# クリティカルパスの内訳の表示名（スパンの種類ごとの、子のスパンを除いた時間）
+BREAKDOWN_LABELS = {
+    LLM: "モデルの呼び出し",
+    MCP: "MCPサーバ（ツールの実行と通信）",
+    TOOL: "ツールの待ち・変換（同時実行数・サーバの起動待ちなど）",
+    NODE: "ノードの処理（履歴の整理・出力の加工など）",
+    GRAPH: "LangGraph（チェックポイントの保存など）",
+}
+
+
+def load_spans(path):
+    """
+    JSONLのトレースを読み込み、時刻とattributesを扱いやすい形に変換したスパンのリストを返す関数
+    """
+    spans = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            span = json.loads(line)
+            span["start"] = int(span["startTimeUnixNano"]) / 1e9
+            span["end"] = int(span["endTimeUnixNano"]) / 1e9
+            span["duration"] = span["end"] - span["start"]
+            span["attrs"] = decode_attributes(span.get("attributes", []))
+            span["type"] = span["attrs"].get("span.type")
+            spans.append(span)
+    return spans
+
+
+def group_traces(spans):
+    """
+    スパンをトレースごとにまとめ、ルートのスパンの開始時刻の順に (ルート, {span_id: [子のスパン]}) のリストを返す関数
+    ルートのスパンがない（書き込み中の）トレースは除く
+    """
+    by_trace = defaultdict(list)
+    for span in spans:
+        by_trace[span["traceId"]].append(span)
+
+    traces = []
+    for trace_spans in by_trace.values():
+        roots = [s for s in trace_spans if not s.get("parentSpanId")]
+        if not roots:
+            continue
+        children = defaultdict(list)
+        for span in trace_spans:
+            if span.get("parentSpanId"):
+                children[span["parentSpanId"]].append(span)
+        traces.append((roots[0], children))
+    traces.sort(key=lambda t: t[0]["start"])
+    return traces
+
+
+def critical_path(span, children, tolerance=1e-4):
+    """
+    spanの終了時刻から逆にたどり、それぞれの時点で最後に終わった子のスパンを順に選んでクリティカルパスを作成する関数
+    並列に実行されたツールは一番遅いものだけが選ばれる
+    出力は、[(深さ, スパン, 子のスパンを除いた時間)] のリスト（開始時刻の順）
+    """
+    path = []
+    cursor = span["end"] + tolerance
+    selected = []
+    candidates = sorted(children.get(span["spanId"], []), key=lambda s: s["end"], reverse=True)
+    for child in candidates:
+        if child["end"] <= cursor:
+            selected.append(child)
+            cursor = child["start"] + tolerance
+    selected.reverse()
+
+    self_time = span["duration"] - sum(child["duration"] for child in selected)
+    path.append((0, span, max(self_time, 0.0)))
+    for child in selected:
+        path.extend((depth + 1, s, t) for depth, s, t in critical_path(child, children, tolerance))
+    return path
+
+
+def token_counts(spans):
+    input_tokens = sum(s["attrs"].get("gen_ai.usage.input_tokens", 0) for s in spans if s["type"] == LLM)
+    output_tokens = sum(s["attrs"].get("gen_ai.usage.output_tokens", 0) for s in spans if s["type"] == LLM)
+    return input_tokens, output_tokens
+
+
+def span_label(span):
+    attrs = span["attrs"]
+    label = span["name"]
+    if span["type"] == TOOL and attrs.get("mcp.server"):
+        label += f" [{attrs['mcp.server']}]"
+    if span["type"] == LLM and "gen_ai.usage.input_tokens" in attrs:
+        label += f" (入力 {attrs['gen_ai.usage.input_tokens']} / 出力 {attrs['gen_ai.usage.output_tokens']}トークン)"
+    if span.get("status", {}).get("code") == 2:
+        label += " [エラー]"
+    return label
+
+
+def print_trace(root, children):
+    spans = [root, *(s for group in children.values() for s in group)]
+    input_tokens, output_tokens = token_counts(spans)
+    total = root["duration"] or 1e-9
+    print(f"trace {root['traceId'][:12]}  thread_id={root['attrs'].get('thread_id')}  "
+          f"{root['duration']:.2f}秒  入力 {input_tokens} / 出力 {output_tokens}トークン")
+
+    path = critical_path(root, children)
+    print("  クリティカルパス:")
+    for depth, span, _ in path:
+        print(f"    {'  ' * depth}{span_label(span):<60} {span['duration']:>7.3f}秒 {span['duration'] / total:>6.1%}")
+
+    breakdown = defaultdict(float)
+    for _, span, self_time in path:
+        breakdown[span["type"]] += self_time
+    print("  内訳（クリティカルパス上の、子のスパンを除いた時間）:")
+    for span_type, label in BREAKDOWN_LABELS.items():
+        if span_type in breakdown:
+            print(f"    {breakdown[span_type]:>7.3f}秒 {breakdown[span_type] / total:>6.1%}  {label}")
+    print()
+
+
+def print_aggregate(traces):
+    """
+    全てのトレースについて、スパンの種類と名前ごとの回数・平均・p95の秒数を表示する
+    """
+    durations = defaultdict(list)
+    for root, children in traces:
+        for span in [root, *(s for group in children.values() for s in group)]:
+            key = span["name"] if span["type"] != TOOL else span_label(span)
+            durations[(span["type"], key)].append(span["duration"])
+
+    print(f"全{len(traces)}ターンの集計:")
+    print(f"  {'種類':<6} {'名前':<50} {'回数':>6} {'平均':>8} {'p95':>8}")
+    for (span_type, name), values in sorted(durations.items(), key=lambda item: -sum(item[1])):
+        values.sort()
+        p95 = values[min(int(len(values) * 0.95), len(values) - 1)]
+        print(f"  {span_type:<6} {name:<50} {len(values):>6} {sum(values) / len(values):>7.3f}秒 {p95:>7.3f}秒")
+
+
+def to_otlp(spans, service_name="playwright-mcp-agent"):
+    """
+    JSONLのスパンを、OTLPのJSON（ExportTraceServiceRequest）の形式にまとめる関数
+    """
+    keys = ("traceId", "spanId", "parentSpanId", "name", "kind", "startTimeUnixNano", "endTimeUnixNano",
+            "attributes", "status")
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+            "scopeSpans": [{
+                "scope": {"name": "tracing.TraceRecorder"},
+                "spans": [{key: span[key] for key in keys if key in span} for span in spans],
+            }],
+        }],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="エージェントのトレースのクリティカルパスと処理時間の内訳を表示する")
+    parser.add_argument("path", nargs="?", default="traces/agent_trace.jsonl", help="トレースのJSONLファイル")
+    parser.add_argument("--last", type=int, default=5, help="クリティカルパスを表示する直近のターン数")
+    parser.add_argument("--thread", default=None, help="指定したthread_idのターンだけを表示する")
+    parser.add_argument("--otlp", default=None, help="OTLPのJSONに変換して保存するファイル名")
+    args = parser.parse_args()
+
+    spans = load_spans(args.path)
+    if args.otlp:
+        with open(args.otlp, "w", encoding="utf-8") as f:
+            json.dump(to_otlp(spans), f, ensure_ascii=False)
+        print(f"{len(spans)}件のスパンを{args.otlp}に保存しました。")
+        return
+
+    traces = group_traces(spans)
+    if args.thread is not None:
+        traces = [t for t in traces if t[0]["attrs"].get("thread_id") == args.thread]
+    if not traces:
+        print("トレースがありません。")
+        return
+    for root, children in traces[-args.last:]:
+        print_trace(root, children)
+    print_aggregate(traces)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""
+エージェントのグラフの処理時間を、グラフのノード・モデルの呼び出し・ツールの呼び出し・MCPサーバごとのスパンとして記録する
+LangChainのコールバックとして実装しているため、graph.ainvoke / astream のconfigの"callbacks"に指定するだけで利用できる
+
+スパンはOTLP（OpenTelemetry）のJSONのスパンと同じ形式で、1行に1スパンずつJSONLファイルに追記する
+集計はtrace_summary.pyで行う（OTLPのコレクタなどに送る場合は、trace_summary.py --otlpでOTLPのJSONに変換する）
+"""
+import os
+import json
+import time
+import threading
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+
+# スパンの種類（attributesの"span.type"）
+GRAPH = "graph"
+NODE = "node"
+LLM = "llm"
+TOOL = "tool"
+MCP = "mcp"
+
+# OTLPのSpanKind（INTERNAL, CLIENT）とStatusCode（OK, ERROR）
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+# MCPサーバの呼び出しをトレースに記録するためのカスタムイベントの名前（mcp_pool.pyから送る）
+MCP_CALL_EVENT = "mcp_call"
+
+
+def _attribute_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        # OTLPのJSONでは64bit整数は文字列で表す
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def encode_attributes(attributes):
+    """
+    {キー: 値} の辞書をOTLPのattributes（[{"key": ..., "value": {"stringValue": ...}}]）に変換する関数
+    """
+    return [{"key": key, "value": _attribute_value(value)} for key, value in attributes.items() if value is not None]
+
+
+def decode_attributes(attributes):
+    """
+    OTLPのattributesを {キー: 値} の辞書に戻す関数
+    """
+    result = {}
+    for item in attributes:
+        (kind, value), = item["value"].items()
+        result[item["key"]] = int(value) if kind == "intValue" else value
+    return result
+
+
+class TraceRecorder(BaseCallbackHandler):
+    """
+    グラフの実行をスパンとしてJSONLファイルに記録するコールバック
+    - graph: グラフの1回の実行（1ターン）。トレースのルートになる
+    - node:  グラフのノード（agent, tools, summarizeなど）
+    - llm:   チャットモデルの呼び出し。usage_metadataの入力・出力トークン数と、最初のトークンまでの秒数を記録する
+    - tool:  ツールの呼び出し。ParallelToolExecutorから渡された実行したMCPサーバ名と、同時実行数の空き待ちの秒数を記録する
+    - mcp:   MCPサーバとの通信（MCPServerPoolのツールが送るカスタムイベントから作成する）
+    それ以外のRunnable（プロンプトやチャネルの書き込みなど）は記録せず、子のスパンは記録した一番近い親につなげる
+
+    スパンはメモリに溜めておき、ターンが終わった時かbuffer_size件を超えた時にファイルに書き込む
+    ファイルがmax_bytesを超えた場合は、".1"を付けた名前に移動してから新しいファイルに書き込む
+    """
+
+    # コールバックをイベントループのスレッドで直接実行する（スレッドプールを経由しない）
+    run_inline = True
+
+    def __init__(self, path="traces/agent_trace.jsonl", buffer_size=200, max_bytes=100_000_000):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.max_bytes = max_bytes
+        # run_id -> 記録中のスパン
+        self.spans = {}
+        # run_id -> (trace_id, 記録した一番近い親のspan_id)。記録しないRunnableの子をつなげるために利用する
+        self.links = {}
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.exported = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    # ========== スパンの開始・終了 ==========
+
+    def _parent(self, parent_run_id):
+        """
+        親のrun_idから (trace_id, 親のspan_id) を返す
+        """
+        if parent_run_id is None:
+            return None, None
+        if parent_run_id in self.spans:
+            span = self.spans[parent_run_id]
+            return span["traceId"], span["spanId"]
+        return self.links.get(parent_run_id, (None, None))
+
+    def _start(self, run_id, parent_run_id, name, span_type, attributes=None, kind=SPAN_KIND_INTERNAL):
+        trace_id, parent_span_id = self._parent(parent_run_id)
+        if trace_id is None:
+            # 親がいない（もしくは記録していない実行の中から呼ばれた）場合は、新しいトレースにする
+            trace_id, parent_span_id = run_id.hex, ""
+        self.spans[run_id] = {
+            "traceId": trace_id,
+            "spanId": run_id.hex[:16],
+            "parentSpanId": parent_span_id,
+            "name": name,
+            "kind": kind,
+            "startTimeUnixNano": time.time_ns(),
+            "attributes": {"span.type": span_type, **(attributes or {})},
+        }
+
+    def _link(self, run_id, parent_run_id):
+        trace_id, span_id = self._parent(parent_run_id)
+        if trace_id is not None:
+            self.links[run_id] = (trace_id, span_id)
+
+    def _end(self, run_id, error=None, attributes=None):
+        self.links.pop(run_id, None)
+        span = self.spans.pop(run_id, None)
+        if span is None:
+            return
+        span["endTimeUnixNano"] = time.time_ns()
+        span["attributes"].update(attributes or {})
+        if error is not None:
+            span["status"] = {"code": STATUS_ERROR, "message": repr(error)}
+        else:
+            span["status"] = {"code": STATUS_OK}
+        self._export(span, flush=span["parentSpanId"] == "")
+
+    def _export(self, span, flush=False):
+        span = {
+            **span,
+            "startTimeUnixNano": str(span["startTimeUnixNano"]),
+            "endTimeUnixNano": str(span["endTimeUnixNano"]),
+            "attributes": encode_attributes(span["attributes"]),
+        }
+        with self.lock:
+            self.buffer.append(json.dumps(span, ensure_ascii=False))
+            if flush or len(self.buffer) >= self.buffer_size:
+                self._flush_locked()
+
+    def flush(self):
+        with self.lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self.buffer:
+            return
+        if self.max_bytes and os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+            os.replace(self.path, self.path + ".1")
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("\n".join(self.buffer) + "\n")
+        self.exported += len(self.buffer)
+        self.buffer = []
+
+    # ========== グラフ・ノード ==========
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, tags=None, metadata=None,
+                       **kwargs):
+        metadata = metadata or {}
+        name = kwargs.get("name") or (serialized or {}).get("name", "")
+        if parent_run_id is None:
+            self._start(run_id, None, name or "graph", GRAPH, {"thread_id": metadata.get("thread_id")})
+        elif metadata.get("langgraph_node") == name and not name.startswith("__") and parent_run_id in self.spans \
+                and self.spans[parent_run_id]["attributes"]["span.type"] == GRAPH:
+            self._start(run_id, parent_run_id, name, NODE, {"langgraph.step": metadata.get("langgraph_step")})
+        else:
+            self._link(run_id, parent_run_id)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=error)
+
+    # ========== モデル ==========
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        metadata = metadata or {}
+        model = metadata.get("ls_model_name") or kwargs.get("name") or (serialized or {}).get("name", "chat_model")
+        self._start(run_id, parent_run_id, f"llm {model}", LLM, {
+            "gen_ai.request.model": model,
+            "llm.input_messages": sum(len(batch) for batch in messages),
+        })
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        span = self.spans.get(run_id)
+        if span is not None and "llm.time_to_first_token" not in span["attributes"]:
+            span["attributes"]["llm.time_to_first_token"] = (time.time_ns() - span["startTimeUnixNano"]) / 1e9
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        attributes = {}
+        generations = [g for batch in response.generations for g in batch]
+        message = getattr(generations[0], "message", None) if generations else None
+        usage = getattr(message, "usage_metadata", None)
+        if usage:
+            attributes["gen_ai.usage.input_tokens"] = usage.get("input_tokens", 0)
+            attributes["gen_ai.usage.output_tokens"] = usage.get("output_tokens", 0)
+        if message is not None:
+            attributes["llm.tool_calls"] = len(getattr(message, "tool_calls", None) or [])
+        self._end(run_id, attributes=attributes)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=error)
+
+    # ========== ツール・MCPサーバ ==========
+
+    def on_tool_start(self, serialized, input_str, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        metadata = metadata or {}
+        name = kwargs.get("name") or (serialized or {}).get("name", "tool")
+        self._start(run_id, parent_run_id, f"tool {name}", TOOL, {
+            "tool.name": name,
+            "mcp.server": metadata.get("mcp_server"),
+            "tool.queue_seconds": metadata.get("queue_seconds"),
+        })
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        content = getattr(output, "content", output)
+        self._end(run_id, attributes={"tool.output_chars": len(content) if isinstance(content, (str, list)) else None})
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=error)
+
+    def on_custom_event(self, name, data, *, run_id, **kwargs):
+        """
+        MCPServerPoolのツールから送られたMCPサーバの呼び出し（起動待ちと通信の秒数）を、ツールの子のスパンとして記録する
+        """
+        if name != MCP_CALL_EVENT:
+            return
+        trace_id, parent_span_id = self._parent(run_id)
+        if trace_id is None:
+            return
+        end = time.time_ns()
+        span = {
+            "traceId": trace_id,
+            "spanId": os.urandom(8).hex(),
+            "parentSpanId": parent_span_id,
+            "name": f"mcp {data['server']}",
+            "kind": SPAN_KIND_CLIENT,
+            "startTimeUnixNano": end - int(data["call_seconds"] * 1e9),
+            "endTimeUnixNano": end,
+            "attributes": {
+                "span.type": MCP,
+                "mcp.server": data["server"],
+                "mcp.tool": data["tool"],
+                "mcp.ready_wait_seconds": data["wait_seconds"],
+            },
+            "status": {"code": STATUS_OK if data["ok"] else STATUS_ERROR},
+        }
+        self._export(span)
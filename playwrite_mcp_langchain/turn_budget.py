@@ -0,0 +1,120 @@
+import json
+import time
+from collections import Counter, OrderedDict
+
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.messages.utils import count_tokens_approximately
+
+
+FORCE_FINAL_PROMPT = """
+（システムからの指示）{reason_text}
+これ以上ツールは利用できません。これまでにツールから得られた情報だけを利用して、ユーザの質問に回答してください。
+情報が足りない場合は、分かったことと分からなかったことを分けて回答してください。
+"""
+
+REASON_TEXTS = {
+    "max_steps": "このターンのモデルの呼び出し回数の上限に達しました。",
+    "max_seconds": "このターンの処理時間の上限に達しました。",
+    "max_tokens": "このターンのトークン数の上限に達しました。",
+    "repeated_tool_call": "同じ引数で同じツールを繰り返し呼び出しています。",
+}
+
+
+def tool_call_signature(tool_call):
+    return f"{tool_call['name']}:{json.dumps(tool_call['args'], sort_keys=True, ensure_ascii=False)}"
+
+
+class TurnBudget:
+    """
+    1ターン（ユーザの1回の入力）ごとに、モデルの呼び出し回数・処理時間・トークン数の上限を管理するクラス
+    同じ引数で同じツールをmax_repeated_calls回を超えて呼び出そうとした場合もループとみなす
+    上限に達した場合は、ツールを利用できないモデルで最終的な回答を作成させる（call_modelから利用する）
+
+    stop_reasonsは、ターンの終了理由ごとの回数
+    "final_answer"（モデルが自分で回答した）, "max_steps", "max_seconds", "max_tokens", "repeated_tool_call"
+    """
+
+    def __init__(self, max_steps=10, max_seconds=180.0, max_tokens=300_000, max_repeated_calls=2,
+                 token_counter=count_tokens_approximately, max_threads=10000):
+        self.max_steps = max_steps
+        self.max_seconds = max_seconds
+        self.max_tokens = max_tokens
+        self.max_repeated_calls = max_repeated_calls
+        self.token_counter = token_counter
+        self.max_threads = max_threads
+        # thread_id -> そのスレッドの現在のターンの状態
+        self.turns = OrderedDict()
+        self.stop_reasons = Counter()
+
+    def _turn(self, thread_id, messages):
+        """
+        現在のターンの状態を返す。最後のHumanMessageの位置が変わった場合は新しいターンとして初期化する
+        """
+        turn_key = max((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), default=0)
+        turn = self.turns.get(thread_id)
+        if turn is None or turn["turn_key"] != turn_key:
+            turn = {"turn_key": turn_key, "start": time.perf_counter(), "steps": 0, "tokens": 0, "calls": Counter()}
+            self.turns[thread_id] = turn
+        self.turns.move_to_end(thread_id)
+        while len(self.turns) > self.max_threads:
+            self.turns.popitem(last=False)
+        return turn
+
+    def check(self, thread_id, messages):
+        """
+        モデルを呼び出す前に上限を確認する。上限に達している場合は理由を返す
+        """
+        turn = self._turn(thread_id, messages)
+        if turn["steps"] >= self.max_steps:
+            return "max_steps"
+        if time.perf_counter() - turn["start"] >= self.max_seconds:
+            return "max_seconds"
+        if turn["tokens"] >= self.max_tokens:
+            return "max_tokens"
+        return None
+
+    def record(self, thread_id, messages, input_messages, response):
+        """
+        モデルの呼び出し結果を記録し、ループしている場合は"repeated_tool_call"を返す
+        トークン数はusage_metadataがあればそれを、なければ推定値を利用する
+        """
+        turn = self._turn(thread_id, messages)
+        turn["steps"] += 1
+        usage = getattr(response, "usage_metadata", None)
+        if usage:
+            turn["tokens"] += usage.get("total_tokens", 0)
+        else:
+            turn["tokens"] += self.token_counter([*input_messages, response])
+
+        if not response.tool_calls:
+            self.stop_reasons["final_answer"] += 1
+            return None
+        for tool_call in response.tool_calls:
+            signature = tool_call_signature(tool_call)
+            turn["calls"][signature] += 1
+            if turn["calls"][signature] > self.max_repeated_calls:
+                return "repeated_tool_call"
+        return None
+
+    def force_final_messages(self, messages, reason):
+        """
+        最終的な回答を作成させるための入力を作成する
+        """
+        self.stop_reasons[reason] += 1
+        return [*messages, HumanMessage(content=FORCE_FINAL_PROMPT.format(reason_text=REASON_TEXTS[reason]))]
+
+    @staticmethod
+    def strip_tool_calls(response, reason):
+        """
+        ツールを利用できないように指示してもtool_callsが返ってきた場合に、tool_callsを取り除いた回答にする
+        """
+        if not response.tool_calls:
+            return response
+        content = response.content or f"（{REASON_TEXTS[reason]}回答を作成できませんでした）"
+        return AIMessage(content=content, id=response.id)
+
+    def turn_stats(self, thread_id):
+        turn = self.turns.get(thread_id)
+        if turn is None:
+            return {}
+        return {"steps": turn["steps"], "tokens": turn["tokens"], "seconds": time.perf_counter() - turn["start"]}